@@ -0,0 +1,168 @@
+"""Load test of full payment round trips against the in-process bank simulator
+
+Usage:
+
+    python benchmarks/load.py [--bank swedbank] [--count 2000] [--threads 1] [--success-rate 0.9]
+                              [--output load.json]
+
+Every round trip creates a payment request, lets `thorbanks.simulator.SimulatedBank` verify it and sign the
+response, delivers the automatic pingback (VK_AUTO=Y) to `thorbanks.views.response` and finally posts the
+user's return (VK_AUTO=N). No bank test server or browser is needed.
+
+The example project's test settings use an in-memory SQLite database, which doesn't allow concurrent writes.
+Point DJANGO_SETTINGS_MODULE to settings with a real database to use `--threads`.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from run import get_metadata, test_database
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadDriver(object):
+    def __init__(self, bank_name, key_dir, success_rate=1.0):
+        from django.conf import settings as django_settings
+        from django.urls import reverse
+
+        from thorbanks import settings
+        from thorbanks.simulator import SimulatedBank
+
+        self.bank_name = bank_name
+        self.url = reverse("thorbanks_response")
+        self.local = threading.local()
+
+        self.bank = SimulatedBank.for_bank(
+            bank_name, success_rate=success_rate, pingback=self.pingback
+        )
+
+        links = {name: dict(data) for name, data in django_settings.BANKLINKS.items()}
+        links[bank_name]["PUBLIC_KEY"] = os.path.join(key_dir, "%s_pub.pem" % bank_name)
+        self.bank.write_public_key(links[bank_name]["PUBLIC_KEY"])
+
+        django_settings.BANKLINKS = links
+        settings.invalidate()
+
+    @property
+    def client(self):
+        from django.test import Client
+
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = Client()
+
+        return client
+
+    def post(self, fields):
+        return self.client.post(
+            self.url,
+            urlencode(fields),
+            content_type="application/x-www-form-urlencoded",
+        )
+
+    def pingback(self, url, fields):
+        response = self.post(fields)
+        assert response.status_code == 200, response.status_code
+
+    def round_trip(self, index):
+        from django.db import connection
+
+        from thorbanks.views import create_payment_request
+
+        start = time.perf_counter()
+
+        try:
+            payment = create_payment_request(
+                self.bank_name,
+                message="Load test payment %d" % index,
+                amount=10,
+                currency="EUR",
+                pingback_url="http://testserver%s" % self.url,
+                redirect_to="http://example.com/success/",
+                redirect_on_failure="http://example.com/failed/",
+            )
+
+            url, fields = self.bank.handle(dict(payment.get_payload()))
+
+            response = self.post(fields)
+            assert response.status_code == 302, response.status_code
+
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+        return time.perf_counter() - start
+
+    def run(self, count, threads):
+        start = time.perf_counter()
+
+        if threads > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                timings = list(executor.map(self.round_trip, range(count)))
+        else:
+            timings = [self.round_trip(index) for index in range(count)]
+
+        elapsed = time.perf_counter() - start
+
+        return {
+            "round_trips": count,
+            "threads": threads,
+            "seconds": elapsed,
+            "per_minute": count / elapsed * 60,
+            "median_ms": statistics.median(timings) * 1e3,
+            "p95_ms": percentile(timings, 0.95) * 1e3,
+            "max_ms": max(timings) * 1e3,
+            "pingbacks": self.bank.pingbacks,
+            "rejected": self.bank.rejected,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bank", default="swedbank")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument(
+        "--success-rate",
+        type=float,
+        default=1.0,
+        help="Share of payments the simulated bank accepts",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with test_database(), tempfile.TemporaryDirectory() as key_dir:
+        from django.db import connection
+
+        if args.threads > 1 and connection.vendor == "sqlite":
+            parser.error("--threads needs a database which supports concurrent writes")
+
+        driver = LoadDriver(args.bank, key_dir, success_rate=args.success_rate)
+        results = driver.run(args.count, args.threads)
+        metadata = get_metadata(args.bank)
+
+    print(
+        "%(round_trips)d round trips in %(seconds).1fs: %(per_minute).0f/min, "
+        "median %(median_ms).1fms, p95 %(p95_ms).1fms, max %(max_ms).1fms" % results
+    )
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({"metadata": metadata, "results": results}, handle, indent=2)
+
+    return results
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main()["rejected"] == 0 else 1)
@@ -0,0 +1,313 @@
+"""Offline benchmarks for the signing, verification and request building hot paths
+
+Usage:
+
+    python benchmarks/run.py [--bank swedbank] [--rounds 5] [--iterations 200] [--output results.json]
+                             [--compare previous.json] [--only create_signature ...]
+
+Uses the example project settings with an in-memory test database and the merchant keys in certs/. The
+certs/*_pub.pem files are the banks' keys, so the benchmark acts as the bank by verifying against the public
+half of the merchant key (written to a temporary directory).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Registers `func(env, count)`, which returns a callable timed `count` times"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+class Environment(object):
+    def __init__(self, bank_name, key_dir):
+        from django.conf import settings as django_settings
+
+        from cryptography.hazmat.primitives import serialization
+
+        from thorbanks import settings
+
+        links = {}
+        for name, data in django_settings.BANKLINKS.items():
+            data = dict(data)
+
+            with open(data["PRIVATE_KEY"], "rb") as handle:
+                private_key = serialization.load_pem_private_key(
+                    handle.read(), password=None
+                )
+
+            data["PUBLIC_KEY"] = os.path.join(key_dir, "%s_pub.pem" % name)
+            with open(data["PUBLIC_KEY"], "wb") as handle:
+                handle.write(
+                    private_key.public_key().public_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PublicFormat.SubjectPublicKeyInfo,
+                    )
+                )
+
+            links[name] = data
+
+        django_settings.BANKLINKS = links
+        settings.invalidate()
+
+        self.bank_name = bank_name
+        self.context = settings.get_bank_context(bank_name)
+
+    def create_payment(self, amount=10):
+        from thorbanks.forms import PaymentRequest
+
+        return PaymentRequest(
+            bank_name=self.bank_name,
+            amount=amount,
+            currency="EUR",
+            redirect_to="http://example.com/success/",
+            redirect_on_failure="http://example.com/failed/",
+            message="Benchmark payment",
+            url="http://testserver/banks/thorbanks_response/",
+        )
+
+    def get_payment_fields(self):
+        return dict(self.create_payment().data)
+
+    def get_response_data(self, transaction):
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        from thorbanks.utils import get_pkey, HASH_ALGORITHMS, request_digest
+
+        data = {
+            "VK_SERVICE": "1111",
+            "VK_VERSION": self.context.version,
+            "VK_SND_ID": self.context.bank_id,
+            "VK_REC_ID": self.context.client_id,
+            "VK_STAMP": str(transaction.pk),
+            "VK_T_NO": "1000",
+            "VK_AMOUNT": "%.2f" % transaction.amount,
+            "VK_CURR": transaction.currency,
+            "VK_REC_ACC": "EE871600161234567892",
+            "VK_REC_NAME": "Shop",
+            "VK_SND_ACC": "EE871600161234567893",
+            "VK_SND_NAME": "Tõõgera Leõpäöldi",
+            "VK_REF": "",
+            "VK_MSG": transaction.message,
+            "VK_T_DATETIME": "2020-01-01T10:00:00+0200",
+            "VK_ENCODING": "UTF-8",
+            "VK_LANG": "EST",
+            "VK_AUTO": "Y",
+        }
+
+        digest = request_digest(data, self.bank_name, response=True)
+        signature = get_pkey(self.bank_name).sign(
+            digest,
+            padding.PKCS1v15(),
+            HASH_ALGORITHMS[self.context.verify_hash_algorithm],
+        )
+        data["VK_MAC"] = b64encode(signature).decode()
+        return data
+
+
+@benchmark
+def request_digest(env, count):
+    from thorbanks.utils import request_digest
+
+    fields = env.get_payment_fields()
+    return lambda: request_digest(fields, env.bank_name)
+
+
+@benchmark
+def create_signature(env, count):
+    from thorbanks.utils import create_signature
+
+    fields = env.get_payment_fields()
+    return lambda: create_signature(
+        fields, env.bank_name, env.context.sign_hash_algorithm
+    )
+
+
+@benchmark
+def verify_signature(env, count):
+    from thorbanks.utils import verify_signature
+
+    data = env.get_response_data(env.create_payment().transaction)
+    return lambda: verify_signature(data, env.bank_name, data["VK_MAC"], response=True)
+
+
+@benchmark
+def payment_request(env, count):
+    return env.create_payment
+
+
+@benchmark
+def redirect_html(env, count):
+    payment = env.create_payment()
+    return payment.redirect_html
+
+
+@benchmark
+def response_view(env, count):
+    """Full callback of a pending transaction through the Django test client"""
+    from django.test import Client
+    from django.urls import reverse
+
+    client = Client()
+    url = reverse("thorbanks_response")
+    payloads = [
+        urlencode(env.get_response_data(env.create_payment().transaction))
+        for _ in range(count)
+    ]
+
+    def post():
+        response = client.post(
+            url, payloads.pop(), content_type="application/x-www-form-urlencoded"
+        )
+        assert response.status_code == 200, response.status_code
+
+    return post
+
+
+def run_benchmark(env, func, rounds, iterations, warmup):
+    call = func(env, rounds * iterations + warmup)
+
+    for _ in range(warmup):
+        call()
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            call()
+        timings.append((time.perf_counter() - start) / iterations * 1e6)
+
+    return {
+        "rounds": rounds,
+        "iterations": iterations,
+        "mean_us": statistics.mean(timings),
+        "median_us": statistics.median(timings),
+        "min_us": min(timings),
+        "max_us": max(timings),
+        "stdev_us": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def get_metadata(bank_name):
+    import django
+
+    import cryptography
+
+    from thorbanks import settings
+
+    context = settings.get_bank_context(bank_name)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "django": django.get_version(),
+        "cryptography": cryptography.__version__,
+        "bank": bank_name,
+        "sign_hash_algorithm": context.sign_hash_algorithm,
+        "verify_hash_algorithm": context.verify_hash_algorithm,
+    }
+
+
+def print_results(results, previous=None):
+    header = "%-20s %12s %12s %12s" % ("benchmark", "median us", "min us", "stdev us")
+    if previous:
+        header += " %10s" % "vs prev"
+
+    print(header)
+    print("-" * len(header))
+
+    for name, result in results.items():
+        line = "%-20s %12.1f %12.1f %12.1f" % (
+            name,
+            result["median_us"],
+            result["min_us"],
+            result["stdev_us"],
+        )
+
+        if previous and name in previous:
+            line += " %9.2fx" % (result["median_us"] / previous[name]["median_us"])
+
+        print(line)
+
+
+@contextmanager
+def test_database():
+    """Sets up Django with the example project's test settings and an in-memory test database"""
+    sys.path.insert(0, ROOT_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "example.test_settings")
+
+    import django
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    django.setup()
+
+    # Signal receivers of the example project log every callback
+    logging.disable(logging.CRITICAL)
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bank", default="swedbank")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="JSON file of an earlier run to compare the results with"
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=sorted(BENCHMARKS), help="Benchmarks to run"
+    )
+    args = parser.parse_args(argv)
+
+    with test_database(), tempfile.TemporaryDirectory() as key_dir:
+        env = Environment(args.bank, key_dir)
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            results[name] = run_benchmark(
+                env, BENCHMARKS[name], args.rounds, args.iterations, args.warmup
+            )
+
+        metadata = get_metadata(args.bank)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as handle:
+            previous = json.load(handle)["results"]
+
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({"metadata": metadata, "results": results}, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -169,6 +169,12 @@ BANKLINKS = {
 # Tell django that thorbanks migrations are in thorbanks_models app
 MIGRATION_MODULES = {"thorbanks_models": "shop.thorbanks_migrations"}
 
+# The example project overrides the thorbanks redirect templates (see templates/thorbanks)
+THORBANKS_REDIRECT_TEMPLATES = True
+
 # Here you can customize where the bank logos are (used by the PaymentFormMixin). This is relative to STATIC_URL and
 #  must end with slash
 # BANKLINK_LOGO_PATH
+
+# Add a partial index on pending transactions/authentications (see thorbanks.abstract_models.get_status_indexes)
+THORBANKS_PENDING_INDEX = True
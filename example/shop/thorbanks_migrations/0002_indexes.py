@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("thorbanks_models", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="authentication",
+            index=models.Index(
+                fields=["status", "created"], name="authentication_status_created"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="authentication",
+            index=models.Index(
+                fields=["bank_name", "status"], name="authentication_bank_status"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="authentication",
+            index=models.Index(
+                condition=models.Q(("status", "P")),
+                fields=["bank_name", "created"],
+                name="authentication_pending",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["status", "created"], name="transaction_status_created"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["bank_name", "status"], name="transaction_bank_status"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                condition=models.Q(("status", "P")),
+                fields=["bank_name", "created"],
+                name="transaction_pending",
+            ),
+        ),
+    ]
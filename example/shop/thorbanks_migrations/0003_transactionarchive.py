@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:27
+
+from django.db import migrations, models
+
+import thorbanks.abstract_models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("thorbanks_models", "0002_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TransactionArchive",
+            fields=[
+                ("bank_name", models.CharField(max_length=16, verbose_name="bank")),
+                (
+                    "description",
+                    models.CharField(
+                        help_text="reference description",
+                        max_length=255,
+                        verbose_name="reference description",
+                    ),
+                ),
+                (
+                    "amount",
+                    models.DecimalField(
+                        decimal_places=2, max_digits=9, verbose_name="amount"
+                    ),
+                ),
+                ("currency", models.CharField(max_length=3, verbose_name="currency")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("P", "pending"), ("F", "failed"), ("C", "completed")],
+                        default="P",
+                        max_length=1,
+                        verbose_name="status",
+                    ),
+                ),
+                (
+                    "redirect_after_success",
+                    models.CharField(editable=False, max_length=255),
+                ),
+                (
+                    "redirect_on_failure",
+                    models.CharField(editable=False, max_length=255),
+                ),
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("created", models.DateTimeField()),
+                ("last_modified", models.DateTimeField()),
+                ("archived", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "archived transaction",
+                "ordering": ["-last_modified"],
+                "abstract": False,
+            },
+            bases=(thorbanks.abstract_models.StatusTransitionMixin, models.Model),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("thorbanks_models", "0003_transactionarchive"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="authentication",
+            name="person_code",
+            field=models.CharField(
+                blank=True, db_index=True, max_length=32, verbose_name="Person code"
+            ),
+        ),
+        migrations.AddField(
+            model_name="authentication",
+            name="person_name",
+            field=models.CharField(blank=True, max_length=140, verbose_name="Name"),
+        ),
+    ]
@@ -9,7 +9,6 @@ from django.views.generic import TemplateView
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, FormView
 
-from thorbanks.settings import configure, get_links
 from thorbanks.utils import pingback_url
 from thorbanks.views import (
     AuthError,
@@ -42,15 +41,7 @@ class PaymentView(CreateView):
 
         # Allow overwriting of send_ref value via url param (this is for unittests)
         # WARNING: Don't use this in production code
-        old_val = get_links()[bank_name].get("SEND_REF", True)
         send_ref = self.request.GET.get("send_ref", "1") == "1"
-        configure(
-            __only_use_during_tests={
-                bank_name: {
-                    "SEND_REF": send_ref,
-                }
-            }
-        )
 
         # Create new payment request
         payment = create_payment_request(
@@ -61,15 +52,8 @@ class PaymentView(CreateView):
             pingback_url=pingback_url(self.request),
             redirect_on_failure=redirect_on_failure_url,
             redirect_to=redirect_url,
-        )
-
-        # restore old SEND_REF value
-        configure(
-            __only_use_during_tests={
-                bank_name: {
-                    "SEND_REF": old_val,
-                }
-            }
+            # Only applies to this request
+            options={"SEND_REF": send_ref},
         )
 
         # Attach the pending transaction object to the Order object
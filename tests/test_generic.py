@@ -1,21 +1,90 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import logging
 import os
 import random
+import threading
 from base64 import b64decode, b64encode
+from concurrent.futures import Future
+from datetime import timedelta
+from io import BytesIO, StringIO
+from urllib.parse import urlencode
 
+import django
+from django import forms
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIRequest
+from django.core.management import call_command
+from django.db.models import Q
+from django.http import Http404
+from django.test.utils import isolate_apps
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.encoding import force_bytes, force_str
 
 import pytest
 
-from cryptography.hazmat.primitives import hashes
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 
 from thorbanks import settings as th_settings
+from thorbanks.abstract_models import AbstractTransaction, get_status_indexes
+from thorbanks.archive import archive_transactions, get_archive_model
+from thorbanks.bulk import create_payment_requests_bulk
 from thorbanks.checks import check_banklink_settings
-from thorbanks.forms import PaymentRequest
-from thorbanks.utils import get_pkey, pingback_url, request_digest
+from thorbanks.expiry import expire_pending, get_pending_ttl
+from thorbanks.forms import IPizzaAuthRequest, PaymentRequest
+from thorbanks.keys import key_registry, KeyRegistry
+from thorbanks.metrics import get_metrics, LocalMetrics, metrics_view, NullMetrics
+from thorbanks.nonces import reset_nonce_backend
+from thorbanks.raw_response import decode_raw_response, encode_raw_response
+from thorbanks.refnum import (
+    calculate_731_checksum,
+    calculate_731_checksums,
+    is_valid_reference,
+    validate_references,
+)
+from thorbanks.replay import get_replay_cache, reset_replay_cache
+from thorbanks.signals import transaction_failed, transaction_succeeded
+from thorbanks.signers import (
+    get_signer,
+    InProcessSigner,
+    ProcessPoolSigner,
+    reset_signer,
+)
+from thorbanks.simulator import SimulatedBank, SimulatorError
+from thorbanks.tracing import get_tracer, NULL_SPAN
+from thorbanks.utils import (
+    build_digest,
+    get_detected_hash_algorithm,
+    get_pkey,
+    hash_algorithm_detector,
+    HASH_ALGORITHMS,
+    IPIZZA_REQUEST_ORDER,
+    pingback_url,
+    request_digest,
+    verify_signature,
+)
+from thorbanks.views import (
+    async_response,
+    AsyncAuthResponseView,
+    AuthError,
+    AuthResponseView,
+    create_payment_request,
+    parse_callback_data,
+    PaymentError,
+)
+
+
+try:
+    from django.test import AsyncRequestFactory
+except ImportError:  # Django < 3.1
+    AsyncRequestFactory = None
+
+requires_async_views = pytest.mark.skipif(
+    django.VERSION < (3, 1), reason="Async views require Django 3.1+"
+)
 
 
 def only_issue_ids(issues):
@@ -89,6 +158,45 @@ def get_banklink_config(bank_name=None, printable_name=None):
     }
 
 
+def write_public_key(private_key_path, target_path):
+    """Writes the public half of `private_key_path` so tests can act as the bank"""
+    with open(private_key_path, "rb") as handle:
+        private_key = serialization.load_pem_private_key(handle.read(), password=None)
+
+    with open(target_path, "wb") as handle:
+        handle.write(
+            private_key.public_key().public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+        )
+
+    return str(target_path)
+
+
+def get_loopback_banklink_config(tmp_path):
+    """Banklink config where the bank public key matches our private key
+
+    This allows signing bank responses in tests with `get_pkey`.
+    """
+    conf = get_banklink_config()
+
+    for bank_name, data in conf.items():
+        data["PUBLIC_KEY"] = write_public_key(
+            data["PRIVATE_KEY"], tmp_path / ("%s_pub.pem" % bank_name)
+        )
+
+    return conf
+
+
+def sign_response(data, bank_name, hash_algorithm, auth=False):
+    digest = request_digest(data, bank_name, auth=auth, response=True)
+    signature = get_pkey(bank_name).sign(
+        digest, padding.PKCS1v15(), HASH_ALGORITHMS[hash_algorithm]
+    )
+    return force_str(b64encode(signature))
+
+
 def test_no_settings_raises_exception(settings):
     settings.BANKLINKS = None
 
@@ -277,3 +385,1360 @@ def test_payment_form_html_decode_error():
 
     assert isinstance(form.submit_button(), str)
     assert isinstance(form.redirect_html(), str)
+
+
+def test_key_registry_caches_and_reloads(tmp_path):
+    certs_dir = os.path.join(os.path.dirname(__file__), "..", "certs")
+    key_path = str(tmp_path / "key.pem")
+
+    with open(os.path.join(certs_dir, "swed_key.pem"), "rb") as handle:
+        swed_key = handle.read()
+
+    with open(os.path.join(certs_dir, "seb_key.pem"), "rb") as handle:
+        seb_key = handle.read()
+
+    with open(key_path, "wb") as handle:
+        handle.write(swed_key)
+
+    registry = KeyRegistry()
+    first = registry.get_private_key("swedbank", key_path)
+    assert registry.get_private_key("swedbank", key_path) is first
+    assert registry.stats() == {"hits": 1, "misses": 1, "reloads": 0, "size": 1}
+
+    # Rotate the key on disk, the registry must pick up the new key
+    with open(key_path, "wb") as handle:
+        handle.write(seb_key)
+    stat = os.stat(key_path)
+    os.utime(key_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    second = registry.get_private_key("swedbank", key_path)
+    assert second is not first
+    assert second.private_numbers() != first.private_numbers()
+    assert registry.stats() == {"hits": 1, "misses": 1, "reloads": 1, "size": 1}
+
+    # Hits from concurrent lookups are all counted
+    def lookup():
+        for _ in range(200):
+            registry.get_private_key("swedbank", key_path)
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert registry.stats()["hits"] == 1 + 8 * 200
+
+
+def test_bank_context(settings):
+    conf = get_banklink_config()
+    settings.BANKLINKS = conf
+    th_settings.configure()
+
+    context = th_settings.get_bank_context("seb")
+
+    assert context.client_id == conf["seb"]["CLIENT_ID"]
+    assert context.version == "009"
+    assert context.send_ref is False
+    assert context.digest_counts_bytes is True
+    assert isinstance(context.sign_hasher, hashes.SHA512)
+    assert context.payment_fields == {
+        "VK_SERVICE": "1012",
+        "VK_VERSION": "009",
+        "VK_SND_ID": conf["seb"]["CLIENT_ID"],
+    }
+    assert context.private_key is get_pkey("seb")
+
+    with pytest.raises(AttributeError):
+        context.client_id = "other"
+
+    with pytest.raises(AttributeError):
+        context.extra = True
+
+
+def test_verify_signature_remembers_hash_algorithm(settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+    hash_algorithm_detector.clear()
+
+    data = {
+        "VK_SERVICE": "1111",
+        "VK_VERSION": "008",
+        "VK_SND_ID": "HP",
+        "VK_REC_ID": "uid100052",
+        "VK_STAMP": "1",
+        "VK_T_NO": "100",
+        "VK_AMOUNT": "10.00",
+        "VK_CURR": "EUR",
+        "VK_REF": "17",
+        "VK_MSG": "Test",
+        "VK_T_DATETIME": "2020-01-01T10:00:00+0200",
+    }
+    signature = sign_response(data, "swedbank", "sha512")
+
+    # swedbank is configured to use sha1, so the first callback has to fall back
+    assert get_detected_hash_algorithm("swedbank") is None
+    assert verify_signature(data, "swedbank", signature, response=True)
+    assert get_detected_hash_algorithm("swedbank") == "sha512"
+
+    candidates = hash_algorithm_detector.candidates("swedbank", "sha1")
+    assert candidates[0] == "sha512"
+    assert candidates[-1] == "sha1"
+
+    assert verify_signature(data, "swedbank", signature, response=True)
+    assert hash_algorithm_detector.stats()["swedbank"]["successes"] == {"sha512": 2}
+
+    # Tampered data must not verify with any algorithm
+    assert not verify_signature(
+        dict(data, VK_AMOUNT="1.00"), "swedbank", signature, response=True
+    )
+    assert get_detected_hash_algorithm("swedbank") == "sha512"
+
+
+def test_build_digest_length_prefixes():
+    data = {"VK_SERVICE": "1012", "VK_MSG": "müsli", "VK_STAMP": 15}
+    field_order = ("VK_SERVICE", "VK_STAMP", "VK_REF", "VK_MSG")
+
+    assert build_digest(data, field_order) == "004101200215005müsli".encode("UTF-8")
+    assert build_digest(data, field_order, count_bytes=True) == (
+        "004101200215006müsli".encode("UTF-8")
+    )
+
+
+def test_invalid_field_orders(settings):
+    settings.BANKLINKS = get_banklink_config()
+    settings.BANKLINKS["swedbank"]["FIELD_ORDERS"] = {"1111": "VK_SERVICE"}
+
+    assert only_issue_ids(check_banklink_settings(None)) == [
+        "thorbanks.E012",
+    ]
+
+
+def test_field_order_registry(settings):
+    conf = get_banklink_config()
+    conf["lhv"]["FIELD_ORDERS"] = {"1111": ["VK_SERVICE", "VK_STAMP"]}
+    settings.BANKLINKS = conf
+    th_settings.configure()
+
+    swedbank = th_settings.get_bank_context("swedbank")
+    lhv = th_settings.get_bank_context("lhv")
+
+    for service in ["1011", "1012", "1111", "1911", "3012", "3013", "4011", "4012"]:
+        assert swedbank.get_field_order(service) == IPIZZA_REQUEST_ORDER[service]
+
+    # Unknown services fall back to the defaults of the message type
+    assert swedbank.get_field_order(None) == IPIZZA_REQUEST_ORDER["1012"]
+    assert swedbank.get_field_order("9999", response=True) == (
+        IPIZZA_REQUEST_ORDER["1111"]
+    )
+    assert swedbank.get_field_order(None, auth=True) == IPIZZA_REQUEST_ORDER["4012"]
+
+    # Bank specific variants
+    assert lhv.get_field_order("1111") == ("VK_SERVICE", "VK_STAMP")
+    assert request_digest({"VK_SERVICE": "1111", "VK_STAMP": "5"}, "lhv") == (
+        b"00411110015"
+    )
+
+    # Services are only accepted by the endpoint they belong to
+    assert swedbank.is_allowed_service("1911", response=True)
+    assert not swedbank.is_allowed_service("1911", auth=True, response=True)
+    assert not swedbank.is_allowed_service("3013", response=True)
+    assert not swedbank.is_allowed_service(None, auth=True, response=True)
+    assert not swedbank.is_allowed_service("1112", response=True)
+    assert not swedbank.is_allowed_service("3012", auth=True, response=True)
+
+
+@pytest.mark.django_db
+def test_auth_rejects_payment_response(client, rf, settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    request = IPizzaAuthRequest(
+        "swedbank", "http://example.com/logged-in/", "http://example.com/auth/"
+    )
+    assert request.is_valid()
+
+    # VK_NONCE is not part of the MAC of payment responses
+    transaction = create_test_payment().transaction
+    data = dict(get_payment_response_data(transaction, "1911"), VK_NONCE=request.nonce)
+
+    with pytest.raises(AuthError, match="Unexpected VK_SERVICE 1911"):
+        AuthResponseView.as_view()(
+            rf.post(
+                "/auth/",
+                urlencode(data),
+                content_type="application/x-www-form-urlencoded",
+            )
+        )
+
+    request.auth.refresh_from_db()
+    assert request.auth.status == request.auth.STATUS_PENDING
+
+    # The MAC of 3012 doesn't cover VK_NONCE, any nonce could be added to a genuine response
+    data = get_auth_response_data(request.nonce, "swedbank", service="3012")
+    assert not verify_signature(
+        data, "swedbank", data["VK_MAC"], auth=True, response=True
+    )
+
+    with pytest.raises(AuthError, match="Unexpected VK_SERVICE 3012"):
+        AuthResponseView.as_view()(
+            rf.post(
+                "/auth/",
+                urlencode(data),
+                content_type="application/x-www-form-urlencoded",
+            )
+        )
+
+    request.auth.refresh_from_db()
+    assert request.auth.status == request.auth.STATUS_PENDING
+
+    # Likewise auth responses are rejected by the payment callback
+    data = dict(
+        get_auth_response_data(request.nonce, "swedbank"), VK_STAMP=str(transaction.pk)
+    )
+    with pytest.raises(PaymentError, match="Unexpected VK_SERVICE 3013"):
+        client.post(
+            reverse("thorbanks_response"),
+            urlencode(data),
+            content_type="application/x-www-form-urlencoded",
+        )
+
+    # Bank specific services are accepted when they match the message type
+    conf = get_loopback_banklink_config(tmp_path)
+    conf["swedbank"]["FIELD_ORDERS"] = {"1112": IPIZZA_REQUEST_ORDER["1111"]}
+    settings.BANKLINKS = conf
+    th_settings.configure()
+
+    assert th_settings.get_bank_context("swedbank").is_allowed_service(
+        "1112", response=True
+    )
+
+
+@pytest.mark.django_db
+def test_create_payment_requests_bulk(settings):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    payments = [
+        {
+            "message": "Invoice %d" % x,
+            "amount": 10 + x,
+            "currency": "EUR",
+            "redirect_to": "http://example.com/success/",
+            "redirect_on_failure": "http://example.com/failed/",
+        }
+        for x in range(3)
+    ]
+    payloads = create_payment_requests_bulk(
+        "swedbank", payments, "http://example.com/banks/thorbanks_response/"
+    )
+
+    assert len(payloads) == 3
+    assert len({x.transaction.pk for x in payloads}) == 3
+
+    for payment, payload in zip(payments, payloads):
+        assert payload.transaction.pk is not None
+        assert payload.transaction.message == payment["message"]
+        assert payload.request_url == get_banklink_config()["swedbank"]["REQUEST_URL"]
+
+        # The payload must match what the regular payment request produces
+        request = PaymentRequest(
+            existing_transaction=payload.transaction,
+            url="http://example.com/banks/thorbanks_response/",
+        )
+        assert payload.fields == dict(
+            request.cleaned_data, VK_MAC=request["VK_MAC"].value()
+        )
+
+
+def test_signer_backends(settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    digest = b"0041012003008"
+    expected = InProcessSigner().sign("swedbank", digest, "sha1")
+
+    signer = ProcessPoolSigner(pool_size=1)
+    try:
+        assert signer.sign("swedbank", digest, "sha1") == expected
+        assert signer.sign_many("swedbank", [digest] * 3, "sha1") == [expected] * 3
+        assert signer.verify("swedbank", digest, expected, ["sha512", "sha1"]) == "sha1"
+        assert signer.verify("swedbank", b"other", expected, ["sha1"]) is None
+
+        # Workers that don't respond in time are replaced by in-process signing
+        signer.timeout = 0
+        assert signer.sign("swedbank", digest, "sha1") == expected
+    finally:
+        signer.close()
+
+    # ...and the abandoned work is cancelled instead of being left in the pool
+    class StalledExecutor(object):
+        def __init__(self):
+            self.futures = []
+
+        def submit(self, *args):
+            self.futures.append(Future())
+            return self.futures[-1]
+
+    executor = StalledExecutor()
+    signer = ProcessPoolSigner(pool_size=2, timeout=0)
+    signer.get_executor = lambda: executor
+
+    assert signer.sign("swedbank", digest, "sha1") == expected
+    assert signer.sign_many("swedbank", [digest] * 3, "sha1") == [expected] * 3
+    assert len(executor.futures) == 4
+    assert all(future.cancelled() for future in executor.futures)
+
+    settings.THORBANKS_SIGNER = {
+        "BACKEND": "thorbanks.signers.ProcessPoolSigner",
+        "OPTIONS": {"pool_size": 1, "timeout": 10},
+    }
+    reset_signer()
+    try:
+        assert isinstance(get_signer(), ProcessPoolSigner)
+        assert verify_signature(
+            {"VK_SERVICE": "1012"},
+            "swedbank",
+            sign_response({"VK_SERVICE": "1012"}, "swedbank", "sha1"),
+        )
+    finally:
+        reset_signer()
+
+
+def get_payment_response_data(transaction, service="1111", auto="N"):
+    data = {
+        "VK_SERVICE": service,
+        "VK_VERSION": "008",
+        "VK_SND_ID": "HP",
+        "VK_REC_ID": "uid100052",
+        "VK_STAMP": str(transaction.pk),
+        "VK_REF": "",
+        "VK_MSG": transaction.message,
+        "VK_ENCODING": "UTF-8",
+        "VK_LANG": "EST",
+        "VK_AUTO": auto,
+    }
+
+    if service == "1111":
+        data.update(
+            {
+                "VK_T_NO": "1000",
+                "VK_AMOUNT": "%.2f" % transaction.amount,
+                "VK_CURR": transaction.currency,
+                "VK_REC_ACC": "EE871600161234567892",
+                "VK_REC_NAME": "Shop",
+                "VK_SND_ACC": "EE871600161234567893",
+                "VK_SND_NAME": "Tõõgera Leõpäöldi",
+                "VK_T_DATETIME": "2020-01-01T10:00:00+0200",
+            }
+        )
+    else:
+        data["VK_DATETIME"] = "2020-01-01T10:00:00+0200"
+
+    data["VK_MAC"] = sign_response(data, transaction.bank_name, "sha1")
+    return data
+
+
+def create_test_payment(amount=10):
+    return PaymentRequest(
+        bank_name="swedbank",
+        amount=amount,
+        currency="EUR",
+        redirect_to="http://example.com/success/",
+        redirect_on_failure="http://example.com/failed/",
+        message="My cool payment",
+        url="http://example.com/banks/thorbanks_response/",
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("service", ["1111", "1911"])
+def test_response_view(client, settings, tmp_path, service):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    transaction = create_test_payment().transaction
+
+    response = client.post(
+        reverse("thorbanks_response"),
+        urlencode(get_payment_response_data(transaction, service=service)),
+        content_type="application/x-www-form-urlencoded",
+    )
+    transaction.refresh_from_db()
+
+    if service == "1111":
+        assert response["Location"] == "http://example.com/success/"
+        assert transaction.status == transaction.STATUS_COMPLETED
+    else:
+        assert response["Location"] == "http://example.com/failed/"
+        assert transaction.status == transaction.STATUS_FAILED
+
+    response = client.post(
+        reverse("thorbanks_response"),
+        urlencode(get_payment_response_data(transaction, service=service, auto="Y")),
+        content_type="application/x-www-form-urlencoded",
+    )
+    assert response.content == b"request handled"
+
+
+@requires_async_views
+@pytest.mark.django_db
+def test_async_response_view(settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    transaction = create_test_payment().transaction
+    request = AsyncRequestFactory().post(
+        reverse("thorbanks_response"),
+        urlencode(get_payment_response_data(transaction)),
+        content_type="application/x-www-form-urlencoded",
+    )
+
+    response = async_to_sync(async_response)(request)
+    transaction.refresh_from_db()
+
+    assert response["Location"] == "http://example.com/success/"
+    assert transaction.status == transaction.STATUS_COMPLETED
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "use_async", [False, pytest.param(True, marks=requires_async_views)]
+)
+def test_late_payment_after_expiry(client, settings, tmp_path, caplog, use_async):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    transaction = create_test_payment().transaction
+
+    # The transaction expires while the user is still paying at the bank
+    assert expire_pending("Transaction", ttl=-10) == 1
+    transaction.refresh_from_db()
+    assert transaction.status == transaction.STATUS_FAILED
+
+    succeeded = []
+
+    def receiver(sender, transaction, late=False, **kwargs):
+        succeeded.append((transaction.pk, late))
+
+    def post(auto):
+        data = urlencode(get_payment_response_data(transaction, auto=auto))
+        if not use_async:
+            return client.post(
+                reverse("thorbanks_response"),
+                data,
+                content_type="application/x-www-form-urlencoded",
+            )
+
+        request = AsyncRequestFactory().post(
+            reverse("thorbanks_response"),
+            data,
+            content_type="application/x-www-form-urlencoded",
+        )
+        return async_to_sync(async_response)(request)
+
+    transaction_succeeded.connect(receiver)
+    try:
+        with caplog.at_level(logging.CRITICAL):
+            response = post("N")
+            assert post("Y").content == b"request handled"
+    finally:
+        transaction_succeeded.disconnect(receiver)
+
+    transaction.refresh_from_db()
+    assert response["Location"] == "http://example.com/success/"
+    assert transaction.status == transaction.STATUS_COMPLETED
+
+    # Only the first callback completes the transaction, the pingback is a duplicate
+    assert succeeded == [(transaction.pk, True)]
+    assert [r.levelno for r in caplog.records].count(logging.CRITICAL) == 1
+    assert "failed transaction %s" % transaction.pk in caplog.text
+
+
+@requires_async_views
+@pytest.mark.django_db
+@pytest.mark.parametrize("service", ["3013", "3014"])
+def test_async_auth_response_view(settings, tmp_path, service):
+    conf = get_loopback_banklink_config(tmp_path)
+    # Bank specific failure response, the MAC covers VK_NONCE like 3013
+    conf["swedbank"]["FIELD_ORDERS"] = {"3014": IPIZZA_REQUEST_ORDER["3013"]}
+    settings.BANKLINKS = conf
+    th_settings.configure()
+
+    klass = th_settings.get_model("Authentication")
+    view = AsyncAuthResponseView.as_view()
+
+    request = IPizzaAuthRequest(
+        "swedbank",
+        "http://example.com/logged-in/",
+        "http://example.com/auth/",
+        extra_fields={"redirect_on_failure": "http://example.com/login-failed/"},
+    )
+    assert request.is_valid()
+
+    def post(data):
+        return async_to_sync(view)(
+            AsyncRequestFactory().post(
+                "/auth/",
+                urlencode(data),
+                content_type="application/x-www-form-urlencoded",
+            )
+        )
+
+    response = post(get_auth_response_data(request.nonce, "swedbank", service))
+    auth = klass.objects.get(pk=request.auth.pk)
+
+    if service == "3013":
+        assert response["Location"] == "http://example.com/logged-in/"
+        assert auth.status == klass.STATUS_COMPLETED
+        assert auth.person_code == "37602294565"
+    else:
+        assert response["Location"] == "http://example.com/login-failed/"
+        assert auth.status == klass.STATUS_FAILED
+
+    with pytest.raises(Http404):
+        post(get_auth_response_data(str(request.auth.pk + 1000), "swedbank"))
+
+
+@pytest.mark.django_db
+def test_payment_request_validates_once(settings, monkeypatch):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    def full_clean(self):
+        raise AssertionError("full_clean should not be called")
+
+    with monkeypatch.context() as m:
+        m.setattr(PaymentRequest, "full_clean", full_clean)
+        request = create_test_payment()
+        assert request.is_valid()
+
+    # The compiled schema must produce the same result as the regular form cleaning
+    form = PaymentRequest.__new__(PaymentRequest)
+    forms.Form.__init__(form, dict(request.data))
+    assert form.is_valid()
+    assert form.cleaned_data == request.cleaned_data
+
+    with pytest.raises(RuntimeError):
+        PaymentRequest(
+            bank_name="swedbank",
+            amount=10,
+            currency="EUR",
+            redirect_to="http://example.com/",
+            redirect_on_failure="http://example.com/",
+            message="",
+            url="http://example.com/",
+        )
+
+
+@pytest.mark.django_db
+def test_redirect_html(settings):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    request = PaymentRequest(
+        bank_name="swedbank",
+        amount=20.40,
+        currency="EUR",
+        redirect_to="http://example.com",
+        redirect_on_failure="http://example.com",
+        message='Pangalink: <"müsli">',
+        url="http://example.com/?a=1&b=2",
+    )
+
+    html = request.redirect_html()
+    assert html.startswith(
+        '<form action="%s" method="POST" id="banklink_redirect_url" accept-charset="UTF-8">'
+        % settings.BANKLINKS["swedbank"]["REQUEST_URL"]
+    )
+    assert "document.forms['banklink_redirect_url'].submit();" in html
+    assert (
+        '<input type="hidden" name="VK_MSG" value="Pangalink: &lt;&quot;müsli&quot;&gt;">'
+        in html
+    )
+    assert (
+        '<input type="hidden" name="VK_RETURN" value="http://example.com/?a=1&amp;b=2">'
+        in html
+    )
+    assert (
+        '<input type="hidden" name="VK_MAC" value="%s">' % request["VK_MAC"].value()
+        in html
+    )
+    assert html.count('type="hidden"') == len(request.fields)
+
+    settings.THORBANKS_REDIRECT_TEMPLATES = False
+    page = request.get_redirect_response_html()
+    assert page.startswith("<html><head><title>Banklink request</title>")
+    assert html in page
+
+    settings.THORBANKS_REDIRECT_TEMPLATES = True
+    page = request.get_redirect_response_html()
+    assert "favicon.ico" in page
+    assert html in page
+
+
+@pytest.mark.django_db
+def test_transition_status(settings):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    klass = th_settings.get_model("Transaction")
+    pk = create_test_payment().transaction.pk
+
+    # Two requests holding the same pending row
+    first = klass.objects.get(pk=pk)
+    second = klass.objects.get(pk=pk)
+
+    # Columns not part of the transition must not be overwritten
+    klass.objects.filter(pk=pk).update(description="Changed elsewhere")
+
+    assert first.transition_status(klass.STATUS_COMPLETED)
+    assert first.status == klass.STATUS_COMPLETED
+
+    assert not second.transition_status(klass.STATUS_FAILED)
+    assert second.status == klass.STATUS_PENDING
+
+    row = klass.objects.get(pk=pk)
+    assert row.status == klass.STATUS_COMPLETED
+    assert row.description == "Changed elsewhere"
+
+    assert (
+        klass.objects.transition(pk, klass.STATUS_FAILED, klass.STATUS_COMPLETED) == 1
+    )
+    assert klass.objects.get(pk=pk).status == klass.STATUS_FAILED
+
+
+def test_status_indexes(settings):
+    klass = th_settings.get_model("Transaction")
+    names = {index.name for index in klass._meta.indexes}
+
+    assert {"transaction_status_created", "transaction_bank_status"} <= names
+
+    # Manual models with long class names get Django's hash based names instead
+    with isolate_apps("thorbanks_models"):
+
+        class PaymentTransactionWithLongName(AbstractTransaction):
+            class Meta(AbstractTransaction.Meta):
+                app_label = "thorbanks_models"
+
+        names = [x.name for x in PaymentTransactionWithLongName._meta.indexes]
+        assert len(set(names)) == len(names)
+        assert all(len(x) <= 30 for x in names)
+        assert "models.E034" not in only_issue_ids(
+            PaymentTransactionWithLongName.check()
+        )
+
+    settings.THORBANKS_PENDING_INDEX = False
+    assert [x.name for x in get_status_indexes()] == [
+        "%(class)s_status_created",
+        "%(class)s_bank_status",
+    ]
+
+    settings.THORBANKS_PENDING_INDEX = True
+    pending = get_status_indexes()[-1]
+    assert pending.fields == ["bank_name", "created"]
+    assert pending.condition == Q(status="P")
+
+
+@pytest.mark.django_db
+def test_expire_pending(settings):
+    settings.BANKLINKS = get_banklink_config()
+    settings.BANKLINKS["swedbank"]["PENDING_TTL"] = 60
+    th_settings.configure()
+
+    klass = th_settings.get_model("Transaction")
+    old = [create_test_payment().transaction for _ in range(5)]
+    fresh = create_test_payment().transaction
+    resolved = create_test_payment().transaction
+    klass.objects.transition(resolved.pk, klass.STATUS_COMPLETED, klass.STATUS_PENDING)
+
+    klass.objects.filter(pk__in=[x.pk for x in old] + [resolved.pk]).update(
+        created=timezone.now() - timedelta(minutes=5)
+    )
+
+    failed = []
+
+    def receiver(sender, transaction, expired=False, **kwargs):
+        assert expired
+        failed.append(transaction.pk)
+
+    transaction_failed.connect(receiver)
+    try:
+        assert expire_pending("Transaction", bank_names=["swedbank"], chunk_size=2) == 5
+        assert expire_pending("Transaction", bank_names=["swedbank"]) == 0
+    finally:
+        transaction_failed.disconnect(receiver)
+
+    assert sorted(failed) == sorted(x.pk for x in old)
+    assert klass.objects.get(pk=fresh.pk).status == klass.STATUS_PENDING
+    assert klass.objects.get(pk=resolved.pk).status == klass.STATUS_COMPLETED
+
+    settings.THORBANKS_PENDING_TTL = 30
+    assert get_pending_ttl("swedbank") == 60
+    assert get_pending_ttl("seb") == 30
+
+    # Banks which were removed from BANKLINKS are swept too
+    removed = create_test_payment().transaction
+    klass.objects.filter(pk=removed.pk).update(
+        bank_name="oldbank", created=timezone.now() - timedelta(minutes=1)
+    )
+    assert expire_pending("Transaction") == 1
+    assert klass.objects.get(pk=removed.pk).status == klass.STATUS_FAILED
+
+    out = StringIO()
+    call_command(
+        "thorbanks_expire_pending", "--model", "Transaction", "--ttl", "0", stdout=out
+    )
+    assert "Expired 1 pending Transaction rows" in out.getvalue()
+    assert klass.objects.get(pk=fresh.pk).status == klass.STATUS_FAILED
+
+
+@pytest.mark.django_db
+def test_archive_transactions(client, settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    th_settings.configure()
+
+    klass = th_settings.get_model("Transaction")
+    archive = get_archive_model()
+
+    done = [create_test_payment().transaction for _ in range(3)]
+    pending = create_test_payment().transaction
+    for transaction in done:
+        klass.objects.transition(
+            transaction.pk, klass.STATUS_COMPLETED, klass.STATUS_PENDING
+        )
+
+    last_modified = timezone.now() - timedelta(days=100)
+    klass.objects.update(last_modified=last_modified)
+
+    assert archive_transactions(chunk_size=2) == 3
+    assert archive_transactions() == 0
+
+    assert list(klass.objects.values_list("pk", flat=True)) == [pending.pk]
+
+    archived = archive.objects.get(pk=done[0].pk)
+    assert archived.status == klass.STATUS_COMPLETED
+    assert archived.last_modified == last_modified
+    assert archived.redirect_after_success == "http://example.com/success/"
+
+    # Late callbacks of archived transactions are resolved through the archive
+    response = client.post(
+        reverse("thorbanks_response"),
+        urlencode(get_payment_response_data(done[0], "1111", "N")),
+        content_type="application/x-www-form-urlencoded",
+    )
+    assert response.status_code == 302
+    assert response["Location"] == "http://example.com/success/"
+
+
+@pytest.mark.django_db
+def test_archive_keeps_conflicting_transactions(settings):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    klass = th_settings.get_model("Transaction")
+    archive = get_archive_model()
+
+    transaction = create_test_payment().transaction
+    klass.objects.transition(
+        transaction.pk, klass.STATUS_COMPLETED, klass.STATUS_PENDING
+    )
+    klass.objects.update(last_modified=timezone.now() - timedelta(days=100))
+
+    # e.g. the primary key was reused after the archived row was created
+    archive.objects.create(
+        **{
+            x.attname: getattr(transaction, x.attname)
+            for x in klass._meta.concrete_fields
+        },
+    )
+    archive.objects.filter(pk=transaction.pk).update(description="Older transaction")
+
+    with pytest.raises(RuntimeError, match="already exist in the archive"):
+        archive_transactions()
+
+    assert klass.objects.filter(pk=transaction.pk).exists()
+    assert archive.objects.get(pk=transaction.pk).description == "Older transaction"
+
+
+@pytest.mark.django_db
+def test_archive_skips_referenced_transactions(settings):
+    from shop.models import Order
+
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    klass = th_settings.get_model("Transaction")
+
+    transaction = create_test_payment().transaction
+    klass.objects.transition(
+        transaction.pk, klass.STATUS_COMPLETED, klass.STATUS_PENDING
+    )
+    klass.objects.update(last_modified=timezone.now() - timedelta(days=100))
+    order = Order.objects.create(amount=10, transaction_id=transaction.pk)
+
+    # Archiving would clear the order's SET_NULL reference
+    assert archive_transactions() == 0
+    order.refresh_from_db()
+    assert order.transaction_id == transaction.pk
+
+    out = StringIO()
+    call_command("thorbanks_archive", "--include-referenced", stdout=out)
+    assert "Archived 1 transactions" in out.getvalue()
+
+    order.refresh_from_db()
+    assert order.transaction_id is None
+    assert get_archive_model().objects.filter(pk=transaction.pk).exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("mode", ["json", "compact", "repr"])
+def test_raw_response_storage(settings, mode):
+    settings.THORBANKS_RAW_RESPONSE_STORAGE = mode
+
+    klass = th_settings.get_model("Authentication")
+    auth = klass.objects.create(bank_name="swedbank")
+
+    data = {
+        "VK_SERVICE": "3013",
+        "VK_VERSION": "008",
+        "VK_NONCE": str(auth.pk),
+        "VK_USER_NAME": "Tõõgera Leõpäöldi",
+        "VK_USER_ID": "37602294565",
+        "VK_COUNTRY": "EE",
+        "VK_MAC": "c2lnbmF0dXJl",
+    }
+
+    assert auth.transition_status(
+        klass.STATUS_COMPLETED, **auth.get_response_fields(data)
+    )
+
+    auth = klass.objects.get(person_code="37602294565")
+    assert auth.person_name == "Tõõgera Leõpäöldi"
+    assert auth.get_raw_response() == data
+
+    if mode == "compact":
+        assert "VK_" not in auth.raw_response
+        assert "37602294565" not in auth.raw_response
+
+    assert decode_raw_response(encode_raw_response(data, mode="json")) == data
+    assert decode_raw_response(str(data)) == data
+
+
+def test_parse_callback_data(rf):
+    query = "VK_ENCODING=ISO-8859-1&VK_SND_NAME=T%F5%F5gera+Le%F5p%E4%F6ldi&VK_REF="
+    request = rf.get("/banks/thorbanks_response/?" + query)
+
+    data = parse_callback_data(request)
+    assert data == {
+        "VK_ENCODING": "ISO-8859-1",
+        "VK_SND_NAME": "Tõõgera Leõpäöldi",
+        "VK_REF": "",
+    }
+    assert parse_callback_data(request) is data
+
+    with pytest.raises(TypeError):
+        data["VK_REF"] = "1"
+
+    # Bytes which were not percent-encoded reach the view as a latin-1 decoded QUERY_STRING
+    request = rf.get("/banks/thorbanks_response/")
+    request.META["QUERY_STRING"] = "VK_SND_NAME=Tõõgera Leõpäöldi".encode(
+        "UTF-8"
+    ).decode("iso-8859-1")
+    assert parse_callback_data(request) == {"VK_SND_NAME": "Tõõgera Leõpäöldi"}
+
+    # ASGIRequest decodes QUERY_STRING as UTF-8, the raw bytes come from the scope
+    request = ASGIRequest(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/banks/thorbanks_response/",
+            "query_string": "VK_SND_NAME=Jüri €".encode("UTF-8"),
+            "headers": [],
+        },
+        BytesIO(b""),
+    )
+    assert parse_callback_data(request) == {"VK_SND_NAME": "Jüri €"}
+
+    request = rf.post(
+        "/banks/thorbanks_response/",
+        urlencode({"VK_SND_NAME": "Tõõgera Leõpäöldi", "VK_MSG": "a+b=c&d"}),
+        content_type="application/x-www-form-urlencoded",
+    )
+    assert parse_callback_data(request) == {
+        "VK_SND_NAME": "Tõõgera Leõpäöldi",
+        "VK_MSG": "a+b=c&d",
+    }
+
+    request = rf.post("/banks/thorbanks_response/", {"VK_SND_NAME": "Tõõgera"})
+    assert parse_callback_data(request) == {"VK_SND_NAME": "Tõõgera"}
+
+
+@pytest.mark.django_db
+def test_replay_cache(client, settings, tmp_path, monkeypatch):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    settings.THORBANKS_REPLAY_CACHE = {"TIMEOUT": 60, "LOCAL_SIZE": 1}
+    settings.THORBANKS_METRICS = {"BACKEND": "thorbanks.metrics.LocalMetrics"}
+    th_settings.configure()
+    reset_replay_cache()
+
+    transaction = create_test_payment().transaction
+    payload = get_payment_response_data(transaction, "1111", "Y")
+
+    def post(data):
+        return client.post(
+            reverse("thorbanks_response"),
+            urlencode(data),
+            content_type="application/x-www-form-urlencoded",
+        )
+
+    try:
+        assert post(payload).content == b"request handled"
+
+        replay_cache = get_replay_cache()
+        assert replay_cache.stats()["misses"] == 1
+
+        def verify_signature(*args, **kwargs):
+            raise AssertionError("Duplicate callbacks must not be verified again")
+
+        with monkeypatch.context() as m:
+            m.setattr("thorbanks.views.verify_signature", verify_signature)
+
+            # The user returning from the bank carries the same signature
+            response = post(dict(payload, VK_AUTO="N"))
+            assert response["Location"] == "http://example.com/success/"
+
+            # Served from the Django cache once evicted from the local tier
+            replay_cache.clear()
+            assert post(payload).content == b"request handled"
+
+        assert replay_cache.stats() == {
+            "local_hits": 0,
+            "shared_hits": 1,
+            "misses": 0,
+            "hit_rate": 1.0,
+            "local_size": 1,
+        }
+
+        # Hits of both tiers are attributed to the bank
+        assert (
+            get_metrics().get_value(
+                "duplicate_callbacks_total", bank="swedbank", source="replay_cache"
+            )
+            == 2
+        )
+
+    finally:
+        caches["default"].clear()
+        reset_replay_cache()
+
+
+def get_auth_response_data(nonce, bank_name, service="3013"):
+    data = {
+        "VK_SERVICE": service,
+        "VK_VERSION": "008",
+        "VK_DATETIME": "2020-01-01T10:00:00+0200",
+        "VK_SND_ID": "HP",
+        "VK_REC_ID": "uid100052",
+        "VK_NONCE": nonce,
+        "VK_USER_NAME": "Tõõgera Leõpäöldi",
+        "VK_USER_ID": "37602294565",
+        "VK_COUNTRY": "EE",
+        "VK_OTHER": "",
+        "VK_TOKEN": "1",
+        "VK_RID": "",
+        "VK_ENCODING": "UTF-8",
+        "VK_LANG": "EST",
+    }
+    data["VK_MAC"] = sign_response(
+        data,
+        bank_name,
+        th_settings.get_verify_hash_algorithm(bank_name),
+        auth=True,
+    )
+    return data
+
+
+@pytest.mark.django_db
+def test_cache_nonce_backend(rf, settings, tmp_path):
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    settings.THORBANKS_NONCE_BACKEND = {
+        "BACKEND": "thorbanks.nonces.CacheNonceBackend",
+        "OPTIONS": {"timeout": 60},
+    }
+    th_settings.configure()
+    reset_nonce_backend()
+
+    klass = th_settings.get_model("Authentication")
+    view = AuthResponseView.as_view()
+
+    try:
+        # Starting an authentication doesn't touch the database
+        request = IPizzaAuthRequest(
+            "swedbank", "http://example.com/logged-in/", "http://example.com/auth/"
+        )
+        assert request.is_valid()
+        assert not klass.objects.exists()
+
+        nonce = request.data["VK_NONCE"]
+        assert 0 < len(nonce) <= 50
+
+        data = get_auth_response_data(nonce, "swedbank")
+        for _ in range(2):
+            response = view(
+                rf.post(
+                    "/auth/",
+                    urlencode(data),
+                    content_type="application/x-www-form-urlencoded",
+                )
+            )
+            assert response["Location"] == "http://example.com/logged-in/"
+
+        # The row is only created for the valid response, and only once
+        auth = klass.objects.get()
+        assert auth.status == klass.STATUS_COMPLETED
+        assert auth.bank_name == "swedbank"
+        assert auth.person_code == "37602294565"
+
+        # The row keeps the time which was sent to the bank as VK_DATETIME
+        assert auth.created == request.auth.created
+        assert auth.created.strftime("%Y-%m-%dT%H:%M:%S%z") == (
+            request.data["VK_DATETIME"]
+        )
+
+        # The nonce is not the primary key, so compact storage has to keep it
+        assert auth.get_raw_response()["VK_NONCE"] == nonce
+        settings.THORBANKS_RAW_RESPONSE_STORAGE = "compact"
+        fields = klass(pk=auth.pk).get_response_fields(data)
+        assert nonce in fields["raw_response"]
+        assert klass(pk=auth.pk, **fields).get_raw_response() == data
+
+        unknown = get_auth_response_data("unknown", "swedbank")
+        with pytest.raises(Http404):
+            view(rf.get("/auth/?" + urlencode(unknown)))
+
+    finally:
+        caches["default"].clear()
+        reset_nonce_backend()
+
+
+def test_config_snapshot(settings, monkeypatch):
+    settings.BANKLINKS = get_banklink_config()
+    snapshot = th_settings.get_snapshot()
+
+    # The snapshot is reused without touching the filesystem
+    with monkeypatch.context() as m:
+        m.setattr("os.path.isfile", None)
+        assert th_settings.get_snapshot() is snapshot
+        assert th_settings.get_bank_context("swedbank").client_id == "uid100052"
+
+    # Changing the settings invalidates it
+    conf = get_banklink_config()
+    conf["swedbank"]["CLIENT_ID"] = "uid100011"
+    settings.BANKLINKS = conf
+
+    new_snapshot = th_settings.get_snapshot()
+    assert new_snapshot.version > snapshot.version
+    assert th_settings.get_client_id("swedbank") == "uid100011"
+
+
+@pytest.mark.django_db
+def test_override_bank_options(settings):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    context = th_settings.get_bank_context("swedbank")
+    assert context.send_ref and context.language == "EST"
+
+    with th_settings.override_bank_options("swedbank", SEND_REF=False, LANGUAGE="ENG"):
+        overridden = th_settings.get_bank_context("swedbank")
+        assert not overridden.send_ref
+        assert overridden.language == "ENG"
+        assert th_settings.get_bank_context("swedbank") is overridden
+        assert th_settings.get_send_ref("swedbank") is False
+
+        # Other threads keep seeing the global configuration
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(th_settings.get_send_ref("swedbank"))
+        )
+        thread.start()
+        thread.join()
+        assert results == [True]
+
+    assert th_settings.get_bank_context("swedbank") is context
+
+    payment = create_payment_request(
+        bank_name="swedbank",
+        message="My cool payment",
+        amount=10,
+        currency="EUR",
+        pingback_url="http://example.com/banks/thorbanks_response/",
+        redirect_to="http://example.com/success/",
+        redirect_on_failure="http://example.com/failed/",
+        options={"SEND_REF": False, "LANGUAGE": "RUS"},
+    )
+    assert payment.data["VK_REF"] == ""
+    assert payment.data["VK_LANG"] == "RUS"
+
+    assert create_test_payment().data["VK_REF"] != ""
+
+
+def reference_731_checksum(number):
+    """The original string based implementation"""
+    number = str(int(number))[::-1]
+    weights = [7, 3, 1] * len(number)
+    weight_sum = sum(int(x) * weights[i] for i, x in enumerate(number))
+    return int(number[::-1] + str((10 - weight_sum % 10) % 10))
+
+
+def test_reference_numbers():
+    numbers = list(range(1, 2000)) + [123456789012345678, random.randint(1, 10**18)]
+
+    assert calculate_731_checksum(1) == 13
+    assert calculate_731_checksum("1234") == 12344
+    assert [calculate_731_checksum(x) for x in numbers] == [
+        reference_731_checksum(x) for x in numbers
+    ]
+    assert calculate_731_checksums(numbers) == [
+        reference_731_checksum(x) for x in numbers
+    ]
+
+    assert is_valid_reference("13")
+    assert is_valid_reference(12344)
+    assert not is_valid_reference("12345")
+    assert not is_valid_reference("1")
+    assert not is_valid_reference("1" * 21)
+    assert not is_valid_reference("12a4")
+    assert not is_valid_reference("1２")
+    assert validate_references(["13", "14", "12344"]) == ["14"]
+
+
+def test_reference_numbers_numpy():
+    numpy = pytest.importorskip("numpy")
+
+    numbers = numpy.arange(1, 100000)
+    result = calculate_731_checksums(numbers)
+
+    assert isinstance(result, numpy.ndarray)
+    assert result.tolist() == [calculate_731_checksum(x) for x in range(1, 100000)]
+
+
+@pytest.mark.django_db
+def test_metrics(client, rf, settings, tmp_path):
+    assert isinstance(get_metrics(), NullMetrics)
+    with pytest.raises(Http404):
+        metrics_view(rf.get("/metrics/"))
+
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    settings.THORBANKS_METRICS = {
+        "BACKEND": "thorbanks.metrics.LocalMetrics",
+        "OPTIONS": {"buckets": (0.01, 1.0)},
+    }
+    th_settings.configure()
+
+    metrics = get_metrics()
+    assert isinstance(metrics, LocalMetrics)
+
+    transaction = create_test_payment().transaction
+    assert metrics.get_value("payment_requests_total", bank="swedbank") == 1
+    assert (
+        metrics.get_value("sign_seconds", bank="swedbank", hash_algorithm="sha1") == 1
+    )
+
+    payload = get_payment_response_data(transaction, "1111", "Y")
+    for data in [payload, dict(payload, VK_AUTO="N")]:
+        client.post(
+            reverse("thorbanks_response"),
+            urlencode(data),
+            content_type="application/x-www-form-urlencoded",
+        )
+
+    assert (
+        metrics.get_value("callbacks_total", bank="swedbank", service="1111", auto="Y")
+        == 1
+    )
+    assert (
+        metrics.get_value(
+            "duplicate_callbacks_total", bank="swedbank", source="database"
+        )
+        == 1
+    )
+    assert metrics.get_value("verify_seconds", bank="swedbank") == 2
+
+    assert not verify_signature(
+        dict(payload, VK_AMOUNT="0.01"), "swedbank", payload["VK_MAC"], response=True
+    )
+    assert (
+        metrics.get_value("signature_failures_total", bank="swedbank", kind="payment")
+        == 1
+    )
+
+    response = metrics_view(rf.get("/metrics/"))
+    lines = force_str(response.content).splitlines()
+
+    assert "# TYPE thorbanks_sign_seconds histogram" in lines
+    assert 'thorbanks_verify_seconds_bucket{bank="swedbank",le="+Inf"} 3' in lines
+    assert (
+        'thorbanks_verifications_total{bank="swedbank",hash_algorithm="none",valid="false"} 1'
+        in lines
+    )
+
+
+@pytest.mark.django_db
+def test_tracing(caplog, client, settings, tmp_path, monkeypatch):
+    assert get_tracer().span("payment_request", bank="swedbank") is NULL_SPAN
+
+    settings.BANKLINKS = get_loopback_banklink_config(tmp_path)
+    settings.THORBANKS_TRACER = {
+        "BACKEND": "thorbanks.tracing.LoggingTracer",
+        "OPTIONS": {"level": "INFO"},
+    }
+    th_settings.configure()
+
+    # Tracing times the key lookups of the signer instead of adding its own
+    lookups = []
+    for name in ("get_private_key", "get_public_key"):
+        method = getattr(key_registry, name)
+        monkeypatch.setattr(
+            key_registry,
+            name,
+            lambda *args, _name=name, _method=method: lookups.append(_name)
+            or _method(*args),
+        )
+
+    with caplog.at_level("INFO", logger="thorbanks.tracing"):
+        payment = create_test_payment()
+        payment.get_redirect_response()
+        assert lookups == ["get_private_key"]
+
+        data = urlencode(get_payment_response_data(payment.transaction))
+        del lookups[:]
+
+        client.post(
+            reverse("thorbanks_response"),
+            data,
+            content_type="application/x-www-form-urlencoded",
+        )
+        assert lookups == ["get_public_key"]
+
+    spans = {
+        record.span: record.attributes
+        for record in caplog.records
+        if record.name == "thorbanks.tracing"
+    }
+
+    assert set(spans) == {
+        "payment_request",
+        "payment_request.save",
+        "payment_request.prepare",
+        "payment_request.sign",
+        "payment_request.render",
+        "payment_callback",
+        "payment_callback.parse",
+        "payment_callback.lookup",
+        "payment_callback.verify",
+        "payment_callback.transition",
+        "payment_callback.signal",
+        "signature.digest",
+        "signature.load_key",
+        "signature.sign",
+        "signature.verify",
+    }
+    assert spans["payment_request"] == {
+        "bank": "swedbank",
+        "transaction_id": payment.transaction.pk,
+    }
+    assert spans["payment_callback"] == {
+        "bank": "swedbank",
+        "transaction_id": payment.transaction.pk,
+        "service": "1111",
+    }
+
+
+@pytest.mark.django_db
+def test_simulated_bank(client, rf, settings, tmp_path):
+    settings.BANKLINKS = get_banklink_config()
+    th_settings.configure()
+
+    def pingback(url, fields):
+        response = client.post(
+            reverse("thorbanks_response"),
+            urlencode(fields),
+            content_type="application/x-www-form-urlencoded",
+        )
+        assert response.content == b"request handled"
+
+    bank = SimulatedBank.for_bank("swedbank", pingback=pingback)
+
+    config = get_banklink_config()
+    config["swedbank"]["PUBLIC_KEY"] = str(tmp_path / "swedbank_pub.pem")
+    bank.write_public_key(config["swedbank"]["PUBLIC_KEY"])
+    settings.BANKLINKS = config
+    th_settings.configure()
+
+    # Successful payment, the pingback completes the transaction before the user returns
+    payment = create_test_payment()
+    url, fields = bank.handle(dict(payment.get_payload()))
+    assert url == "http://example.com/banks/thorbanks_response/"
+    assert fields["VK_SERVICE"] == "1111"
+
+    transaction = payment.transaction
+    transaction.refresh_from_db()
+    assert transaction.status == transaction.STATUS_COMPLETED
+    assert bank.pingbacks == 1
+
+    response = client.post(
+        reverse("thorbanks_response"),
+        urlencode(fields),
+        content_type="application/x-www-form-urlencoded",
+    )
+    assert response["Location"] == "http://example.com/success/"
+
+    # Failed payment
+    bank.success_rate = 0
+    payment = create_test_payment()
+    url, fields = bank.handle(dict(payment.get_payload()))
+    assert fields["VK_SERVICE"] == "1911"
+
+    payment.transaction.refresh_from_db()
+    assert payment.transaction.status == transaction.STATUS_FAILED
+
+    # Requests with an invalid signature are rejected
+    data = dict(create_test_payment().get_payload(), VK_AMOUNT="0.01")
+    with pytest.raises(SimulatorError):
+        bank.handle(data)
+    assert bank.rejected == 1
+
+    # Authentication
+    request = IPizzaAuthRequest(
+        "swedbank", "http://example.com/logged-in/", "http://example.com/auth/"
+    )
+    assert request.is_valid()
+
+    url, fields = bank.handle(dict(request.get_payload()))
+    assert url == "http://example.com/auth/"
+    assert fields["VK_SERVICE"] == "3013"
+
+    response = AuthResponseView.as_view()(
+        rf.post(
+            "/auth/",
+            urlencode(fields),
+            content_type="application/x-www-form-urlencoded",
+        )
+    )
+    assert response["Location"] == "http://example.com/logged-in/"
+
+    # WSGI
+    body = urlencode(create_test_payment().get_payload()).encode()
+    statuses = []
+    result = bank(
+        {
+            "REQUEST_METHOD": "POST",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": BytesIO(body),
+        },
+        lambda status, headers: statuses.append(status),
+    )
+    assert statuses == ["200 OK"]
+    assert b'name="VK_MAC"' in b"".join(result)
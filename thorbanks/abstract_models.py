@@ -1,8 +1,125 @@
+from django.conf import settings as django_settings
 from django.db import models
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from asgiref.sync import sync_to_async
 
-class AbstractTransaction(models.Model):
+from thorbanks.raw_response import (
+    COMPACT_RAW_RESPONSE_EXCLUDE,
+    decode_raw_response,
+    encode_raw_response,
+)
+
+
+def get_status_indexes():
+    """Indexes shared by the abstract Transaction and Authentication models
+
+    The composite indexes cover the admin listings (status + created) and the per bank reconciliation
+    queries (bank_name + status). Set `THORBANKS_PENDING_INDEX = True` to also add a partial index on
+    the pending rows, which stays small no matter how many completed rows the table holds. Backends
+    without partial index support (e.g. MySQL) skip it when migrating.
+
+    Note: Index names are limited to 30 characters, names which end up longer than that (manual models with
+    long class names) are replaced with Django's hash based index names, see `shorten_status_index_names`.
+    The `%(class)s` placeholder in index names requires Django 3.0+ (the minimum supported version).
+    """
+    indexes = [
+        models.Index(fields=["status", "created"], name="%(class)s_status_created"),
+        models.Index(fields=["bank_name", "status"], name="%(class)s_bank_status"),
+    ]
+
+    if getattr(django_settings, "THORBANKS_PENDING_INDEX", False):
+        indexes.append(
+            models.Index(
+                fields=["bank_name", "created"],
+                name="%(class)s_pending",
+                condition=models.Q(status="P"),
+            )
+        )
+
+    return indexes
+
+
+@receiver(class_prepared)
+def shorten_status_index_names(sender, **kwargs):
+    """Renames the status indexes of models whose class name makes them too long for Django (models.E034)
+
+    Short names are kept as they are, so the indexes of existing models don't have to be migrated.
+    """
+    if not issubclass(sender, StatusTransitionMixin):
+        return
+
+    for index in sender._meta.indexes:
+        if len(index.name) > index.max_name_length:
+            index.set_name_with_model(sender)
+
+
+class BanklinkQuerySet(models.QuerySet):
+    def transition(self, pk, status, from_status, **fields):
+        """Atomically moves the row `pk` from `from_status` to `status`
+
+        Runs a single `UPDATE ... WHERE pk = %s AND status = %s` which only writes the given columns, so
+        concurrent callbacks for the same row (e.g. the bank's automatic pingback and the user's redirect)
+        can't both win. Returns the number of updated rows.
+        """
+        fields["status"] = status
+        fields.setdefault("last_modified", timezone.now())
+
+        return self.filter(pk=pk, status=from_status).update(**fields)
+
+    async def atransition(self, pk, status, from_status, **fields):
+        """Async variant of `transition`"""
+        fields["status"] = status
+        fields.setdefault("last_modified", timezone.now())
+
+        queryset = self.filter(pk=pk, status=from_status)
+        if hasattr(queryset, "aupdate"):
+            return await queryset.aupdate(**fields)
+
+        return await sync_to_async(queryset.update)(**fields)
+
+
+class StatusTransitionMixin(object):
+    def _get_transition_queryset(self):
+        return BanklinkQuerySet(model=type(self), using=self._state.db)
+
+    def _apply_transition(self, status, fields):
+        self.status = status
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def transition_status(self, status, from_status=None, **fields):
+        """Moves this object to `status` if it is still in `from_status` (pending by default)
+
+        Returns True if this call made the transition, in which case the in-memory object is updated too.
+        """
+        fields["last_modified"] = timezone.now()
+        updated = self._get_transition_queryset().transition(
+            self.pk, status, from_status or self.STATUS_PENDING, **fields
+        )
+
+        if updated:
+            self._apply_transition(status, fields)
+
+        return bool(updated)
+
+    async def atransition_status(self, status, from_status=None, **fields):
+        """Async variant of `transition_status`"""
+        fields["last_modified"] = timezone.now()
+        updated = await self._get_transition_queryset().atransition(
+            self.pk, status, from_status or self.STATUS_PENDING, **fields
+        )
+
+        if updated:
+            self._apply_transition(status, fields)
+
+        return bool(updated)
+
+
+class AbstractTransaction(StatusTransitionMixin, models.Model):
     STATUS_PENDING = "P"
     STATUS_FAILED = "F"
     STATUS_COMPLETED = "C"
@@ -26,6 +143,8 @@ class AbstractTransaction(models.Model):
     redirect_after_success = models.CharField(max_length=255, editable=False)
     redirect_on_failure = models.CharField(max_length=255, editable=False)
 
+    objects = BanklinkQuerySet.as_manager()
+
     def __str__(self):
         return _("Transaction {} - {} {:.2f} from {} [{}]").format(
             self.id,
@@ -39,6 +158,7 @@ class AbstractTransaction(models.Model):
         abstract = True
         verbose_name = _("transaction")
         ordering = ["-last_modified"]
+        indexes = get_status_indexes()
 
     @property
     def message(self):
@@ -49,7 +169,7 @@ class AbstractTransaction(models.Model):
         self.description = value
 
 
-class AbstractAuthentication(models.Model):
+class AbstractAuthentication(StatusTransitionMixin, models.Model):
     STATUS_PENDING = "P"
     STATUS_FAILED = "F"
     STATUS_COMPLETED = "C"
@@ -68,6 +188,12 @@ class AbstractAuthentication(models.Model):
     redirect_after_success = models.CharField(max_length=255, editable=False)
     redirect_on_failure = models.CharField(max_length=255, editable=False)
     raw_response = models.TextField(blank=True)
+    person_code = models.CharField(
+        _("Person code"), max_length=32, blank=True, db_index=True
+    )
+    person_name = models.CharField(_("Name"), max_length=140, blank=True)
+
+    objects = BanklinkQuerySet.as_manager()
 
     def __str__(self):
         return "Authentication %s - %s [%s]" % (
@@ -76,7 +202,51 @@ class AbstractAuthentication(models.Model):
             self.get_status_display(),
         )  # pragma no cover
 
+    def get_response_fields(self, data):
+        """Returns the column values storing the bank's response `data` (see THORBANKS_RAW_RESPONSE_STORAGE)"""
+        exclude = COMPACT_RAW_RESPONSE_EXCLUDE
+        if self.pk is None or data.get("VK_NONCE") != str(self.pk):
+            # VK_NONCE can only be restored from the primary key if it is the primary key (see CacheNonceBackend)
+            exclude = tuple(x for x in exclude if x != "VK_NONCE")
+
+        return {
+            "raw_response": encode_raw_response(data, exclude=exclude),
+            "person_code": data.get("VK_USER_ID") or "",
+            "person_name": data.get("VK_USER_NAME") or "",
+        }
+
+    def get_raw_response(self):
+        """Returns the bank's response as a dict, regardless of the storage mode it was saved with"""
+        data = decode_raw_response(self.raw_response)
+
+        if data:
+            data.setdefault("VK_NONCE", str(self.pk))
+            data.setdefault("VK_USER_ID", self.person_code)
+            data.setdefault("VK_USER_NAME", self.person_name)
+
+        return data
+
     class Meta:
         abstract = True
         verbose_name = _("Authentication")
         ordering = ["-last_modified"]
+        indexes = get_status_indexes()
+
+
+class AbstractTransactionArchive(AbstractTransaction):
+    """Completed and failed transactions moved out of the main table by `thorbanks.archive`
+
+    Rows keep the primary key of the original transaction so late bank callbacks (VK_STAMP) can still be
+    resolved. The timestamps are copied as-is instead of being set on insert.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    created = models.DateTimeField()
+    last_modified = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        abstract = True
+        verbose_name = _("archived transaction")
+        ordering = ["-last_modified"]
+        indexes = []
@@ -0,0 +1,149 @@
+from datetime import timedelta
+
+from django.conf import settings as django_settings
+from django.db import connections, router
+from django.db import transaction as db_transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from thorbanks import settings
+
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def get_archive_model():
+    """Returns the TransactionArchive model or None if archiving is not set up
+
+    With THORBANKS_MANUAL_MODELS archiving is enabled by adding a "TransactionArchive" entry pointing to a
+    subclass of `thorbanks.abstract_models.AbstractTransactionArchive`.
+    """
+    try:
+        return settings.get_model("TransactionArchive")
+    except LookupError:
+        return None
+
+
+def get_archived_transaction(pk, using=None):
+    """Fallback lookup for transactions which are no longer in the main table, returns None if not found"""
+    archive = get_archive_model()
+    if archive is None:
+        return None
+
+    return archive._default_manager.db_manager(using).filter(pk=pk).first()
+
+
+def _get_reverse_relations(klass):
+    """Returns the relations of other models pointing to `klass`"""
+    return [
+        x
+        for x in klass._meta.get_fields(include_hidden=True)
+        if x.is_relation and x.auto_created and not x.concrete and x.related_model
+    ]
+
+
+def _exclude_referenced(queryset, relations):
+    """Removes the rows of `queryset` which are still referenced through one of `relations`"""
+    for relation in relations:
+        queryset = queryset.filter(
+            ~Exists(
+                relation.related_model._base_manager.filter(
+                    **{relation.field.name: OuterRef("pk")}
+                )
+            )
+        )
+
+    return queryset
+
+
+def _archive_chunk(klass, archive, queryset, chunk_size, field_names):
+    using = router.db_for_write(klass)
+    archive_using = router.db_for_write(archive)
+
+    with db_transaction.atomic(using=using), db_transaction.atomic(using=archive_using):
+        # Locked so late callbacks can't change the rows between copying and deleting them
+        if connections[using].features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+
+        rows = list(queryset.order_by("pk")[:chunk_size])
+        if not rows:
+            return 0
+
+        pks = [row.pk for row in rows]
+        existing = list(
+            archive._default_manager.using(archive_using)
+            .filter(pk__in=pks)
+            .values_list("pk", flat=True)
+        )
+        if existing:
+            # Never delete a transaction which can't be archived (e.g. a reused primary key)
+            raise RuntimeError(
+                "Transactions %s already exist in the archive"
+                % ", ".join(str(x) for x in sorted(existing))
+            )
+
+        archive._default_manager.db_manager(archive_using).bulk_create(
+            [archive(**{x: getattr(row, x) for x in field_names}) for row in rows]
+        )
+
+        klass._default_manager.using(using).filter(pk__in=pks).delete()
+
+    return len(rows)
+
+
+def archive_transactions(
+    days=None, chunk_size=DEFAULT_CHUNK_SIZE, now=None, include_referenced=False
+):
+    """Moves completed and failed transactions not modified in `days` days to the archive model
+
+    `days` defaults to settings.THORBANKS_ARCHIVE_AFTER_DAYS (90). Rows are moved `chunk_size` at a time,
+    every chunk is inserted into the archive and deleted from the main table in its own database
+    transaction so an interrupted run can simply be restarted. Pending rows are never archived. Raises
+    RuntimeError (leaving the chunk in place) if a transaction's primary key is already in the archive.
+
+    Transactions which are still referenced by other models (e.g. an order's ForeignKey/OneToOneField) are
+    skipped, deleting them would apply the `on_delete` of the reference (clearing it with SET_NULL or
+    deleting the referencing rows with CASCADE). Pass `include_referenced=True` to archive them anyway, in
+    which case the regular Django deletion collector runs the `on_delete` handlers.
+
+    Returns the number of archived rows.
+    """
+    archive = get_archive_model()
+    if archive is None:
+        raise RuntimeError(
+            "Transaction archiving is not configured, see thorbanks.archive.get_archive_model"
+        )
+
+    klass = settings.get_model("Transaction")
+
+    if days is None:
+        days = getattr(
+            django_settings, "THORBANKS_ARCHIVE_AFTER_DAYS", DEFAULT_ARCHIVE_AFTER_DAYS
+        )
+
+    if now is None:
+        now = timezone.now()
+
+    archive_fields = {x.attname for x in archive._meta.concrete_fields}
+    field_names = [
+        x.attname for x in klass._meta.concrete_fields if x.attname in archive_fields
+    ]
+
+    queryset = klass._default_manager.using(router.db_for_write(klass)).filter(
+        status__in=[klass.STATUS_COMPLETED, klass.STATUS_FAILED],
+        last_modified__lt=now - timedelta(days=days),
+    )
+    if not include_referenced:
+        queryset = _exclude_referenced(queryset, _get_reverse_relations(klass))
+
+    count = 0
+    while True:
+        archived = _archive_chunk(klass, archive, queryset, chunk_size, field_names)
+        if not archived:
+            break
+
+        count += archived
+
+    return count
@@ -0,0 +1,163 @@
+from base64 import b64encode
+
+from django.db import connections, router
+from django.db import transaction as db_transaction
+from django.utils.encoding import force_str
+
+from thorbanks import settings
+from thorbanks.forms import (
+    build_transaction,
+    get_payment_request_fields,
+    render_redirect_form,
+)
+from thorbanks.metrics import get_metrics
+from thorbanks.refnum import calculate_731_checksums
+from thorbanks.signals import transaction_started
+from thorbanks.signers import get_signer, ProcessPoolSigner
+from thorbanks.utils import _get_hasher, request_digest
+
+
+# Batches smaller than this are always signed in-process, starting worker processes costs more than it saves
+PROCESS_POOL_THRESHOLD = 200
+
+
+class SignedPaymentPayload(object):
+    """Lightweight result of `create_payment_requests_bulk`
+
+    Holds the saved transaction and the signed VK_* fields (including VK_MAC) which should be POSTed to
+    `request_url`.
+    """
+
+    __slots__ = ("transaction", "fields", "request_url")
+
+    def __init__(self, transaction, fields, request_url):
+        self.transaction = transaction
+        self.fields = fields
+        self.request_url = request_url
+
+    def __repr__(self):
+        return "<SignedPaymentPayload %s>" % self.transaction.pk
+
+    def redirect_html(self, submit_value=None):
+        return render_redirect_form(
+            self.request_url, self.fields.items(), submit_value=submit_value
+        )
+
+
+def sign_digests(bank_name, digests, hash_algorithm, processes=None):
+    """Signs all `digests` with the private key of the bank, returns base64 encoded signatures
+
+    The configured signer backend is used by default. When `processes` is greater than one and the batch
+    is large enough, a dedicated `ProcessPoolSigner` with that many workers is used for this batch.
+    """
+    _get_hasher(hash_algorithm, bank_name)
+
+    if processes and processes > 1 and len(digests) >= PROCESS_POOL_THRESHOLD:
+        signer = ProcessPoolSigner(pool_size=processes)
+        try:
+            signatures = signer.sign_many(bank_name, digests, hash_algorithm)
+        finally:
+            signer.close()
+
+    else:
+        signatures = get_signer().sign_many(bank_name, digests, hash_algorithm)
+
+    metrics = get_metrics()
+    if metrics.enabled:
+        metrics.increment(
+            "signatures_total",
+            len(signatures),
+            bank=bank_name,
+            hash_algorithm=hash_algorithm,
+        )
+
+    return [force_str(b64encode(signature)) for signature in signatures]
+
+
+def create_payment_requests_bulk(
+    bank_name, payments, pingback_url, batch_size=None, processes=None
+):
+    """Creates and signs payment requests for many payments at once
+
+    `payments` is an iterable of dicts with the keys `message`, `amount`, `currency`, `redirect_to`,
+    `redirect_on_failure` and optionally `extra_fields` (same meaning as the arguments of
+    `thorbanks.views.create_payment_request`).
+
+    The Transaction rows are created with a single `bulk_create` (per `batch_size`) and all requests are
+    signed with the bank's key loaded once. Pass `processes` to sign large batches in a process pool.
+
+    Returns a list of `SignedPaymentPayload` objects in the order of `payments`.
+
+    Note: On database backends which can't return primary keys from bulk inserts (e.g. SQLite before Django
+    4.0) the transactions are saved one by one.
+    """
+    klass = settings.get_model("Transaction")
+    context = settings.get_bank_context(bank_name)
+
+    transactions = [
+        build_transaction(
+            bank_name=bank_name,
+            message=payment["message"],
+            amount=payment["amount"],
+            currency=payment["currency"],
+            redirect_to=payment["redirect_to"],
+            redirect_on_failure=payment["redirect_on_failure"],
+            extra_fields=payment.get("extra_fields"),
+        )
+        for payment in payments
+    ]
+
+    using = router.db_for_write(klass)
+    features = connections[using].features
+    can_bulk_insert = getattr(
+        features,
+        "can_return_rows_from_bulk_insert",
+        getattr(features, "can_return_ids_from_bulk_insert", False),
+    )
+
+    with db_transaction.atomic(using=using):
+        if can_bulk_insert:
+            transactions = klass._default_manager.using(using).bulk_create(
+                transactions, batch_size=batch_size
+            )
+
+        else:
+            for transaction in transactions:
+                transaction.save(using=using, force_insert=True)
+
+    for transaction in transactions:
+        transaction_started.send(klass, transaction=transaction)
+
+    if context.send_ref:
+        references = calculate_731_checksums(x.pk for x in transactions)
+    else:
+        references = [""] * len(transactions)
+
+    payloads = []
+    for transaction, reference in zip(transactions, references):
+        fields = get_payment_request_fields(
+            context, transaction, pingback_url, reference=reference
+        )
+
+        # Use the same string representation the form fields would produce
+        fields = {
+            key: "" if value is None else str(value).strip()
+            for key, value in fields.items()
+        }
+        payloads.append(SignedPaymentPayload(transaction, fields, context.request_url))
+
+    signatures = sign_digests(
+        bank_name,
+        [request_digest(payload.fields, bank_name) for payload in payloads],
+        context.sign_hash_algorithm,
+        processes=processes,
+    )
+
+    for payload, signature in zip(payloads, signatures):
+        payload.fields["VK_MAC"] = signature
+
+    metrics = get_metrics()
+    if metrics.enabled:
+        metrics.increment("payment_requests_total", len(payloads), bank=bank_name)
+
+    return payloads
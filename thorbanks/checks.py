@@ -3,7 +3,8 @@ import os
 from django.conf import settings
 from django.core.checks import Error, register
 
-from thorbanks.settings import configure, parse_banklinks
+from thorbanks.raw_response import get_raw_response_storage, RAW_RESPONSE_STORAGE_MODES
+from thorbanks.settings import invalidate, parse_banklinks
 
 
 @register
@@ -53,6 +54,17 @@ def check_model_settings(app_configs, **kwargs):
                 )
             )
 
+    if get_raw_response_storage() not in RAW_RESPONSE_STORAGE_MODES:
+        issues.append(
+            Error(
+                "settings.THORBANKS_RAW_RESPONSE_STORAGE must be one of: {}".format(
+                    ", ".join(RAW_RESPONSE_STORAGE_MODES)
+                ),
+                hint="See docstring of thorbanks.raw_response.get_raw_response_storage.",
+                id="thorbanks.E013",
+            )
+        )
+
     return issues
 
 
@@ -141,6 +153,22 @@ def check_banklink_settings(app_configs, **kwargs):
                         )
                     )
 
+                field_orders = data.get("FIELD_ORDERS")
+                if field_orders is not None and (
+                    not isinstance(field_orders, dict)
+                    or not all(
+                        isinstance(x, (list, tuple)) for x in field_orders.values()
+                    )
+                ):
+                    issues.append(
+                        Error(
+                            "settings.BANKLINKS['{}']: FIELD_ORDERS must be a dict of VK_SERVICE codes to "
+                            "field name tuples".format(bank_name),
+                            hint="See thorbanks.utils.IPIZZA_REQUEST_ORDER.",
+                            id="thorbanks.E012",
+                        )
+                    )
+
             else:
                 issues.append(
                     Error(
@@ -161,6 +189,7 @@ def check_banklink_settings(app_configs, **kwargs):
             )
         )
 
-    configure()
+    # Parse the (possibly changed) configuration again on next access
+    invalidate()
 
     return issues
@@ -0,0 +1,141 @@
+import os
+from types import MappingProxyType
+
+from thorbanks.keys import key_registry
+from thorbanks.utils import (
+    get_field_order,
+    HASH_ALGORITHMS,
+    IPIZZA_REQUEST_ORDER,
+    is_allowed_service,
+)
+
+
+class BankContext(object):
+    """Immutable, precompiled view of a single bank's BANKLINKS entry.
+
+    Built by `thorbanks.settings.configure` so the signing and verification paths read plain attributes
+    instead of looking up the parsed settings dict field by field. Keys are served through
+    `thorbanks.keys.key_registry` so they are only parsed once (and reloaded when rotated on disk).
+    """
+
+    __slots__ = (
+        "bank_name",
+        "protocol",
+        "client_id",
+        "bank_id",
+        "version",
+        "request_url",
+        "send_ref",
+        "language",
+        "digest_counts_bytes",
+        "pending_ttl",
+        "private_key_path",
+        "public_key_path",
+        "sign_hash_algorithm",
+        "sign_hasher",
+        "verify_hash_algorithm",
+        "verify_hasher",
+        "field_orders",
+        "payment_fields",
+        "auth_fields",
+    )
+
+    def __init__(self, bank_name, data):
+        field_orders = dict(IPIZZA_REQUEST_ORDER)
+        for service, field_order in (data.get("FIELD_ORDERS") or {}).items():
+            field_orders[service] = tuple(field_order)
+
+        values = {
+            "bank_name": bank_name,
+            "protocol": data.get("PROTOCOL"),
+            "client_id": data.get("CLIENT_ID"),
+            "bank_id": data.get("BANK_ID"),
+            "version": data.get("VK_VERSION"),
+            "request_url": data.get("REQUEST_URL"),
+            "send_ref": data.get("SEND_REF", True),
+            "language": data.get("LANGUAGE", "EST"),
+            "digest_counts_bytes": data.get("DIGEST_COUNTS_BYTES", False),
+            "pending_ttl": data.get("PENDING_TTL"),
+            "private_key_path": data.get("PRIVATE_KEY"),
+            "public_key_path": data.get("PUBLIC_KEY"),
+            "sign_hash_algorithm": data.get("SIGN_HASH_ALGORITHM"),
+            "sign_hasher": HASH_ALGORITHMS.get(data.get("SIGN_HASH_ALGORITHM")),
+            "verify_hash_algorithm": data.get("VERIFY_HASH_ALGORITHM"),
+            "verify_hasher": HASH_ALGORITHMS.get(data.get("VERIFY_HASH_ALGORITHM")),
+            "field_orders": MappingProxyType(field_orders),
+            "payment_fields": MappingProxyType(
+                {
+                    "VK_SERVICE": "1012",
+                    "VK_VERSION": data.get("VK_VERSION"),
+                    "VK_SND_ID": data.get("CLIENT_ID"),
+                }
+            ),
+            "auth_fields": MappingProxyType(
+                {
+                    "VK_SERVICE": "4012",
+                    "VK_VERSION": data.get("VK_VERSION"),
+                    "VK_SND_ID": data.get("CLIENT_ID"),
+                    "VK_REC_ID": data.get("BANK_ID"),
+                }
+            ),
+        }
+
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("BankContext is immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("BankContext is immutable")
+
+    def __repr__(self):
+        return "<BankContext %s>" % self.bank_name
+
+    @property
+    def private_key(self):
+        return key_registry.get_private_key(self.bank_name, self.private_key_path)
+
+    @property
+    def public_key(self):
+        return key_registry.get_public_key(self.bank_name, self.public_key_path)
+
+    def get_field_order(self, service=None, auth=False, response=False):
+        return get_field_order(
+            service, auth=auth, response=response, field_orders=self.field_orders
+        )
+
+    def is_allowed_service(self, service, auth=False, response=False):
+        return is_allowed_service(
+            service, auth=auth, response=response, field_orders=self.field_orders
+        )
+
+    def preload_keys(self):
+        """Parse the bank's keys ahead of the first request, skipping missing or broken key files
+
+        Invalid key paths are reported by `thorbanks.checks.check_banklink_settings`.
+        """
+        for path, loader in (
+            (self.private_key_path, key_registry.get_private_key),
+            (self.public_key_path, key_registry.get_public_key),
+        ):
+            if path is not None and os.path.isfile(path):
+                try:
+                    loader(self.bank_name, path)
+                except ValueError:
+                    pass
+
+
+def build_bank_contexts(links, preload_keys=True):
+    contexts = {}
+
+    for bank_name, data in links.items():
+        if not isinstance(data, dict):
+            continue
+
+        contexts[bank_name] = BankContext(bank_name, data)
+
+        if preload_keys:
+            contexts[bank_name].preload_keys()
+
+    return MappingProxyType(contexts)
@@ -0,0 +1,128 @@
+from datetime import timedelta
+
+from django.conf import settings as django_settings
+from django.db import connections, router
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from thorbanks import settings
+from thorbanks.signals import auth_failed, transaction_failed
+
+
+# Pending rows older than this (in seconds) are expired unless the bank sets PENDING_TTL in BANKLINKS
+DEFAULT_PENDING_TTL = 24 * 60 * 60
+
+DEFAULT_CHUNK_SIZE = 500
+
+EXPIRY_SIGNALS = {
+    "Transaction": (transaction_failed, "transaction"),
+    "Authentication": (auth_failed, "auth"),
+}
+
+
+def get_pending_ttl(bank_name):
+    """Returns the number of seconds a row of the bank may stay pending
+
+    Configured with the PENDING_TTL key of the bank in settings.BANKLINKS, falls back to
+    settings.THORBANKS_PENDING_TTL (one day by default). Banks which are no longer configured use the latter.
+    """
+    context = settings.get_contexts().get(bank_name)
+    ttl = context.pending_ttl if context is not None else None
+    if ttl is None:
+        ttl = getattr(django_settings, "THORBANKS_PENDING_TTL", DEFAULT_PENDING_TTL)
+
+    return ttl
+
+
+def _expire_chunk(klass, using, queryset, chunk_size):
+    """Fails up to `chunk_size` rows of `queryset`, returns the rows failed by this call
+
+    Rows are locked with SKIP LOCKED where the backend supports it so several nodes can sweep at the same
+    time without waiting on each other. The UPDATE is conditional on the row still being pending, rows
+    which were resolved (or expired by another node) in the meantime are left alone.
+    """
+    stamp = timezone.now()
+
+    with db_transaction.atomic(using=using):
+        if connections[using].features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+
+        pks = list(queryset.order_by("pk").values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return None
+
+        updated = (
+            klass._default_manager.using(using)
+            .filter(pk__in=pks, status=klass.STATUS_PENDING)
+            .update(status=klass.STATUS_FAILED, last_modified=stamp)
+        )
+
+    expired = klass._default_manager.using(using).filter(pk__in=pks)
+    if updated != len(pks):
+        # Another node got to some of the rows first, only keep the ones failed by this UPDATE
+        expired = expired.filter(status=klass.STATUS_FAILED, last_modified=stamp)
+
+    return list(expired)
+
+
+def expire_pending(
+    model_name, bank_names=None, ttl=None, chunk_size=DEFAULT_CHUNK_SIZE, now=None
+):
+    """Marks pending rows of the model `model_name` ("Transaction" or "Authentication") as failed
+
+    A row is expired when it has been pending for longer than the TTL of its bank (see `get_pending_ttl`),
+    pass `ttl` (in seconds) to use the same TTL for all banks. Every bank with pending rows is swept unless
+    `bank_names` is given, including banks which are no longer configured. The rows are failed in chunked
+    bulk UPDATEs and `transaction_failed`/`auth_failed` is sent for every expired row (with `expired=True`)
+    after its chunk has been committed.
+
+    Safe to run concurrently on several nodes, every row is expired (and its signal sent) exactly once.
+
+    Returns the number of rows expired by this call.
+    """
+    klass = settings.get_model(model_name)
+    signal, argument = EXPIRY_SIGNALS[model_name]
+    using = router.db_for_write(klass)
+
+    if now is None:
+        now = timezone.now()
+
+    if bank_names is None:
+        # Includes banks which have been removed from settings.BANKLINKS but still have pending rows
+        bank_names = list(
+            klass._default_manager.using(using)
+            .filter(status=klass.STATUS_PENDING)
+            .order_by("bank_name")
+            .values_list("bank_name", flat=True)
+            .distinct()
+        )
+
+    count = 0
+    for bank_name in bank_names:
+        bank_ttl = get_pending_ttl(bank_name) if ttl is None else ttl
+
+        queryset = klass._default_manager.using(using).filter(
+            bank_name=bank_name,
+            status=klass.STATUS_PENDING,
+            created__lt=now - timedelta(seconds=bank_ttl),
+        )
+
+        while True:
+            expired = _expire_chunk(klass, using, queryset, chunk_size)
+            if expired is None:
+                break
+
+            for obj in expired:
+                signal.send(klass, expired=True, **{argument: obj})
+
+            count += len(expired)
+
+    return count
+
+
+def expire_pending_transactions(**kwargs):
+    return expire_pending("Transaction", **kwargs)
+
+
+def expire_pending_authentications(**kwargs):
+    return expire_pending("Authentication", **kwargs)
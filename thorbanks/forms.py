@@ -1,5 +1,9 @@
+from html import escape
+
 from django import forms
 from django.conf import settings as django_settings
+from django.core.exceptions import ValidationError
+from django.forms.utils import ErrorDict
 from django.forms.widgets import RadioSelect
 from django.http import HttpResponse
 from django.template.loader import render_to_string
@@ -8,36 +12,244 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
 from thorbanks import settings
-from thorbanks.settings import get_send_ref
+from thorbanks.metrics import get_metrics
+from thorbanks.nonces import get_nonce_backend
 from thorbanks.signals import transaction_started
+from thorbanks.tracing import get_tracer
 from thorbanks.utils import calculate_731_checksum, create_signature
 
 
-class AuthRequestBase(forms.Form):
+REDIRECT_FORM_ID = "banklink_redirect_url"
+
+
+def use_redirect_templates():
+    """Whether redirect pages are rendered via the thorbanks/*-request.html templates
+
+    Enable with settings.THORBANKS_REDIRECT_TEMPLATES = True if you have customized these templates.
+    """
+    return getattr(django_settings, "THORBANKS_REDIRECT_TEMPLATES", False)
+
+
+def render_redirect_form(request_url, payload, encoding="UTF-8", submit_value=None):
+    """Renders the form which POSTs `payload` ((name, value) pairs) to the bank
+
+    Without `submit_value` the form is submitted automatically, otherwise a submit button is rendered instead.
+    """
+    if submit_value is None:
+        start = '<form action="%s" method="POST" id="%s" accept-charset="%s">' % (
+            escape(request_url),
+            REDIRECT_FORM_ID,
+            escape(encoding),
+        )
+        end = (
+            '</form><script type="text/javascript">'
+            "document.forms['%s'].submit();</script>" % REDIRECT_FORM_ID
+        )
+    else:
+        start = '<form action="%s" method="POST">' % escape(request_url)
+        end = '<input type="submit" value="%s" /></form>' % escape(submit_value)
+
+    return mark_safe(
+        "\n".join(
+            [start]
+            + [
+                '<input type="hidden" name="%s" value="%s">'
+                % (
+                    escape(name),
+                    escape(value if type(value) is str else force_str(value)),
+                )
+                for name, value in payload
+            ]
+            + [end]
+        )
+    )
+
+
+def render_redirect_page(title, form_html):
+    return (
+        "<html><head><title>%s</title>"
+        '<meta http-equiv="Content-Type" value="text/html; charset=utf-8" />'
+        "</head><body>%s</body></html>" % (title, form_html)
+    )
+
+
+class PayloadSchema(object):
+    """Validates prepared VK_* payloads against the fields declared on a request form
+
+    Compiled once per form class. Plain CharFields (all VK_* fields) are checked inline with the same rules
+    Django applies (string conversion, stripping, required and max_length), any other field type falls
+    back to `Field.clean`. This lets the request forms skip the full form cleaning machinery.
+    """
+
+    def __init__(self, form_class):
+        self.fields = []
+
+        for name, field in form_class.base_fields.items():
+            if type(field) is forms.CharField:
+                self.fields.append(
+                    (name, None, field.required, field.max_length, field.strip)
+                )
+            else:
+                self.fields.append((name, field, field.required, None, False))
+
+    def clean(self, data):
+        """Returns the cleaned payload, raises ValidationError if it is invalid"""
+        cleaned_data = {}
+
+        for name, field, required, max_length, strip in self.fields:
+            value = data.get(name)
+
+            if field is not None:
+                cleaned_data[name] = field.clean(value)
+                continue
+
+            if value is None or value == "":
+                value = ""
+            else:
+                value = str(value)
+                if strip:
+                    value = value.strip()
+
+            if not value:
+                if required:
+                    raise ValidationError("%s is required" % name, code="required")
+
+            elif max_length is not None and len(value) > max_length:
+                raise ValidationError(
+                    "%s is longer than %d characters" % (name, max_length),
+                    code="max_length",
+                )
+
+            elif "\x00" in value:
+                raise ValidationError(
+                    "%s contains null characters" % name, code="null_characters"
+                )
+
+            cleaned_data[name] = value
+
+        return cleaned_data
+
+
+class RequestFormMixin(object):
+    """Validates the prepared payload once and attaches the signature without revalidating the form
+
+    The bound form is kept as a rendering facade, `is_valid()` keeps working without running form cleaning.
+    """
+
+    @classmethod
+    def get_payload_schema(cls):
+        schema = cls.__dict__.get("_payload_schema")
+        if schema is None:
+            schema = PayloadSchema(cls)
+            cls._payload_schema = schema
+
+        return schema
+
+    def validate_and_sign(self):
+        try:
+            self.cleaned_data = self.get_payload_schema().clean(self.data)
+        except ValidationError:
+            raise RuntimeError("invalid initial data")  # pragma no cover
+
+        self._errors = ErrorDict()
+
+        self.finalize()
+        self.cleaned_data["VK_MAC"] = self.data["VK_MAC"]
+
+
+def build_transaction(
+    bank_name,
+    message,
+    amount,
+    currency,
+    redirect_to,
+    redirect_on_failure,
+    extra_fields=None,
+):
+    """Returns a new (unsaved) Transaction object for a payment request"""
+    transaction = settings.get_model("Transaction")()
+    transaction.bank_name = bank_name
+    transaction.description = message
+    transaction.amount = round(amount, 2)
+    transaction.currency = currency
+    transaction.message = message
+
+    transaction.redirect_after_success = redirect_to
+    transaction.redirect_on_failure = redirect_on_failure
+
+    if extra_fields is not None:
+        for key, value in extra_fields.items():
+            setattr(transaction, key, value)
+
+    return transaction
+
+
+def get_payment_request_fields(
+    context, transaction, url, language=None, encoding="UTF-8", reference=None
+):
+    """Returns the unsigned VK_* fields of a 1012 payment request for a saved transaction
+
+    The reference number is calculated from the transaction id unless it is given via `reference`. The
+    language defaults to the LANGUAGE option of the bank (EST).
+    """
+    if language is None:
+        language = context.language
+
+    if reference is None:
+        reference = calculate_731_checksum(transaction.pk) if context.send_ref else ""
+
+    fields = dict(context.payment_fields)
+    fields.update(
+        {
+            "VK_ENCODING": encoding,
+            "VK_DATETIME": transaction.created.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "VK_RETURN": url,
+            "VK_CANCEL": url,
+            "VK_LANG": language,
+            "VK_STAMP": transaction.pk,
+            "VK_REF": reference,
+            "VK_AMOUNT": transaction.amount,
+            "VK_CURR": transaction.currency,
+            "VK_MSG": transaction.message,
+        }
+    )
+    return fields
+
+
+class AuthRequestBase(RequestFormMixin, forms.Form):
     def __init__(
         self, bank_name, redirect_to, response_url, *args, extra_fields=None, **kwargs
     ):
-        self.auth = settings.get_model("Authentication")()
-        self.auth.bank_name = bank_name
-        self.auth.redirect_after_success = redirect_to
-        self.auth.redirect_on_failure = redirect_to
+        tracer = get_tracer()
 
-        if extra_fields is not None:
-            for key, value in extra_fields.items():
-                setattr(self.auth, key, value)
+        with tracer.span("auth_request", bank=bank_name) as span:
+            self.auth = settings.get_model("Authentication")()
+            self.auth.bank_name = bank_name
+            self.auth.redirect_after_success = redirect_to
+            self.auth.redirect_on_failure = redirect_to
 
-        self.auth.save()
+            if extra_fields is not None:
+                for key, value in extra_fields.items():
+                    setattr(self.auth, key, value)
 
-        initial = self.prepare(bank_name, redirect_to, response_url, *args, **kwargs)
+            with tracer.span("auth_request.nonce", bank=bank_name):
+                self.nonce = get_nonce_backend().start(self.auth)
 
-        super(AuthRequestBase, self).__init__(initial, *args, **kwargs)
+            span.set_attribute("auth_id", self.auth.pk)
 
-        if not self.is_valid():
-            raise RuntimeError("invalid initial data")  # pragma no cover
+            with tracer.span("auth_request.prepare", bank=bank_name):
+                initial = self.prepare(
+                    bank_name, redirect_to, response_url, *args, **kwargs
+                )
 
-        self.finalize()
-        if not self.is_valid():
-            raise RuntimeError("signature is invalid")  # pragma no cover
+                super(AuthRequestBase, self).__init__(initial, *args, **kwargs)
+
+            with tracer.span("auth_request.sign", bank=bank_name):
+                self.validate_and_sign()
+
+        metrics = get_metrics()
+        if metrics.enabled:
+            metrics.increment("auth_requests_total", bank=bank_name)
 
     def prepare(self, bank_name, redirect_to, response_url, *args, **kwargs):
         raise NotImplementedError  # pragma no cover
@@ -45,24 +257,16 @@ class AuthRequestBase(forms.Form):
     def finalize(self):
         raise NotImplementedError  # pragma no cover
 
+    def get_payload(self):
+        """Returns the (name, value) pairs of the request in field order"""
+        return [(name, self.data.get(name, "")) for name in self.fields]
+
     def redirect_html(self):
         """Redirection html"""
-        html = (
-            '<form action="%s" method="POST" id="banklink_redirect_url" accept-charset="%s">'
-            % (self.get_request_url(), self.get_encoding())
+        return render_redirect_form(
+            self.get_request_url(), self.get_payload(), encoding=self.get_encoding()
         )
 
-        for field in self:
-            html += force_str(field) + "\n"
-
-        html += "</form>"
-        html += """<script type="text/javascript">
-                       document.forms['banklink_redirect_url'].submit();
-                   </script>
-                """
-
-        return mark_safe(html)
-
     def get_request_url(self):
         return settings.get_request_url(self.auth.bank_name)
 
@@ -70,7 +274,13 @@ class AuthRequestBase(forms.Form):
         return "UTF-8"
 
     def get_redirect_response_html(self):
-        return render_to_string("thorbanks/auth-request.html", {"form": self})
+        with get_tracer().span(
+            "auth_request.render", bank=self.auth.bank_name, auth_id=self.auth.pk
+        ):
+            if use_redirect_templates():
+                return render_to_string("thorbanks/auth-request.html", {"form": self})
+
+            return render_redirect_page("Authentication request", self.redirect_html())
 
     def get_redirect_response(self):
         return HttpResponse(self.get_redirect_response_html(), content_type="text/html")
@@ -91,18 +301,17 @@ class IPizzaAuthRequest(AuthRequestBase):
     VK_MAC = forms.CharField(widget=forms.HiddenInput(), required=False)
 
     def prepare(self, bank_name, redirect_to, response_url, *args, **kwargs):
-        initial = {
-            "VK_SERVICE": "4012",
-            "VK_VERSION": settings.get_version(bank_name),
-            "VK_SND_ID": settings.get_client_id(bank_name),
-            "VK_REC_ID": settings.get_bank_id(bank_name),
-            "VK_NONCE": self.auth.pk,
-            "VK_RETURN": response_url,
-            "VK_DATETIME": self.auth.created.strftime("%Y-%m-%dT%H:%M:%S%z"),
-            "VK_RID": "",
-            "VK_REPLY": "3013",
-            "VK_ENCODING": self.get_encoding(),
-        }
+        initial = dict(settings.get_bank_context(bank_name).auth_fields)
+        initial.update(
+            {
+                "VK_NONCE": self.nonce,
+                "VK_RETURN": response_url,
+                "VK_DATETIME": self.auth.created.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "VK_RID": "",
+                "VK_REPLY": "3013",
+                "VK_ENCODING": self.get_encoding(),
+            }
+        )
         return initial
 
     def finalize(self):
@@ -110,71 +319,72 @@ class IPizzaAuthRequest(AuthRequestBase):
         self.data["VK_MAC"] = mac
 
 
-class PaymentRequestBase(forms.Form):
+class PaymentRequestBase(RequestFormMixin, forms.Form):
     def __init__(self, *args, extra_fields=None, **kwargs):
-        if "existing_transaction" in kwargs:
-            self.transaction = kwargs.pop("existing_transaction")
-
-        else:
-            self.transaction = settings.get_model("Transaction")()
-            self.transaction.bank_name = kwargs["bank_name"]
-            self.transaction.description = kwargs["message"]
-            self.transaction.amount = round(kwargs["amount"], 2)
-            self.transaction.currency = kwargs["currency"]
-            self.transaction.message = kwargs["message"]
-
-            self.transaction.redirect_after_success = kwargs["redirect_to"]
-            self.transaction.redirect_on_failure = kwargs["redirect_on_failure"]
-
-            if extra_fields is not None:
-                for key, value in extra_fields.items():
-                    setattr(self.transaction, key, value)
+        tracer = get_tracer()
+
+        with tracer.span("payment_request") as span:
+            if "existing_transaction" in kwargs:
+                self.transaction = kwargs.pop("existing_transaction")
+
+            else:
+                with tracer.span("payment_request.save", bank=kwargs["bank_name"]):
+                    self.transaction = build_transaction(
+                        bank_name=kwargs["bank_name"],
+                        message=kwargs["message"],
+                        amount=kwargs["amount"],
+                        currency=kwargs["currency"],
+                        redirect_to=kwargs["redirect_to"],
+                        redirect_on_failure=kwargs["redirect_on_failure"],
+                        extra_fields=extra_fields,
+                    )
+                    self.transaction.save()
+
+                transaction_started.send(
+                    settings.get_model("Transaction"), transaction=self.transaction
+                )
 
-            self.transaction.save()
+            attributes = {
+                "bank": self.transaction.bank_name,
+                "transaction_id": self.transaction.pk,
+            }
+            for key, value in attributes.items():
+                span.set_attribute(key, value)
 
-            transaction_started.send(
-                settings.get_model("Transaction"), transaction=self.transaction
-            )
+            with tracer.span("payment_request.prepare", **attributes):
+                initial = self.prepare(self.transaction, kwargs["url"])
 
-        initial = self.prepare(self.transaction, kwargs["url"])
+                super(PaymentRequestBase, self).__init__(initial, *args)
 
-        super(PaymentRequestBase, self).__init__(initial, *args)
+            with tracer.span("payment_request.sign", **attributes):
+                self.validate_and_sign()
 
-        if not self.is_valid():
-            raise RuntimeError("invalid initial data")
+        metrics = get_metrics()
+        if metrics.enabled:
+            metrics.increment("payment_requests_total", bank=self.transaction.bank_name)
 
-        self.finalize()
-        if not self.is_valid():
-            raise RuntimeError("signature is invalid")
-
-    def prepare(self, transaction, url, language="EST"):
+    def prepare(self, transaction, url, language=None):
         raise NotImplementedError
 
     def finalize(self):
         raise NotImplementedError
 
+    def get_payload(self):
+        """Returns the (name, value) pairs of the request in field order"""
+        return [(name, self.data.get(name, "")) for name in self.fields]
+
     def redirect_html(self):
-        html = (
-            '<form action="%s" method="POST" id="banklink_redirect_url" accept-charset="%s">'
-            % (self.get_request_url(), self.get_encoding())
+        return render_redirect_form(
+            self.get_request_url(), self.get_payload(), encoding=self.get_encoding()
         )
-        for field in self:
-            html += force_str(field) + "\n"
-        html += "</form>"
-        html += """<script type="text/javascript">
-                    document.forms['banklink_redirect_url'].submit();
-                    </script>"""
-        return mark_safe(html)
 
     def submit_button(self, value="Make the payment"):
-        html = '<form action="%s" method="POST">' % (
-            settings.get_request_url(self.transaction.bank_name)
+        return render_redirect_form(
+            self.get_request_url(),
+            self.get_payload(),
+            encoding=self.get_encoding(),
+            submit_value=value,
         )
-        for field in self:
-            html += force_str(field) + "\n"
-        html += '<input type="submit" value="%s" />' % value
-        html += "</form>"
-        return mark_safe(html)
 
     def get_request_url(self):
         return settings.get_request_url(self.transaction.bank_name)
@@ -183,7 +393,17 @@ class PaymentRequestBase(forms.Form):
         return "UTF-8"
 
     def get_redirect_response_html(self):
-        return render_to_string("thorbanks/payment-request.html", {"form": self})
+        with get_tracer().span(
+            "payment_request.render",
+            bank=self.transaction.bank_name,
+            transaction_id=self.transaction.pk,
+        ):
+            if use_redirect_templates():
+                return render_to_string(
+                    "thorbanks/payment-request.html", {"form": self}
+                )
+
+            return render_redirect_page("Banklink request", self.redirect_html())
 
     def get_redirect_response(self):
         return HttpResponse(self.get_redirect_response_html(), content_type="text/html")
@@ -210,32 +430,26 @@ class PaymentRequest(PaymentRequestBase):
     VK_LANG = forms.CharField(widget=forms.HiddenInput())
     VK_ENCODING = forms.CharField(widget=forms.HiddenInput())
 
-    def prepare(self, transaction, url, language="EST"):
+    def prepare(self, transaction, url, language=None):
+        context = settings.get_bank_context(transaction.bank_name)
+
+        if language is None:
+            language = context.language
         assert language in ["EST", "ENG", "RUS"]
 
-        return {
-            "VK_SERVICE": "1012",
-            "VK_VERSION": settings.get_version(transaction.bank_name),
-            "VK_ENCODING": self.get_encoding(),
-            "VK_DATETIME": transaction.created.strftime("%Y-%m-%dT%H:%M:%S%z"),
-            "VK_RETURN": url,
-            "VK_CANCEL": url,
-            "VK_LANG": language,
-            "VK_SND_ID": settings.get_client_id(transaction.bank_name),
-            "VK_STAMP": transaction.pk,
-            "VK_REF": calculate_731_checksum(transaction.pk)
-            if get_send_ref(transaction.bank_name)
-            else "",
-            "VK_AMOUNT": transaction.amount,
-            "VK_CURR": transaction.currency,
-            "VK_MSG": transaction.message,
-        }
+        return get_payment_request_fields(
+            context,
+            transaction,
+            url,
+            language=language,
+            encoding=self.get_encoding(),
+        )
 
     def finalize(self):
         self.data["VK_MAC"] = create_signature(
             self.cleaned_data,
             self.transaction.bank_name,
-            settings.get_sign_hash_algorithm(self.transaction.bank_name),
+            settings.get_bank_context(self.transaction.bank_name).sign_hash_algorithm,
         )
 
 
@@ -0,0 +1,102 @@
+import os
+import threading
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+
+KEY_TYPE_PRIVATE = "private"
+KEY_TYPE_PUBLIC = "public"
+
+
+def load_private_key(data):
+    return serialization.load_pem_private_key(
+        data, password=None, backend=default_backend()
+    )
+
+
+def load_public_key(data):
+    return serialization.load_pem_public_key(data, default_backend())
+
+
+_LOADERS = {
+    KEY_TYPE_PRIVATE: load_private_key,
+    KEY_TYPE_PUBLIC: load_public_key,
+}
+
+
+class KeyRegistry(object):
+    """Process-wide cache of parsed PEM keys.
+
+    Keys are cached by (bank name, key type, file path). Every lookup stats the key file and the key is
+    re-parsed when the file's inode, size or modification time changes, so rotating a key on disk does
+    not require a restart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Counters have their own lock so cache hits don't wait for a key being parsed
+        self._stats_lock = threading.Lock()
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @staticmethod
+    def _file_signature(path):
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, bank_name, key_type, path):
+        cache_key = (bank_name, key_type, path)
+        file_signature = self._file_signature(path)
+
+        cached = self._keys.get(cache_key)
+        if cached is not None and cached[0] == file_signature:
+            self._count("hits")
+            return cached[1]
+
+        with self._lock:
+            # Another thread might have loaded the key while we were waiting for the lock
+            cached = self._keys.get(cache_key)
+            if cached is not None and cached[0] == file_signature:
+                self._count("hits")
+                return cached[1]
+
+            with open(path, "rb") as handle:
+                key = _LOADERS[key_type](handle.read())
+
+            self._count("misses" if cached is None else "reloads")
+
+            self._keys[cache_key] = (file_signature, key)
+
+        return key
+
+    def get_private_key(self, bank_name, path):
+        return self.get(bank_name, KEY_TYPE_PRIVATE, path)
+
+    def get_public_key(self, bank_name, path):
+        return self.get(bank_name, KEY_TYPE_PUBLIC, path)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "size": len(self._keys),
+            }
+
+    def clear(self):
+        with self._lock, self._stats_lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+            self.reloads = 0
+
+
+key_registry = KeyRegistry()
@@ -1,5 +1,9 @@
+import threading
+
 from django.apps import apps
+from django.conf import settings as django_settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from django.utils.module_loading import import_string as base_import_string
 
 
@@ -25,3 +29,49 @@ def validate_import_string(dotted_path):
 
 def import_string(dotted_path):
     return base_import_string(dotted_path)
+
+
+class SettingLoader(object):
+    """Process wide object built on first use from settings.<setting>, dropped again when the setting changes
+
+    By default the setting is a {"BACKEND": dotted path, "OPTIONS": kwargs} dict and `default` is the backend
+    used when it's not set. Pass `factory(config)` to build the object from the setting's value differently.
+    `close(obj)` is called with the dropped object.
+    """
+
+    def __init__(self, setting, default=None, factory=None, close=None):
+        self.setting = setting
+        self.default = default
+        self.factory = factory or self.load_backend
+        self.close = close
+
+        self._lock = threading.Lock()
+        self._value = None
+
+        setting_changed.connect(self.on_setting_changed, weak=False)
+
+    def load_backend(self, config):
+        config = config or {}
+        backend = import_string(config.get("BACKEND", self.default))
+        return backend(**config.get("OPTIONS", {}))
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self.factory(
+                        getattr(django_settings, self.setting, None)
+                    )
+
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            value, self._value = self._value, None
+
+        if value is not None and self.close is not None:
+            self.close(value)
+
+    def on_setting_changed(self, setting, **kwargs):
+        if setting == self.setting:
+            self.reset()
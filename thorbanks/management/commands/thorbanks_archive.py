@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from thorbanks.archive import archive_transactions, DEFAULT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Moves old completed and failed transactions to the archive model"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Archive rows not modified in this many days (default: THORBANKS_ARCHIVE_AFTER_DAYS)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Number of rows moved per database transaction",
+        )
+        parser.add_argument(
+            "--include-referenced",
+            action="store_true",
+            help="Also archive transactions other models still point to, applying their on_delete",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            count = archive_transactions(
+                days=options["days"],
+                chunk_size=options["chunk_size"],
+                include_referenced=options["include_referenced"],
+            )
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("Archived %d transactions" % count)
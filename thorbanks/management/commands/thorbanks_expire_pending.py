@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from thorbanks import settings
+from thorbanks.expiry import DEFAULT_CHUNK_SIZE, expire_pending
+
+
+class Command(BaseCommand):
+    help = "Marks pending transactions and authentications older than the TTL of their bank as failed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bank",
+            action="append",
+            dest="banks",
+            help="Only expire rows of this bank (can be used multiple times)",
+        )
+        parser.add_argument(
+            "--ttl",
+            type=int,
+            help="Expire rows pending for longer than this many seconds (overrides PENDING_TTL)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Number of rows updated per query",
+        )
+        parser.add_argument(
+            "--model",
+            action="append",
+            dest="models",
+            choices=["Transaction", "Authentication"],
+            help="Only expire rows of this model (default: both)",
+        )
+
+    def handle(self, *args, **options):
+        for model_name in options["models"] or ["Transaction", "Authentication"]:
+            try:
+                settings.get_model(model_name)
+            except LookupError:
+                # Manual models setups don't have to define both models
+                continue
+
+            count = expire_pending(
+                model_name,
+                bank_names=options["banks"],
+                ttl=options["ttl"],
+                chunk_size=options["chunk_size"],
+            )
+            self.stdout.write("Expired %d pending %s rows" % (count, model_name))
@@ -0,0 +1,202 @@
+import bisect
+import threading
+
+from django.http import Http404, HttpResponse
+
+from thorbanks.loading import SettingLoader
+
+
+DEFAULT_METRICS_BACKEND = "thorbanks.metrics.NullMetrics"
+
+# Latency buckets in seconds, RSA signing with a 2048 bit key takes about a millisecond
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# name: (type, help) of the metrics recorded by thorbanks
+METRICS = {
+    "payment_requests_total": ("counter", "Payment requests created"),
+    "auth_requests_total": ("counter", "Authentication requests created"),
+    "signatures_total": ("counter", "Requests signed"),
+    "sign_seconds": ("histogram", "Time spent signing a request"),
+    "verifications_total": ("counter", "Bank responses verified"),
+    "verify_seconds": ("histogram", "Time spent verifying a bank response"),
+    "signature_failures_total": ("counter", "Bank responses with an invalid signature"),
+    "callbacks_total": ("counter", "Verified bank callbacks by VK_SERVICE"),
+    "duplicate_callbacks_total": (
+        "counter",
+        "Callbacks of already finished transactions and authentications",
+    ),
+}
+
+
+class NullMetrics(object):
+    """Default metrics backend, records nothing
+
+    Instrumented code checks `enabled` before timing anything, so disabled metrics cost one attribute lookup.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class LocalMetrics(NullMetrics):
+    """Keeps counters and histograms in the memory of the current process
+
+    Use `render` (or `metrics_view`) to expose them in the Prometheus text format:
+
+        THORBANKS_METRICS = {
+            "BACKEND": "thorbanks.metrics.LocalMetrics",
+            "OPTIONS": {"buckets": (0.001, 0.01, 0.1, 1.0)},
+        }
+
+    Values are per process, with several workers scrape every worker or use a backend which forwards the
+    values to a shared collector (any class implementing `increment` and `observe`).
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="thorbanks_"):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def get_value(self, name, **labels):
+        """Returns the value of a counter or the number of observations of a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][2]
+
+            return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+
+        return "{%s}" % ",".join(
+            '%s="%s"'
+            % (
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for key, value in labels
+        )
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(buckets), total, count)
+                for key, (buckets, total, count) in self._histograms.items()
+            }
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            full_name = self.prefix + name
+            lines.append("# HELP %s %s" % (full_name, help_text))
+            lines.append("# TYPE %s %s" % (full_name, metric_type))
+
+            if metric_type == "counter":
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(
+                            "%s%s %s" % (full_name, self._format_labels(labels), value)
+                        )
+                continue
+
+            for (key_name, labels), (buckets, total, count) in sorted(
+                histograms.items()
+            ):
+                if key_name != name:
+                    continue
+
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    cumulative += bucket_count
+                    lines.append(
+                        "%s_bucket%s %d"
+                        % (
+                            full_name,
+                            self._format_labels(labels + (("le", repr(bound)),)),
+                            cumulative,
+                        )
+                    )
+
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (
+                        full_name,
+                        self._format_labels(labels + (("le", "+Inf"),)),
+                        count,
+                    )
+                )
+                lines.append(
+                    "%s_sum%s %r" % (full_name, self._format_labels(labels), total)
+                )
+                lines.append(
+                    "%s_count%s %d" % (full_name, self._format_labels(labels), count)
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = SettingLoader("THORBANKS_METRICS", DEFAULT_METRICS_BACKEND)
+
+
+def get_metrics():
+    """Returns the metrics backend configured by settings.THORBANKS_METRICS"""
+    return _metrics.get()
+
+
+def reset_metrics():
+    _metrics.reset()
+
+
+def metrics_view(request):
+    """Exposes the metrics of a backend with a `render` method (e.g. `LocalMetrics`) for Prometheus to scrape
+
+    Not included in thorbanks.urls, add it to your own urls behind whatever access control you need.
+    """
+    render = getattr(get_metrics(), "render", None)
+    if render is None:
+        raise Http404("Metrics are not enabled")
+
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4")
@@ -0,0 +1,170 @@
+import secrets
+
+from django.core.cache import caches
+from django.http import Http404
+from django.utils import timezone
+
+from asgiref.sync import sync_to_async
+
+from thorbanks.loading import SettingLoader
+
+
+DEFAULT_NONCE_BACKEND = "thorbanks.nonces.DatabaseNonceBackend"
+
+
+class DatabaseNonceBackend(object):
+    """Default nonce backend, saves the Authentication row when the request is created and uses its pk as VK_NONCE"""
+
+    def start(self, auth):
+        """Registers a new authentication attempt, returns the VK_NONCE to send to the bank"""
+        auth.save()
+        return str(auth.pk)
+
+    def get_auth(self, klass, nonce):
+        """Returns the authentication of `nonce` or None if it is unknown"""
+        try:
+            return klass._default_manager.get(pk=nonce)
+        except klass.DoesNotExist:
+            return None
+
+    def transition(self, auth, nonce, status, **fields):
+        """Moves the authentication of `nonce` to `status`, returns True if this call made the transition"""
+        return auth.transition_status(status, **fields)
+
+    async def aget_auth(self, klass, nonce):
+        manager = klass._default_manager
+
+        # Django 4.1+ has a native async ORM
+        get = manager.aget if hasattr(manager, "aget") else sync_to_async(manager.get)
+
+        try:
+            return await get(pk=nonce)
+        except klass.DoesNotExist:
+            return None
+
+    async def atransition(self, auth, nonce, status, **fields):
+        return await auth.atransition_status(status, **fields)
+
+
+class CacheNonceBackend(DatabaseNonceBackend):
+    """Keeps pending authentication attempts in Django's cache instead of the database
+
+    The Authentication row is only inserted once the bank returns a valid successful (3013) response, so
+    abandoned logins and bots don't create rows. Failed responses send `auth_failed` with an unsaved
+    Authentication. Attempts expire after `timeout` seconds.
+
+    Example settings:
+
+        THORBANKS_NONCE_BACKEND = {
+            "BACKEND": "thorbanks.nonces.CacheNonceBackend",
+            "OPTIONS": {"alias": "default", "timeout": 900},
+        }
+
+    Note: The cache must be shared by all workers (e.g. not the local-memory cache with several processes).
+    """
+
+    key_prefix = "thorbanks:nonce:"
+
+    def __init__(self, alias="default", timeout=900):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def get_state(auth):
+        return {
+            field.attname: getattr(auth, field.attname)
+            for field in auth._meta.concrete_fields
+            if not field.primary_key
+        }
+
+    def start(self, auth):
+        auth.created = auth.last_modified = timezone.now()
+
+        # Fits VK_NONCE (max 50 characters)
+        nonce = secrets.token_urlsafe(24)
+        self.cache.set(self.key_prefix + nonce, self.get_state(auth), self.timeout)
+
+        return nonce
+
+    def get_auth(self, klass, nonce):
+        state = self.cache.get(self.key_prefix + nonce)
+        if state is None:
+            return None
+
+        if "pk" in state:
+            # Already completed by an earlier response
+            return super(CacheNonceBackend, self).get_auth(klass, state["pk"])
+
+        return klass(**state)
+
+    def transition(self, auth, nonce, status, **fields):
+        if auth.pk is not None:
+            return super(CacheNonceBackend, self).transition(
+                auth, nonce, status, **fields
+            )
+
+        # Only one of concurrent responses for the same nonce may act on it
+        if not self.cache.add(self.key_prefix + nonce + ":claimed", True, self.timeout):
+            return False
+
+        auth.status = status
+        for key, value in fields.items():
+            setattr(auth, key, value)
+
+        if status == auth.STATUS_COMPLETED:
+            created = auth.created
+            auth.save()
+
+            # auto_now_add replaced the time the request was signed with (VK_DATETIME), restore it
+            type(auth)._default_manager.filter(pk=auth.pk).update(created=created)
+            auth.created = created
+
+            state = {"pk": auth.pk}
+        else:
+            # Failed attempts are not saved, remember the outcome for repeated responses
+            state = self.get_state(auth)
+
+        self.cache.set(self.key_prefix + nonce, state, self.timeout)
+
+        return True
+
+    async def aget_auth(self, klass, nonce):
+        return await sync_to_async(self.get_auth)(klass, nonce)
+
+    async def atransition(self, auth, nonce, status, **fields):
+        return await sync_to_async(self.transition)(auth, nonce, status, **fields)
+
+
+_nonce_backend = SettingLoader("THORBANKS_NONCE_BACKEND", DEFAULT_NONCE_BACKEND)
+
+
+def get_nonce_backend():
+    """Returns the nonce backend configured by settings.THORBANKS_NONCE_BACKEND"""
+    return _nonce_backend.get()
+
+
+def reset_nonce_backend():
+    _nonce_backend.reset()
+
+
+def get_auth_or_404(klass, nonce):
+    auth = None if nonce is None else get_nonce_backend().get_auth(klass, nonce)
+    if auth is None:
+        raise Http404("No %s matches the given query." % klass._meta.object_name)
+
+    return auth
+
+
+async def aget_auth_or_404(klass, nonce):
+    auth = None
+    if nonce is not None:
+        auth = await get_nonce_backend().aget_auth(klass, nonce)
+
+    if auth is None:
+        raise Http404("No %s matches the given query." % klass._meta.object_name)
+
+    return auth
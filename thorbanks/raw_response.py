@@ -0,0 +1,58 @@
+import ast
+import json
+
+from django.conf import settings as django_settings
+
+
+RAW_RESPONSE_STORAGE_MODES = ("json", "compact", "repr")
+
+# Fields which are left out of compactly stored auth responses, they can be restored from the model's columns
+COMPACT_RAW_RESPONSE_EXCLUDE = ("VK_NONCE", "VK_USER_ID", "VK_USER_NAME")
+
+
+def get_raw_response_storage():
+    """How Authentication.raw_response is stored, configured with settings.THORBANKS_RAW_RESPONSE_STORAGE
+
+    - json: (default) the response as a JSON object
+    - compact: a JSON object without the VK_ prefixes and the fields in COMPACT_RAW_RESPONSE_EXCLUDE
+    - repr: the Python repr of the response dict (format used by older versions)
+    """
+    return getattr(django_settings, "THORBANKS_RAW_RESPONSE_STORAGE", "json")
+
+
+def encode_raw_response(data, mode=None, exclude=COMPACT_RAW_RESPONSE_EXCLUDE):
+    """Returns `data` serialized with the storage `mode`, `exclude` lists the fields the compact mode drops"""
+    if mode is None:
+        mode = get_raw_response_storage()
+
+    if mode == "repr":
+        return str(dict(data))
+
+    if mode == "compact":
+        data = {
+            key[3:] if key.startswith("VK_") else key: value
+            for key, value in data.items()
+            if key not in exclude
+        }
+
+    elif mode != "json":
+        raise ValueError("Invalid raw response storage mode %s" % mode)
+
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_raw_response(value):
+    """Returns the response dict stored with any of the RAW_RESPONSE_STORAGE_MODES
+
+    The fields dropped by the compact mode are not restored, use `AbstractAuthentication.get_raw_response` for that.
+    """
+    if not value:
+        return {}
+
+    try:
+        data = json.loads(value)
+    except ValueError:
+        # Stored by an older version
+        return ast.literal_eval(value)
+
+    return {key if key.startswith("VK_") else "VK_" + key: x for key, x in data.items()}
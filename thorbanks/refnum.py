@@ -0,0 +1,81 @@
+import sys
+
+
+# Estonian reference numbers end with a 7-3-1 check digit: the digits of the base number are multiplied with
+# the weights 7, 3, 1, 7, 3, 1, ... starting from the rightmost one and the check digit completes the sum to the
+# next multiple of ten.
+WEIGHTS = (7, 3, 1)
+
+# _PRODUCTS[i][d] is the weighted value of digit `d` at position `i` (mod 3) counting from the right
+_PRODUCTS = tuple(tuple(weight * digit for digit in range(10)) for weight in WEIGHTS)
+
+# Maps the characters "0"-"9" to ints without calling int() for every digit
+_DIGITS = {str(digit): digit for digit in range(10)}
+
+# Reference numbers are 2 to 20 digits long (base number and the check digit)
+MIN_LENGTH = 2
+MAX_LENGTH = 20
+
+
+def _check_digit(digits):
+    total = 0
+    position = 0
+
+    for char in reversed(digits):
+        total += _PRODUCTS[position][_DIGITS[char]]
+        position = 0 if position == 2 else position + 1
+
+    return (10 - total % 10) % 10
+
+
+def calculate_check_digit(number):
+    """Returns the 7-3-1 check digit of the base number `number`"""
+    return _check_digit(str(int(number)))
+
+
+def calculate_731_checksum(number):
+    """Returns `number` with its 7-3-1 check digit appended"""
+    number = int(number)
+    return number * 10 + _check_digit(str(number))
+
+
+def calculate_731_checksums(numbers):
+    """Batched `calculate_731_checksum`
+
+    NumPy integer arrays are processed with vectorized operations and returned as an array (base numbers must
+    stay below 2**63 / 10), any other iterable is returned as a list. NumPy is optional and never imported here.
+    """
+    numpy = sys.modules.get("numpy")
+
+    if numpy is not None and isinstance(numbers, numpy.ndarray):
+        numbers = numbers.astype(numpy.int64)
+        remaining = numbers.copy()
+        total = numpy.zeros_like(numbers)
+
+        position = 0
+        while remaining.any():
+            total += (remaining % 10) * WEIGHTS[position]
+            remaining //= 10
+            position = 0 if position == 2 else position + 1
+
+        return numbers * 10 + (10 - total % 10) % 10
+
+    return [calculate_731_checksum(number) for number in numbers]
+
+
+def is_valid_reference(value):
+    """Checks the length, characters and check digit of the reference number `value`"""
+    value = str(value)
+
+    if not MIN_LENGTH <= len(value) <= MAX_LENGTH:
+        return False
+
+    if not value.isascii() or not value.isdecimal():
+        return False
+
+    return _check_digit(value[:-1]) == _DIGITS[value[-1]]
+
+
+def validate_references(values):
+    """Returns the values of `values` which are not valid reference numbers"""
+    return [value for value in values if not is_valid_reference(value)]
@@ -0,0 +1,186 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings as django_settings
+from django.core.cache import caches
+
+from asgiref.sync import sync_to_async
+
+from thorbanks.loading import SettingLoader
+
+
+class CallbackOutcome(object):
+    """What a verified callback of a final transaction resolved to, enough to answer a duplicate of it"""
+
+    __slots__ = ("redirect_after_success", "redirect_on_failure", "bank_name")
+
+    def __init__(self, redirect_after_success, redirect_on_failure, bank_name=None):
+        self.redirect_after_success = redirect_after_success
+        self.redirect_on_failure = redirect_on_failure
+        self.bank_name = bank_name
+
+    @classmethod
+    def from_transaction(cls, transaction):
+        return cls(
+            transaction.redirect_after_success,
+            transaction.redirect_on_failure,
+            transaction.bank_name,
+        )
+
+    def to_value(self):
+        """Returns the value stored in the shared cache, `CallbackOutcome(*value)` restores the outcome"""
+        return (self.redirect_after_success, self.redirect_on_failure, self.bank_name)
+
+
+class ReplayCache(object):
+    """Remembers the outcome of verified bank callbacks so duplicates skip the database and RSA verification
+
+    Banks retry automatic pingbacks and users refresh the return page, every such duplicate carries the same
+    VK_STAMP and VK_MAC. Outcomes are only stored once the transaction is final, so a cached outcome never
+    changes. Lookups go through a small per-process LRU (with its own, shorter TTL) before hitting the
+    Django cache `alias`.
+
+    Enable it with:
+
+        THORBANKS_REPLAY_CACHE = {
+            "ALIAS": "default",  # Django cache shared by all workers
+            "TIMEOUT": 600,  # seconds
+            "LOCAL_SIZE": 1024,  # entries kept in the per-process tier
+            "LOCAL_TIMEOUT": 60,  # seconds
+        }
+    """
+
+    key_prefix = "thorbanks:replay:"
+
+    def __init__(self, alias="default", timeout=600, local_size=1024, local_timeout=60):
+        self.alias = alias
+        self.timeout = timeout
+        self.local_size = local_size
+        self.local_timeout = min(local_timeout, timeout)
+
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, data):
+        """Cache key of a callback, identified by the bank, VK_STAMP and a digest of the signature"""
+        identity = "\0".join(
+            data.get(key, "")
+            for key in ("VK_SND_ID", "VK_STAMP", "VK_SERVICE", "VK_MAC")
+        )
+        return self.key_prefix + hashlib.sha256(identity.encode("UTF-8")).hexdigest()
+
+    def _get_local(self, key):
+        with self._lock:
+            cached = self._local.get(key)
+            if cached is None:
+                return None
+
+            if cached[0] < time.monotonic():
+                del self._local[key]
+                return None
+
+            self._local.move_to_end(key)
+            self.local_hits += 1
+            return cached[1]
+
+    def _set_local(self, key, outcome):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_timeout, outcome)
+            self._local.move_to_end(key)
+
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def _from_shared(self, key, value):
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.shared_hits += 1
+
+        outcome = CallbackOutcome(*value)
+        self._set_local(key, outcome)
+        return outcome
+
+    def get(self, key):
+        outcome = self._get_local(key)
+        if outcome is not None:
+            return outcome
+
+        return self._from_shared(key, self.cache.get(key))
+
+    async def aget(self, key):
+        outcome = self._get_local(key)
+        if outcome is not None:
+            return outcome
+
+        return self._from_shared(key, await sync_to_async(self.cache.get)(key))
+
+    def set(self, key, outcome):
+        self._set_local(key, outcome)
+        self.cache.set(
+            key,
+            outcome.to_value(),
+            self.timeout,
+        )
+
+    async def aset(self, key, outcome):
+        self._set_local(key, outcome)
+        await sync_to_async(self.cache.set)(
+            key,
+            outcome.to_value(),
+            self.timeout,
+        )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+
+            return {
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.local_hits + self.shared_hits) / lookups if lookups else 0.0
+                ),
+                "local_size": len(self._local),
+            }
+
+    def clear(self):
+        """Clears the per-process tier and the counters, entries in the Django cache expire on their own"""
+        with self._lock:
+            self._local.clear()
+            self.local_hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+
+
+_replay_cache = SettingLoader(
+    "THORBANKS_REPLAY_CACHE",
+    factory=lambda config: ReplayCache(
+        **{key.lower(): value for key, value in config.items()}
+    ),
+)
+
+
+def get_replay_cache():
+    """Returns the replay cache configured by settings.THORBANKS_REPLAY_CACHE or None when it's disabled"""
+    if not getattr(django_settings, "THORBANKS_REPLAY_CACHE", None):
+        return None
+
+    return _replay_cache.get()
+
+
+def reset_replay_cache():
+    _replay_cache.reset()
@@ -1,7 +1,13 @@
+import contextvars
 import os
+import threading
+from contextlib import contextmanager
+from types import MappingProxyType
 
 from django.apps import apps
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
 def parse_banklinks(config=None):
@@ -68,6 +74,8 @@ def get_model(model_name):
         THORBANKS_MANUAL_MODELS = {
             "Authentication": "myapp.Authentication",
             "Transaction": "myapp.Transaction",
+            # Optional, see thorbanks.archive
+            "TransactionArchive": "myapp.TransactionArchive",
         }
 
     Example myapp/models.py:
@@ -87,7 +95,7 @@ def get_model(model_name):
 
 # Shorthand methods
 def get_private_key(the_bank):
-    return get_links()[the_bank]["PRIVATE_KEY"]
+    return get_bank_option(the_bank, "PRIVATE_KEY")
 
 
 def get_public_key(the_bank):
@@ -97,43 +105,43 @@ def get_public_key(the_bank):
 
         $ openssl x509 -pubkey -noout -in cert.pem  > pubkey.pem
     """
-    return get_links()[the_bank]["PUBLIC_KEY"]
+    return get_bank_option(the_bank, "PUBLIC_KEY")
 
 
 def get_client_id(the_bank):
-    return get_links()[the_bank]["CLIENT_ID"]
+    return get_bank_option(the_bank, "CLIENT_ID")
 
 
 def get_bank_id(the_bank):
-    return get_links()[the_bank]["BANK_ID"]
+    return get_bank_option(the_bank, "BANK_ID")
 
 
 def get_version(the_bank):
-    return get_links()[the_bank]["VK_VERSION"]
+    return get_bank_option(the_bank, "VK_VERSION")
 
 
 def get_request_url(the_bank):
-    return get_links()[the_bank]["REQUEST_URL"]
+    return get_bank_option(the_bank, "REQUEST_URL")
 
 
 def get_link_type(the_bank):
-    return get_links()[the_bank]["TYPE"]
+    return get_bank_option(the_bank, "TYPE")
 
 
 def get_link_protocol(the_bank):
-    return get_links()[the_bank]["PROTOCOL"]
+    return get_bank_option(the_bank, "PROTOCOL")
 
 
 def get_send_ref(the_bank):
-    return get_links()[the_bank]["SEND_REF"]
+    return get_bank_option(the_bank, "SEND_REF")
 
 
 def get_sign_hash_algorithm(the_bank):
-    return get_links()[the_bank]["SIGN_HASH_ALGORITHM"]
+    return get_bank_option(the_bank, "SIGN_HASH_ALGORITHM")
 
 
 def get_verify_hash_algorithm(the_bank):
-    return get_links()[the_bank]["VERIFY_HASH_ALGORITHM"]
+    return get_bank_option(the_bank, "VERIFY_HASH_ALGORITHM")
 
 
 def get_bank_choices():
@@ -154,24 +162,153 @@ def get_bank_choices():
     ]
 
 
-# Updated by configure method below. Do not use directly and access this value trough get_links method
-_LINKS = None
+def get_bank_context(the_bank):
+    """Returns the precompiled `thorbanks.context.BankContext` of the bank
+
+    Options overridden with `override_bank_options` in the current context are taken into account.
+    """
+    snapshot = get_snapshot()
+
+    overrides = _OVERRIDES.get().get(the_bank)
+    if not overrides:
+        return snapshot.contexts[the_bank]
+
+    try:
+        cache_key = (snapshot.version, the_bank, tuple(sorted(overrides.items())))
+        context = _OVERRIDE_CONTEXTS.get(cache_key)
+    except TypeError:
+        # Unhashable option values, build the context every time
+        cache_key = context = None
+
+    if context is None:
+        from thorbanks.context import BankContext
+
+        data = dict(snapshot.links[the_bank])
+        data.update(overrides)
+        context = BankContext(the_bank, data)
+
+        if cache_key is not None:
+            if len(_OVERRIDE_CONTEXTS) >= MAX_OVERRIDE_CONTEXTS:
+                _OVERRIDE_CONTEXTS.clear()
+
+            _OVERRIDE_CONTEXTS[cache_key] = context
+
+    return context
+
+
+def get_bank_option(the_bank, key):
+    """Returns the BANKLINKS option `key` of the bank, including overrides of the current context"""
+    overrides = _OVERRIDES.get().get(the_bank)
+    if overrides and key in overrides:
+        return overrides[key]
+
+    return get_links()[the_bank][key]
+
+
+# Per context (thread or asyncio task) overrides of bank options, {bank_name: {option: value}}
+_OVERRIDES = contextvars.ContextVar(
+    "thorbanks_bank_overrides", default=MappingProxyType({})
+)
+
+# Bank contexts built for overridden options, keyed by (snapshot version, bank name, options)
+_OVERRIDE_CONTEXTS = {}
+MAX_OVERRIDE_CONTEXTS = 256
+
+
+@contextmanager
+def override_bank_options(the_bank, **options):
+    """Overrides BANKLINKS options of a bank for the current thread or asyncio task only
+
+    Use this for per-request options instead of changing the global configuration:
+
+        with override_bank_options("swedbank", SEND_REF=False, LANGUAGE="ENG"):
+            payment = create_payment_request(...)
+
+    Overrides are applied on top of the shared configuration snapshot, so they don't re-read the settings
+    and concurrent requests never see each other's values.
+    """
+    overrides = dict(_OVERRIDES.get())
+    overrides[the_bank] = MappingProxyType(dict(overrides.get(the_bank, {}), **options))
+
+    token = _OVERRIDES.set(MappingProxyType(overrides))
+    try:
+        yield
+    finally:
+        _OVERRIDES.reset(token)
+
+
+class ConfigSnapshot(object):
+    """Parsed settings.BANKLINKS and the matching bank contexts
+
+    Built once and shared by all threads until the settings change (see `invalidate`). Every rebuild gets a
+    new `version`, which can be used to invalidate values derived from the configuration.
+    """
+
+    __slots__ = ("version", "links", "contexts")
+
+    def __init__(self, version, links, contexts):
+        self.version = version
+        self.links = links
+        self.contexts = contexts
+
+    def __repr__(self):
+        return "<ConfigSnapshot %d>" % self.version
+
+
+# Updated by configure method below. Do not use directly and access these values trough get_snapshot/get_links
+_SNAPSHOT = None
+_SNAPSHOT_VERSION = 0
+_SNAPSHOT_LOCK = threading.RLock()
+
+
+def get_snapshot():
+    snapshot = _SNAPSHOT
+
+    if snapshot is None:
+        with _SNAPSHOT_LOCK:
+            if _SNAPSHOT is None:
+                configure()
+
+            snapshot = _SNAPSHOT
+
+    return snapshot
 
 
 def get_links():
-    global _LINKS
+    return get_snapshot().links
+
+
+def get_contexts():
+    return get_snapshot().contexts
+
 
-    if _LINKS is None:
-        configure()
+def invalidate():
+    """Drops the current snapshot, the configuration is parsed again on next access"""
+    global _SNAPSHOT
 
-    return _LINKS
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT = None
+
+
+@receiver(setting_changed)
+def invalidate_on_setting_changed(setting, **kwargs):
+    if setting == "BANKLINKS":
+        invalidate()
 
 
 def configure(__only_use_during_tests=None):
-    global _LINKS
+    global _SNAPSHOT, _SNAPSHOT_VERSION
+
+    from thorbanks.context import build_bank_contexts
 
-    _LINKS = parse_banklinks()
+    links = parse_banklinks()
 
     if isinstance(__only_use_during_tests, dict):
         for k, v in __only_use_during_tests.items():
-            _LINKS[k].update(v)
+            links[k].update(v)
+
+    contexts = build_bank_contexts(links)
+
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT_VERSION += 1
+        _SNAPSHOT = ConfigSnapshot(_SNAPSHOT_VERSION, links, contexts)
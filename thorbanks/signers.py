@@ -0,0 +1,255 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from thorbanks import settings
+from thorbanks.keys import key_registry
+from thorbanks.loading import SettingLoader
+from thorbanks.tracing import get_tracer
+
+
+HASH_ALGORITHMS = {
+    "sha1": hashes.SHA1(),  # Should be used for banklink 1.1 specification (008)
+    "sha512": hashes.SHA512(),  # Should be used for banklink 1.2 specification (009)
+    "sha256": hashes.SHA256(),  # Potentially unused, was supported for SEB with their own updated 1.1 specification
+}
+
+DEFAULT_SIGNER_BACKEND = "thorbanks.signers.InProcessSigner"
+
+
+def _sign_with_key(private_key, digest, hash_algorithm):
+    return private_key.sign(digest, padding.PKCS1v15(), HASH_ALGORITHMS[hash_algorithm])
+
+
+def _verify_with_key(public_key, digest, signature, hash_algorithms):
+    """Returns the first of `hash_algorithms` the signature verifies with (or None)"""
+    for hash_algorithm in hash_algorithms:
+        try:
+            public_key.verify(
+                signature, digest, padding.PKCS1v15(), HASH_ALGORITHMS[hash_algorithm]
+            )
+        except InvalidSignature:
+            continue
+
+        return hash_algorithm
+
+    return None
+
+
+def _sign(bank_name, private_key_path, digest, hash_algorithm):
+    private_key = key_registry.get_private_key(bank_name, private_key_path)
+    return _sign_with_key(private_key, digest, hash_algorithm)
+
+
+def _verify(bank_name, public_key_path, digest, signature, hash_algorithms):
+    public_key = key_registry.get_public_key(bank_name, public_key_path)
+    return _verify_with_key(public_key, digest, signature, hash_algorithms)
+
+
+def _sign_many(bank_name, private_key_path, digests, hash_algorithm):
+    return [_sign(bank_name, private_key_path, x, hash_algorithm) for x in digests]
+
+
+def _init_worker(key_paths):
+    """Warms the key registry of a worker process with the keys of all configured banks"""
+    for bank_name, private_key_path, public_key_path in key_paths:
+        try:
+            if private_key_path:
+                key_registry.get_private_key(bank_name, private_key_path)
+
+            if public_key_path:
+                key_registry.get_public_key(bank_name, public_key_path)
+
+        except (OSError, ValueError):
+            pass
+
+
+class InProcessSigner(object):
+    """Default signer backend, runs the RSA operations in the calling thread"""
+
+    def sign(self, bank_name, digest, hash_algorithm):
+        context = settings.get_bank_context(bank_name)
+        with get_tracer().span("signature.load_key", bank=bank_name):
+            private_key = key_registry.get_private_key(
+                bank_name, context.private_key_path
+            )
+
+        return _sign_with_key(private_key, digest, hash_algorithm)
+
+    def sign_many(self, bank_name, digests, hash_algorithm):
+        context = settings.get_bank_context(bank_name)
+        return _sign_many(bank_name, context.private_key_path, digests, hash_algorithm)
+
+    def verify(self, bank_name, digest, signature, hash_algorithms):
+        """Returns the first of `hash_algorithms` the signature verifies with or None if none of them do"""
+        context = settings.get_bank_context(bank_name)
+        with get_tracer().span("signature.load_key", bank=bank_name):
+            public_key = key_registry.get_public_key(bank_name, context.public_key_path)
+
+        return _verify_with_key(public_key, digest, signature, hash_algorithms)
+
+    def close(self):
+        pass
+
+
+class ProcessPoolSigner(InProcessSigner):
+    """Runs the RSA operations in a pool of worker processes so they don't hold the GIL of the web worker
+
+    Workers are started on first use and preload the keys of all configured banks. If a worker doesn't answer
+    within `timeout` seconds (or the pool is broken) the operation falls back to in-process signing.
+
+    Example settings:
+
+        THORBANKS_SIGNER = {
+            "BACKEND": "thorbanks.signers.ProcessPoolSigner",
+            "OPTIONS": {"pool_size": 4, "timeout": 2.0},
+        }
+    """
+
+    def __init__(self, pool_size=None, timeout=5.0):
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    key_paths = [
+                        (x.bank_name, x.private_key_path, x.public_key_path)
+                        for x in settings.get_contexts().values()
+                    ]
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.pool_size,
+                        initializer=_init_worker,
+                        initargs=(key_paths,),
+                    )
+
+        return self._executor
+
+    def _run(self, fallback, func, *args):
+        try:
+            future = self.get_executor().submit(func, *args)
+            return future.result(timeout=self.timeout)
+
+        except FutureTimeoutError:
+            # Don't leave the abandoned work queued in the pool while signing in-process
+            future.cancel()
+            logging.warning(
+                "thorbanks signer pool did not respond in %s seconds, falling back to in-process signing",
+                self.timeout,
+            )
+
+        except BrokenProcessPool:
+            logging.exception(
+                "thorbanks signer pool is broken, falling back to in-process signing"
+            )
+            self.close()
+
+        return fallback()
+
+    def sign(self, bank_name, digest, hash_algorithm):
+        context = settings.get_bank_context(bank_name)
+        return self._run(
+            lambda: super(ProcessPoolSigner, self).sign(
+                bank_name, digest, hash_algorithm
+            ),
+            _sign,
+            bank_name,
+            context.private_key_path,
+            digest,
+            hash_algorithm,
+        )
+
+    def sign_many(self, bank_name, digests, hash_algorithm):
+        context = settings.get_bank_context(bank_name)
+        digests = list(digests)
+
+        # Split the batch into chunks so every worker gets a share of the work
+        chunk_count = max(1, (self.pool_size or 1) * 4)
+        chunk_size = max(1, -(-len(digests) // chunk_count))
+        chunks = [
+            digests[i : i + chunk_size] for i in range(0, len(digests), chunk_size)
+        ]
+
+        futures = []
+        try:
+            executor = self.get_executor()
+            futures = [
+                executor.submit(
+                    _sign_many,
+                    bank_name,
+                    context.private_key_path,
+                    chunk,
+                    hash_algorithm,
+                )
+                for chunk in chunks
+            ]
+            timeout = None if self.timeout is None else self.timeout * chunk_size
+            return [
+                signature
+                for future in futures
+                for signature in future.result(timeout=timeout)
+            ]
+
+        except FutureTimeoutError:
+            for future in futures:
+                future.cancel()
+
+            logging.warning(
+                "thorbanks signer pool did not sign the batch in time, falling back to in-process signing"
+            )
+
+        except BrokenProcessPool:
+            logging.exception(
+                "thorbanks signer pool is broken, falling back to in-process signing"
+            )
+            self.close()
+
+        return super(ProcessPoolSigner, self).sign_many(
+            bank_name, digests, hash_algorithm
+        )
+
+    def verify(self, bank_name, digest, signature, hash_algorithms):
+        context = settings.get_bank_context(bank_name)
+        hash_algorithms = list(hash_algorithms)
+        return self._run(
+            lambda: super(ProcessPoolSigner, self).verify(
+                bank_name, digest, signature, hash_algorithms
+            ),
+            _verify,
+            bank_name,
+            context.public_key_path,
+            digest,
+            signature,
+            hash_algorithms,
+        )
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+_signer = SettingLoader(
+    "THORBANKS_SIGNER", DEFAULT_SIGNER_BACKEND, close=lambda signer: signer.close()
+)
+
+
+def get_signer():
+    """Returns the signer backend configured by settings.THORBANKS_SIGNER"""
+    return _signer.get()
+
+
+def reset_signer():
+    _signer.reset()
@@ -0,0 +1,306 @@
+import logging
+import random
+import threading
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode
+from urllib.request import urlopen
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from thorbanks import settings
+from thorbanks.forms import render_redirect_form, render_redirect_page
+from thorbanks.keys import load_private_key, load_public_key
+from thorbanks.signers import HASH_ALGORITHMS
+from thorbanks.utils import build_digest, get_field_order
+
+
+class SimulatorError(Exception):
+    """Raised for requests the simulated bank rejects"""
+
+
+def http_pingback(url, fields):
+    """Default pingback, POSTs the fields to `url` like the bank's server would"""
+    with urlopen(url, data=urlencode(fields).encode("UTF-8"), timeout=10) as response:
+        response.read()
+
+
+def serialize_public_key(public_key):
+    return public_key.public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+
+
+class SimulatedBank(object):
+    """Minimal in-process iPizza bank for load testing without the bank test servers
+
+    Accepts signed 1012 payment and 4012 authentication requests, verifies them with the merchant's public
+    key and answers with 1111/1911 and 3013 responses signed with the bank's private key. Successful and
+    failed payments also trigger an automatic (VK_AUTO=Y) pingback to VK_RETURN, like real banks do.
+
+    When `private_key` (PEM) is not given a new key is generated, write `public_key_pem` to the PUBLIC_KEY file
+    of the bank in settings.BANKLINKS (see `write_public_key`). Use `for_bank` to simulate a configured bank.
+
+    The bank can be used directly (`handle`) or mounted as a WSGI application, which answers requests with
+    the page that returns the user to VK_RETURN.
+
+    Options:
+        success_rate: share of payments which succeed (1111), the rest fail (1911)
+        auto_pingback: send automatic pingbacks
+        pingback: callable(url, fields) used to deliver pingbacks, defaults to an HTTP POST
+        pingback_delay: seconds to wait before the pingback is sent (0 sends it synchronously)
+    """
+
+    def __init__(
+        self,
+        bank_id,
+        merchant_public_key,
+        private_key=None,
+        request_hash_algorithm="sha1",
+        response_hash_algorithm="sha1",
+        field_orders=None,
+        count_bytes=False,
+        success_rate=1.0,
+        auto_pingback=True,
+        pingback=None,
+        pingback_delay=0,
+        pingback_workers=4,
+    ):
+        self.bank_id = bank_id
+        self.merchant_public_key = load_public_key(merchant_public_key)
+
+        if private_key is None:
+            self.private_key = rsa.generate_private_key(
+                public_exponent=65537, key_size=2048
+            )
+        else:
+            self.private_key = load_private_key(private_key)
+
+        self.request_hasher = HASH_ALGORITHMS[request_hash_algorithm]
+        self.response_hasher = HASH_ALGORITHMS[response_hash_algorithm]
+        self.field_orders = field_orders
+        self.count_bytes = count_bytes
+        self.success_rate = success_rate
+
+        self.auto_pingback = auto_pingback
+        self.pingback = pingback or http_pingback
+        self.pingback_delay = pingback_delay
+        self.pingback_workers = pingback_workers
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._transaction_counter = 0
+
+        self.requests = 0
+        self.rejected = 0
+        self.pingbacks = 0
+
+    @classmethod
+    def for_bank(cls, bank_name, **kwargs):
+        """Simulates the bank `bank_name` of settings.BANKLINKS
+
+        Requests are verified with the public half of the merchant's PRIVATE_KEY, the hash algorithms, field
+        orders and digest format are taken from the bank's configuration.
+        """
+        context = settings.get_bank_context(bank_name)
+
+        kwargs.setdefault("request_hash_algorithm", context.sign_hash_algorithm)
+        kwargs.setdefault("response_hash_algorithm", context.verify_hash_algorithm)
+        kwargs.setdefault("field_orders", context.field_orders)
+        kwargs.setdefault("count_bytes", context.digest_counts_bytes)
+
+        return cls(
+            context.bank_id,
+            serialize_public_key(context.private_key.public_key()),
+            **kwargs,
+        )
+
+    @property
+    def public_key_pem(self):
+        return serialize_public_key(self.private_key.public_key())
+
+    def write_public_key(self, path):
+        with open(path, "wb") as handle:
+            handle.write(self.public_key_pem)
+
+    def _digest(self, fields, auth=False, response=False):
+        field_order = get_field_order(
+            fields.get("VK_SERVICE"),
+            auth=auth,
+            response=response,
+            field_orders=self.field_orders,
+        )
+        return build_digest(fields, field_order, count_bytes=self.count_bytes)
+
+    def verify(self, fields, auth=False):
+        try:
+            self.merchant_public_key.verify(
+                b64decode(fields["VK_MAC"]),
+                self._digest(fields, auth=auth),
+                padding.PKCS1v15(),
+                self.request_hasher,
+            )
+        except (InvalidSignature, KeyError, ValueError):
+            return False
+
+        return True
+
+    def sign(self, fields, auth=False):
+        fields["VK_MAC"] = b64encode(
+            self.private_key.sign(
+                self._digest(fields, auth=auth, response=True),
+                padding.PKCS1v15(),
+                self.response_hasher,
+            )
+        ).decode("ascii")
+        return fields
+
+    @staticmethod
+    def now():
+        return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S%z")
+
+    def payment_response(self, request, success):
+        with self._lock:
+            self._transaction_counter += 1
+            transaction_number = self._transaction_counter
+
+        fields = {
+            "VK_SERVICE": "1111" if success else "1911",
+            "VK_VERSION": request["VK_VERSION"],
+            "VK_SND_ID": self.bank_id,
+            "VK_REC_ID": request["VK_SND_ID"],
+            "VK_STAMP": request["VK_STAMP"],
+            "VK_REF": request.get("VK_REF", ""),
+            "VK_MSG": request["VK_MSG"],
+            "VK_ENCODING": request.get("VK_ENCODING", "UTF-8"),
+            "VK_LANG": request.get("VK_LANG", "EST"),
+        }
+
+        if success:
+            fields.update(
+                {
+                    "VK_T_NO": str(transaction_number),
+                    "VK_AMOUNT": request["VK_AMOUNT"],
+                    "VK_CURR": request["VK_CURR"],
+                    "VK_REC_ACC": "EE871600161234567892",
+                    "VK_REC_NAME": "Simulated Merchant",
+                    "VK_SND_ACC": "EE871600161234567893",
+                    "VK_SND_NAME": "Simulated Customer",
+                    "VK_T_DATETIME": self.now(),
+                }
+            )
+        else:
+            fields["VK_DATETIME"] = self.now()
+
+        return self.sign(fields)
+
+    def auth_response(self, request):
+        fields = {
+            "VK_SERVICE": "3013",
+            "VK_VERSION": request["VK_VERSION"],
+            "VK_DATETIME": self.now(),
+            "VK_SND_ID": self.bank_id,
+            "VK_REC_ID": request["VK_SND_ID"],
+            "VK_NONCE": request["VK_NONCE"],
+            "VK_USER_NAME": "Simulated Customer",
+            "VK_USER_ID": "37602294565",
+            "VK_COUNTRY": "EE",
+            "VK_OTHER": "",
+            "VK_TOKEN": "1",
+            "VK_RID": request.get("VK_RID", ""),
+            "VK_ENCODING": request.get("VK_ENCODING", "UTF-8"),
+            "VK_LANG": request.get("VK_LANG", "EST"),
+        }
+        return self.sign(fields, auth=True)
+
+    def handle(self, request):
+        """Processes a request dict, returns (return url, response fields for the user's return)
+
+        The automatic pingback (if enabled) is dispatched before returning.
+        """
+        with self._lock:
+            self.requests += 1
+
+        service = request.get("VK_SERVICE")
+        auth = service == "4012"
+
+        if service not in ("1012", "4012") or not self.verify(request, auth=auth):
+            with self._lock:
+                self.rejected += 1
+            raise SimulatorError("Invalid request %s" % service)
+
+        if auth:
+            return request["VK_RETURN"], dict(self.auth_response(request))
+
+        success = self.success_rate >= 1 or random.random() < self.success_rate
+        response = self.payment_response(request, success)
+
+        if self.auto_pingback:
+            self.send_pingback(request["VK_RETURN"], dict(response, VK_AUTO="Y"))
+
+        return (
+            request["VK_RETURN"] if success else request["VK_CANCEL"],
+            dict(response, VK_AUTO="N"),
+        )
+
+    def _deliver(self, url, fields):
+        try:
+            self.pingback(url, fields)
+        except Exception:
+            logging.exception("Simulated bank failed to deliver a pingback to %s", url)
+        else:
+            with self._lock:
+                self.pingbacks += 1
+
+    def send_pingback(self, url, fields):
+        if not self.pingback_delay:
+            self._deliver(url, fields)
+            return
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pingback_workers)
+
+        timer = threading.Timer(
+            self.pingback_delay, self._executor.submit, (self._deliver, url, fields)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def __call__(self, environ, start_response):
+        """WSGI entry point, accepts the request as a urlencoded POST body or query string"""
+        if environ["REQUEST_METHOD"] == "POST":
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            raw = environ["wsgi.input"].read(length).decode("UTF-8")
+        else:
+            raw = environ.get("QUERY_STRING", "")
+
+        try:
+            url, fields = self.handle(dict(parse_qsl(raw, keep_blank_values=True)))
+        except SimulatorError as e:
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return [str(e).encode("UTF-8")]
+
+        body = render_redirect_page(
+            "Simulated bank", render_redirect_form(url, fields.items())
+        ).encode("UTF-8")
+
+        start_response(
+            "200 OK",
+            [
+                ("Content-Type", "text/html; charset=UTF-8"),
+                ("Content-Length", str(len(body))),
+            ],
+        )
+        return [body]
@@ -0,0 +1,167 @@
+import logging
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from thorbanks.loading import SettingLoader
+
+
+DEFAULT_TRACER_BACKEND = "thorbanks.tracing.NullTracer"
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return None
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer(object):
+    """Default tracer, `span` returns a shared no-op span"""
+
+    enabled = False
+
+    def span(self, name, **attributes):
+        """Returns a context manager timing the phase `name`
+
+        The span supports `set_attribute(key, value)` for attributes which are only known inside the block.
+        Attributes used by thorbanks are `bank`, `transaction_id`, `auth_id` and `service`.
+        """
+        return NULL_SPAN
+
+
+class LoggingSpan(object):
+    __slots__ = ("tracer", "name", "attributes", "start")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.finish(self, time.perf_counter() - self.start, exc_type)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class LoggingTracer(NullTracer):
+    """Logs the duration of every span, e.g. to build per-phase latency breakdowns from the logs
+
+        THORBANKS_TRACER = {
+            "BACKEND": "thorbanks.tracing.LoggingTracer",
+            "OPTIONS": {"logger": "thorbanks.tracing", "level": "INFO"},
+        }
+
+    The records carry `span`, `duration` (seconds), `error` and `attributes` as extra fields for structured
+    log handlers.
+    """
+
+    enabled = True
+
+    def __init__(self, logger="thorbanks.tracing", level="DEBUG"):
+        self.logger = logging.getLogger(logger)
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+
+    def span(self, name, **attributes):
+        return LoggingSpan(self, name, attributes)
+
+    def finish(self, span, duration, exc_type=None):
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        error = exc_type.__name__ if exc_type is not None else None
+        self.logger.log(
+            self.level,
+            "%s took %.3fms%s %s",
+            span.name,
+            duration * 1e3,
+            " (%s)" % error if error else "",
+            " ".join(
+                "%s=%s" % item
+                for item in span.attributes.items()
+                if item[1] is not None
+            ),
+            extra={
+                "span": span.name,
+                "duration": duration,
+                "error": error,
+                "attributes": dict(span.attributes),
+            },
+        )
+
+
+class OpenTelemetrySpan(object):
+    __slots__ = ("manager", "span")
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.manager.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return self.manager.__exit__(exc_type, exc_value, tb)
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.span.set_attribute("thorbanks.%s" % key, value)
+
+
+class OpenTelemetryTracer(NullTracer):
+    """Creates OpenTelemetry spans with the globally configured tracer provider
+
+    Requires the `opentelemetry-api` package. Span names and attributes are prefixed with `thorbanks.`.
+    """
+
+    enabled = True
+
+    def __init__(self, name="thorbanks"):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImproperlyConfigured(
+                "OpenTelemetryTracer requires the opentelemetry-api package"
+            )
+
+        self.tracer = trace.get_tracer(name)
+
+    def span(self, name, **attributes):
+        return OpenTelemetrySpan(
+            self.tracer.start_as_current_span(
+                "thorbanks.%s" % name,
+                attributes={
+                    "thorbanks.%s" % key: value
+                    for key, value in attributes.items()
+                    if value is not None
+                },
+            )
+        )
+
+
+_tracer = SettingLoader("THORBANKS_TRACER", DEFAULT_TRACER_BACKEND)
+
+
+def get_tracer():
+    """Returns the tracer configured by settings.THORBANKS_TRACER"""
+    return _tracer.get()
+
+
+def reset_tracer():
+    _tracer.reset()
@@ -1,19 +1,76 @@
 import logging
+import threading
+import time
 from base64 import b64decode, b64encode
-from functools import reduce
 
 from django.urls import reverse
 from django.utils.encoding import force_str
 
-from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
-
 from thorbanks import settings
+from thorbanks.metrics import get_metrics
+from thorbanks.refnum import calculate_731_checksum  # NOQA
+from thorbanks.signers import get_signer, HASH_ALGORITHMS  # NOQA
+from thorbanks.tracing import get_tracer
 
 
+# Order of the fields used for the MAC of every iPizza message, keyed by VK_SERVICE. Bank specific
+# variants can be added with the FIELD_ORDERS key of the bank in settings.BANKLINKS.
 IPIZZA_REQUEST_ORDER = {
+    "1011": (
+        "VK_SERVICE",
+        "VK_VERSION",
+        "VK_SND_ID",
+        "VK_STAMP",
+        "VK_AMOUNT",
+        "VK_CURR",
+        "VK_ACC",
+        "VK_NAME",
+        "VK_REF",
+        "VK_MSG",
+        "VK_RETURN",
+        "VK_CANCEL",
+        "VK_DATETIME",
+    ),
+    "1012": (
+        "VK_SERVICE",
+        "VK_VERSION",
+        "VK_SND_ID",
+        "VK_STAMP",
+        "VK_AMOUNT",
+        "VK_CURR",
+        "VK_REF",
+        "VK_MSG",
+        "VK_RETURN",
+        "VK_CANCEL",
+        "VK_DATETIME",
+    ),
+    "1111": (
+        "VK_SERVICE",
+        "VK_VERSION",
+        "VK_SND_ID",
+        "VK_REC_ID",
+        "VK_STAMP",
+        "VK_T_NO",
+        "VK_AMOUNT",
+        "VK_CURR",
+        "VK_REC_ACC",
+        "VK_REC_NAME",
+        "VK_SND_ACC",
+        "VK_SND_NAME",
+        "VK_REF",
+        "VK_MSG",
+        "VK_T_DATETIME",
+    ),
+    "1911": (
+        "VK_SERVICE",
+        "VK_VERSION",
+        "VK_SND_ID",
+        "VK_REC_ID",
+        "VK_STAMP",
+        "VK_REF",
+        "VK_MSG",
+        "VK_DATETIME",
+    ),
     "3012": (
         "VK_SERVICE",
         "VK_VERSION",
@@ -63,12 +120,6 @@ IPIZZA_REQUEST_ORDER = {
     ),
 }
 
-HASH_ALGORITHMS = {
-    "sha1": hashes.SHA1(),  # Should be used for banklink 1.1 specification (008)
-    "sha512": hashes.SHA512(),  # Should be used for banklink 1.2 specification (009)
-    "sha256": hashes.SHA256(),  # Potentially unused, was supported for SEB with their own updated 1.1 specification
-}
-
 
 def _get_hasher(hash_algorithm, bank_name):
     hasher = HASH_ALGORITHMS.get(hash_algorithm)
@@ -79,161 +130,320 @@ def _get_hasher(hash_algorithm, bank_name):
     return hasher
 
 
-def get_ordered_request(request, auth=False, response=False):
-    def append_if_exists(target, source, the_value):
-        if the_value in source:
-            target.append(source[the_value])
-        return target
+# Services used when the message does not specify a (known) VK_SERVICE, keyed by (auth, response)
+DEFAULT_SERVICES = {
+    (False, False): "1012",
+    (False, True): "1111",
+    (True, False): "4012",
+    (True, True): "3013",
+}
 
-    if not auth:
-        if response:
-            expected_values = (
-                "VK_SERVICE",
-                "VK_VERSION",
-                "VK_SND_ID",
-                "VK_REC_ID",
-                "VK_STAMP",
-                "VK_T_NO",
-                "VK_AMOUNT",
-                "VK_CURR",
-                "VK_REC_ACC",
-                "VK_REC_NAME",
-                "VK_SND_ACC",
-                "VK_SND_NAME",
-                "VK_REF",
-                "VK_MSG",
-                "VK_T_DATETIME",
-            )
 
-        else:
-            expected_values = (
-                "VK_SERVICE",
-                "VK_VERSION",
-                "VK_SND_ID",
-                "VK_STAMP",
-                "VK_AMOUNT",
-                "VK_CURR",
-                "VK_REF",
-                "VK_MSG",
-                "VK_RETURN",
-                "VK_CANCEL",
-                "VK_DATETIME",
-            )
+# VK_SERVICE prefixes of the messages accepted for each (auth, response) combination. Payment callbacks are
+# 11xx/19xx and auth callbacks 30xx, services added with FIELD_ORDERS are allowed when they match the prefix.
+SERVICE_PREFIXES = {
+    (False, False): ("10",),
+    (False, True): ("11", "19"),
+    (True, False): ("40",),
+    (True, True): ("30",),
+}
 
-    else:
-        if response:
-            expected_values = IPIZZA_REQUEST_ORDER["3013"]
+# Field a callback's record is looked up with, it has to be covered by the MAC of an accepted service
+LOOKUP_FIELDS = {
+    (False, True): "VK_STAMP",
+    (True, True): "VK_NONCE",
+}
 
-        else:
-            expected_values = IPIZZA_REQUEST_ORDER["4012"]
 
-    ordered_request = []
-    for value in expected_values:
-        ordered_request = append_if_exists(ordered_request, request, value)
-    return ordered_request
+def is_allowed_service(service, auth=False, response=False, field_orders=None):
+    """Checks that `service` has a known field order and belongs to the auth/response combination
+
+    A message signed for one endpoint must never be accepted by another one, e.g. a 1911 payment response with
+    an added VK_NONCE (not part of its MAC) posted to the authentication endpoint. Responses are only accepted
+    if their field order signs the field used to look up the record (e.g. not 3012, which has no VK_NONCE).
+    """
+    if field_orders is None:
+        field_orders = IPIZZA_REQUEST_ORDER
+
+    if not isinstance(service, str) or service not in field_orders:
+        return False
+
+    lookup_field = LOOKUP_FIELDS.get((auth, response))
+    if lookup_field is not None and lookup_field not in field_orders[service]:
+        return False
+
+    return service.startswith(SERVICE_PREFIXES[auth, response])
+
+
+def get_field_order(service=None, auth=False, response=False, field_orders=None):
+    """Returns the MAC field order of the VK_SERVICE `service`
+
+    Falls back to the default service of the auth/response combination when `service` is unknown.
+    """
+    if field_orders is None:
+        field_orders = IPIZZA_REQUEST_ORDER
+
+    field_order = field_orders.get(service)
+    if field_order is None:
+        field_order = field_orders[DEFAULT_SERVICES[auth, response]]
+
+    return field_order
+
+
+def get_ordered_request(request, auth=False, response=False, field_order=None):
+    if field_order is None:
+        field_order = get_field_order(
+            request.get("VK_SERVICE"), auth=auth, response=response
+        )
+
+    return [request[key] for key in field_order if key in request]
+
+
+def build_digest(request, field_order, count_bytes=False):
+    """Builds the MAC input of `request` from the fields listed in `field_order`
+
+    Every present field is written as a zero-padded three digit length followed by the UTF-8 encoded value.
+    The length is the number of characters by default or the number of bytes when `count_bytes` is set
+    (see DIGEST_COUNTS_BYTES in BANKLINKS).
+    """
+    digest = bytearray()
+
+    for key in field_order:
+        if key not in request:
+            continue
+
+        value = request[key]
+        if type(value) is not str:
+            value = force_str(value)
+
+        encoded = value.encode("UTF-8")
+        digest += b"%03d" % (len(encoded) if count_bytes else len(value))
+        digest += encoded
+
+    return bytes(digest)
 
 
 def request_digest(request, bank_name, auth=False, response=False):
     """
     return request digest in Banklink signature form (see docs for format)
     """
-    request = get_ordered_request(request, auth=auth, response=response)
-    digest = ""
-    for value in request:
-        value_len = len(value)
-        digest += force_str(value_len).rjust(3, "0")
-        digest += force_str(value)
-    return digest.encode("UTF-8")
+    context = settings.get_bank_context(bank_name)
+    return build_digest(
+        request,
+        context.get_field_order(
+            request.get("VK_SERVICE"), auth=auth, response=response
+        ),
+        count_bytes=context.digest_counts_bytes,
+    )
 
 
 def get_pkey(bank_name):
-    with open(settings.get_private_key(bank_name), "rb") as handle:
-        private_key = serialization.load_pem_private_key(
-            handle.read(), password=None, backend=default_backend()
-        )
+    return settings.get_bank_context(bank_name).private_key
 
-    return private_key
+
+def get_public_pkey(bank_name):
+    return settings.get_bank_context(bank_name).public_key
 
 
 def create_signature(request, bank_name, hash_algorithm="sha1", auth=False):
     """
     sign BankLink request in dict format with private_key
     """
-    digest = request_digest(request, bank_name, auth=auth)
+    tracer = get_tracer()
+
+    with tracer.span("signature.digest", bank=bank_name):
+        digest = request_digest(request, bank_name, auth=auth)
+
+    # Validate the algorithm before handing the work over to the signer backend
+    _get_hasher(hash_algorithm, bank_name)
 
-    private_key = get_pkey(bank_name)
+    with tracer.span("signature.sign", bank=bank_name, hash_algorithm=hash_algorithm):
+        metrics = get_metrics()
+        if not metrics.enabled:
+            signature = get_signer().sign(bank_name, digest, hash_algorithm)
 
-    hasher = _get_hasher(hash_algorithm, bank_name)
-    signature = private_key.sign(digest, padding.PKCS1v15(), hasher)
+        else:
+            start = time.perf_counter()
+            signature = get_signer().sign(bank_name, digest, hash_algorithm)
+
+            labels = {"bank": bank_name, "hash_algorithm": hash_algorithm}
+            metrics.observe("sign_seconds", time.perf_counter() - start, **labels)
+            metrics.increment("signatures_total", **labels)
 
     return force_str(b64encode(signature))
 
 
+class HashAlgorithmDetector(object):
+    """Remembers which hash algorithm each bank actually signs its responses with.
+
+    Banks sometimes switch hash algorithms before the merchant updates VERIFY_HASH_ALGORITHM. Instead of
+    retrying the configured algorithm on every callback, the algorithm that last verified successfully
+    is tried first and algorithms that failed while another one succeeded are tried last.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._detected = {}
+        self._failed = {}
+        self._successes = {}
+
+    def candidates(self, bank_name, configured):
+        # record() mutates the failed set of the bank in other threads, iterate over a snapshot
+        with self._lock:
+            failed = tuple(sorted(self._failed.get(bank_name, ())))
+            preferred = [self._detected.get(bank_name, configured), configured]
+
+        preferred.extend(HASH_ALGORITHMS)
+
+        result = []
+        for hash_algorithm in preferred:
+            if hash_algorithm not in result and hash_algorithm not in failed:
+                result.append(hash_algorithm)
+
+        # Previously failed algorithms are still tried as a last resort in case the bank switches back
+        result.extend(x for x in failed if x not in result)
+
+        return result
+
+    def record(self, bank_name, hash_algorithm, configured, failed=()):
+        with self._lock:
+            previous = self._detected.get(bank_name, configured)
+            self._detected[bank_name] = hash_algorithm
+
+            bank_failed = self._failed.setdefault(bank_name, set())
+            bank_failed.discard(hash_algorithm)
+            bank_failed.update(failed)
+
+            bank_successes = self._successes.setdefault(bank_name, {})
+            bank_successes[hash_algorithm] = bank_successes.get(hash_algorithm, 0) + 1
+
+        if hash_algorithm != previous:
+            logging.warning(
+                "%s banklink is using %s hash algorithm, "
+                "but the banklink configuration is using %s.",
+                bank_name,
+                hash_algorithm,
+                configured,
+            )
+
+    def get_detected(self, bank_name):
+        return self._detected.get(bank_name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                bank_name: {
+                    "detected": self._detected.get(bank_name),
+                    "failed": sorted(self._failed.get(bank_name, ())),
+                    "successes": dict(successes),
+                }
+                for bank_name, successes in self._successes.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._detected.clear()
+            self._failed.clear()
+            self._successes.clear()
+
+
+hash_algorithm_detector = HashAlgorithmDetector()
+
+
+def get_detected_hash_algorithm(bank_name):
+    """Returns the hash algorithm last seen in a valid response of the bank (or None)"""
+    return hash_algorithm_detector.get_detected(bank_name)
+
+
 def verify_signature(request, bank_name, signature, auth=False, response=False):
     """
     verify BankLink reply signature
     """
-    signature = force_str(signature)
+    context = settings.get_bank_context(bank_name)
+
+    service = request.get("VK_SERVICE")
+    if not context.is_allowed_service(service, auth=auth, response=response):
+        # Don't fall back to the default field order, the message was signed for another endpoint
+        logging.warning(
+            "Rejected %s banklink message with unexpected VK_SERVICE %s",
+            bank_name,
+            service,
+        )
+        return False
 
-    with open(settings.get_public_key(bank_name), "rb") as handle:
-        public_key = serialization.load_pem_public_key(handle.read(), default_backend())
+    signature = b64decode(force_str(signature))
 
-    digest = request_digest(request, bank_name, auth=auth, response=response)
+    tracer = get_tracer()
 
-    hash_algorithm = settings.get_verify_hash_algorithm(bank_name)
-    hasher = _get_hasher(hash_algorithm, bank_name)
+    with tracer.span("signature.digest", bank=bank_name):
+        digest = request_digest(request, bank_name, auth=auth, response=response)
 
-    try:
-        public_key.verify(b64decode(signature), digest, padding.PKCS1v15(), hasher)
-        return True
-    except InvalidSignature:
-        # Verification with the configured hash algorithm failed. We will try to verify
-        # with the other hash algorithms as a fallback in case the bank has switched
-        # to a new hash algorithm.
-        for hash_algorithm, hasher in HASH_ALGORITHMS.items():
-            try:
-                public_key.verify(
-                    b64decode(signature), digest, padding.PKCS1v15(), hasher
-                )
-                logging.warning(
-                    "%s banklink is using %s hash algorithm, "
-                    "but the banklink configuration is using %s.",
-                    bank_name,
-                    hash_algorithm,
-                    settings.get_hash_algorithm(bank_name),
-                )
-                return True
-            except InvalidSignature:
-                pass
-
-        if not auth:
-            # The client might have paid, but we don't accept the banklink response.
-            # Need to check if the payment was successful and contact the client!
-            logging.critical(
-                "Signature verification for the successful %s banklink callback has "
-                "failed. Immediate action required to confirm the payment's status.",
-                bank_name,
+    if context.verify_hasher is None:
+        _get_hasher(context.verify_hash_algorithm, bank_name)
+
+    # Try the algorithm the bank used last time first. When it fails we fall back to the other hash
+    # algorithms in case the bank has switched to a new one.
+    candidates = hash_algorithm_detector.candidates(
+        bank_name, context.verify_hash_algorithm
+    )
+
+    with tracer.span("signature.verify", bank=bank_name):
+        metrics = get_metrics()
+        if not metrics.enabled:
+            hash_algorithm = get_signer().verify(
+                bank_name, digest, signature, candidates
             )
-        return False
+
+        else:
+            start = time.perf_counter()
+            hash_algorithm = get_signer().verify(
+                bank_name, digest, signature, candidates
+            )
+
+            metrics.observe(
+                "verify_seconds", time.perf_counter() - start, bank=bank_name
+            )
+            metrics.increment(
+                "verifications_total",
+                bank=bank_name,
+                hash_algorithm=hash_algorithm or "none",
+                valid="true" if hash_algorithm is not None else "false",
+            )
+            if hash_algorithm is None:
+                metrics.increment(
+                    "signature_failures_total",
+                    bank=bank_name,
+                    kind="auth" if auth else "payment",
+                )
+
+    if hash_algorithm is not None:
+        hash_algorithm_detector.record(
+            bank_name,
+            hash_algorithm,
+            context.verify_hash_algorithm,
+            failed=candidates[: candidates.index(hash_algorithm)],
+        )
+        return True
+
+    if not auth:
+        # The client might have paid, but we don't accept the banklink response.
+        # Need to check if the payment was successful and contact the client!
+        logging.critical(
+            "Signature verification for the successful %s banklink callback has "
+            "failed. Immediate action required to confirm the payment's status.",
+            bank_name,
+        )
+    return False
 
 
 def weight_generator():
-    """Used for weight generation by calculate_731_checksum"""
+    """Yields the 7-3-1 weights, kept for backwards compatibility (see thorbanks.refnum)"""
     while True:
         yield 7
         yield 3
         yield 1
 
 
-def calculate_731_checksum(number):
-    # Check if number is integer, then cast to string
-    number = str(int(number))[::-1]
-    gen = weight_generator()
-    weight_sum = reduce(lambda x, y: x + int(y) * next(gen), number, 0)
-    checksum = (10 - weight_sum % 10) % 10
-    return int(number[::-1] + str(checksum))
-
-
 def pingback_url(request=None, base_url=None):
     assert request or base_url
 
@@ -1,19 +1,32 @@
+import codecs
 import logging
+from types import MappingProxyType
+from urllib.parse import unquote_to_bytes
 
-from django.http import HttpResponse, HttpResponseRedirect, QueryDict
+import django
+from django.core.handlers.wsgi import get_bytes_from_wsgi
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from asgiref.sync import sync_to_async
+
 from thorbanks import settings
+from thorbanks.archive import get_archived_transaction
 from thorbanks.forms import IPizzaAuthRequest, PaymentRequest
+from thorbanks.metrics import get_metrics
+from thorbanks.nonces import aget_auth_or_404, get_auth_or_404, get_nonce_backend
+from thorbanks.refnum import is_valid_reference
+from thorbanks.replay import CallbackOutcome, get_replay_cache
 from thorbanks.signals import (
     auth_failed,
     auth_succeeded,
     transaction_failed,
     transaction_succeeded,
 )
+from thorbanks.tracing import get_tracer
 from thorbanks.utils import verify_signature
 
 
@@ -27,6 +40,110 @@ def get_request_data(request):
     return request.GET
 
 
+def get_raw_query_string(request):
+    """Returns the query string as the bytes the bank sent or None if the request doesn't expose them"""
+    scope = getattr(request, "scope", None)
+    if scope is not None:
+        # ASGIRequest.META has the query string decoded as UTF-8 already
+        return scope.get("query_string", b"")
+
+    environ = getattr(request, "environ", None)
+    if environ is not None:
+        return get_bytes_from_wsgi(environ, "QUERY_STRING", "")
+
+    return None
+
+
+def parse_callback_data(request):
+    """Decodes the bank's callback payload in a single pass, returns an immutable mapping
+
+    The raw query string (GET) or urlencoded body (POST) is split once and decoded with the encoding given
+    in VK_ENCODING (UTF-8 by default), so the data doesn't have to be parsed again after fixing
+    request.encoding. Other POST bodies (e.g. multipart) are left to Django. The result is cached on the
+    request.
+    """
+    data = getattr(request, "_thorbanks_callback_data", None)
+    if data is not None:
+        return data
+
+    if request.method != "POST":
+        raw = get_raw_query_string(request)
+    elif request.content_type == "application/x-www-form-urlencoded":
+        raw = request.body
+    else:
+        raw = None
+
+    if raw is None:
+        data = get_request_data(request).dict()
+
+    else:
+        pairs = []
+        for field in raw.split(b"&"):
+            if field:
+                key, _, value = field.replace(b"+", b" ").partition(b"=")
+                pairs.append((unquote_to_bytes(key), unquote_to_bytes(value)))
+
+        encoding = "UTF-8"
+        for key, value in pairs:
+            if key == b"VK_ENCODING":
+                encoding = value.decode("ascii", "replace")
+
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            encoding = "UTF-8"
+
+        data = {
+            key.decode(encoding, "replace"): value.decode(encoding, "replace")
+            for key, value in pairs
+        }
+
+    request._thorbanks_callback_data = data = MappingProxyType(data)
+    return data
+
+
+async def aget_object_or_404(klass, **kwargs):
+    if django.VERSION >= (4, 1):
+        try:
+            return await klass._default_manager.aget(**kwargs)
+        except klass.DoesNotExist:
+            raise Http404("No %s matches the given query." % klass._meta.object_name)
+
+    return await sync_to_async(get_object_or_404)(klass, **kwargs)
+
+
+def get_transaction_or_404(klass, pk):
+    """Returns the transaction `pk`, falling back to the archive for late callbacks of archived rows"""
+    try:
+        return klass._default_manager.get(pk=pk)
+    except klass.DoesNotExist:
+        transaction = get_archived_transaction(pk)
+
+    if transaction is None:
+        raise Http404("No %s matches the given query." % klass._meta.object_name)
+
+    return transaction
+
+
+async def aget_transaction_or_404(klass, pk):
+    try:
+        return await aget_object_or_404(klass, pk=pk)
+    except Http404:
+        transaction = await sync_to_async(get_archived_transaction)(pk)
+
+    if transaction is None:
+        raise Http404("No %s matches the given query." % klass._meta.object_name)
+
+    return transaction
+
+
+async def asend(signal, sender, **kwargs):
+    if django.VERSION >= (5, 0):
+        return await signal.asend(sender, **kwargs)
+
+    return await sync_to_async(signal.send)(sender, **kwargs)
+
+
 class PaymentError(Exception):
     """Generic error class."""
 
@@ -35,49 +152,92 @@ class AuthError(Exception):
     """Generic error class."""
 
 
-@csrf_exempt
-def response(request):
-    data = get_request_data(request)
-    if "VK_MAC" not in data:
-        raise PaymentError("VK_MAC not in request")
+def check_service(data, bank_name, error_class, auth=False):
+    """Rejects callbacks whose VK_SERVICE doesn't belong to the endpoint, before their signature is verified"""
+    service = data.get("VK_SERVICE")
+    if not settings.get_bank_context(bank_name).is_allowed_service(
+        service, auth=auth, response=True
+    ):
+        logging.warning(
+            "thorbanks: Got unexpected VK_SERVICE %s from %s for %s callback",
+            service,
+            bank_name,
+            "an auth" if auth else "a payment",
+        )
+        raise error_class("Unexpected VK_SERVICE %s" % service)
+
+
+def get_payment_outcome(klass, data):
+    """Returns the (status, signal) a payment callback should result in"""
+    reference = data.get("VK_REF")
+    if reference and not is_valid_reference(reference):
+        # The bank signed it so the payment is still processed, but reconciliation by reference will fail
+        logging.warning(
+            "thorbanks.views.response(): Got invalid VK_REF %s from bank (transaction %s)",
+            reference,
+            data["VK_STAMP"],
+        )
+
+    if data["VK_SERVICE"] == "1111":
+        return klass.STATUS_COMPLETED, transaction_succeeded
+
+    if data["VK_SERVICE"] == "1911":
+        return klass.STATUS_FAILED, transaction_failed
+
+    logging.critical(
+        "thorbanks.views.response(): Got invalid VK_SERVICE code from bank: %s (transaction %s)",
+        data["VK_SERVICE"],
+        data["VK_STAMP"],
+    )
+
+    raise PaymentError("Bank sent confirmation with invalid VK_SERVICE!")
+
 
-    klass = settings.get_model("Transaction")
-    transaction = get_object_or_404(klass, pk=data["VK_STAMP"])
+def complete_late_payment(klass, transaction, status):
+    """Returns True if `status` is a success that should move the failed (e.g. expired) transaction to completed"""
+    if status != klass.STATUS_COMPLETED or transaction.status == klass.STATUS_COMPLETED:
+        return False
 
-    # Set proper encoding and get the data again (this time in correct encoding)
-    request.encoding = "UTF-8"
+    # The in-memory status may still be pending if the row was expired after it was loaded, look at the row
+    return transaction.transition_status(status, from_status=klass.STATUS_FAILED)
 
-    # We have to manually replace POST after changing encoding because of a Django bug (?)
-    request.POST = QueryDict(request.body, encoding=request.encoding)
-    data = get_request_data(request)
 
-    signature_valid = verify_signature(
-        data, transaction.bank_name, data["VK_MAC"], response=True
+async def acomplete_late_payment(klass, transaction, status):
+    """Async variant of `complete_late_payment`"""
+    if status != klass.STATUS_COMPLETED or transaction.status == klass.STATUS_COMPLETED:
+        return False
+
+    return await transaction.atransition_status(status, from_status=klass.STATUS_FAILED)
+
+
+def log_late_payment(transaction):
+    logging.critical(
+        "thorbanks.views.response(): Bank confirmed payment of failed transaction %s (bank %s), "
+        "marked it as completed",
+        transaction.pk,
+        transaction.bank_name,
     )
-    if not signature_valid:
-        raise PaymentError("Invalid signature. ")
 
-    if data["VK_SERVICE"] == "1111":
-        if transaction.status == klass.STATUS_PENDING:
-            # Mark purchase as complete
-            transaction.status = klass.STATUS_COMPLETED
-            transaction.save()
-            transaction_succeeded.send(klass, transaction=transaction, request=request)
-    elif data["VK_SERVICE"] == "1911":
-        if transaction.status == klass.STATUS_PENDING:
-            # Mark purchase as failed
-            transaction.status = klass.STATUS_FAILED
-            transaction.save()
-            transaction_failed.send(klass, transaction=transaction, request=request)
-    else:
-        logging.critical(
-            "thorbanks.views.response(): Got invalid VK_SERVICE code from bank: %s (transaction %s)",
-            data["VK_SERVICE"],
-            data["VK_STAMP"],
+
+def record_callback(bank_name, data, duplicate=None):
+    """Counts a verified callback, `duplicate` tells where a callback of a finished transaction was detected"""
+    metrics = get_metrics()
+    if not metrics.enabled:
+        return
+
+    metrics.increment(
+        "callbacks_total",
+        bank=bank_name or "",
+        service=data["VK_SERVICE"],
+        auto=data.get("VK_AUTO", "N"),
+    )
+    if duplicate is not None:
+        metrics.increment(
+            "duplicate_callbacks_total", bank=bank_name or "", source=duplicate
         )
 
-        raise PaymentError("Bank sent confirmation with invalid VK_SERVICE!")
 
+def get_payment_response(transaction, data):
     if data["VK_AUTO"] == "Y":
         # This is automatic pingback from the bank - send simple 200 response as text/plain.
         return HttpResponse("request handled", content_type="text/plain")
@@ -91,6 +251,159 @@ def response(request):
     return HttpResponseRedirect(url)
 
 
+@csrf_exempt
+def response(request):
+    tracer = get_tracer()
+
+    with tracer.span("payment_callback") as span:
+        with tracer.span("payment_callback.parse"):
+            data = parse_callback_data(request)
+
+        if "VK_MAC" not in data:
+            raise PaymentError("VK_MAC not in request")
+
+        span.set_attribute("service", data.get("VK_SERVICE"))
+
+        # Duplicates of an already verified callback of a final transaction are answered from the replay cache
+        replay_cache = get_replay_cache()
+        if replay_cache is not None:
+            with tracer.span("payment_callback.replay_cache"):
+                replay_key = replay_cache.make_key(data)
+                outcome = replay_cache.get(replay_key)
+
+            if outcome is not None:
+                span.set_attribute("bank", outcome.bank_name)
+                record_callback(outcome.bank_name, data, duplicate="replay_cache")
+                return get_payment_response(outcome, data)
+
+        klass = settings.get_model("Transaction")
+        with tracer.span("payment_callback.lookup"):
+            transaction = get_transaction_or_404(klass, data["VK_STAMP"])
+
+        attributes = {"bank": transaction.bank_name, "transaction_id": transaction.pk}
+        for key, value in attributes.items():
+            span.set_attribute(key, value)
+
+        check_service(data, transaction.bank_name, PaymentError)
+
+        with tracer.span("payment_callback.verify", **attributes):
+            signature_valid = verify_signature(
+                data, transaction.bank_name, data["VK_MAC"], response=True
+            )
+        if not signature_valid:
+            raise PaymentError("Invalid signature. ")
+
+        status, signal = get_payment_outcome(klass, data)
+        with tracer.span("payment_callback.transition", **attributes):
+            finished = (
+                transaction.status == klass.STATUS_PENDING
+                and transaction.transition_status(status)
+            )
+            late = not finished and complete_late_payment(klass, transaction, status)
+
+        if finished or late:
+            # Purchase was marked as complete/failed by this request
+            extra = {}
+            if late:
+                # The transaction was failed (e.g. expired) while the user was still paying at the bank
+                log_late_payment(transaction)
+                extra["late"] = True
+
+            with tracer.span("payment_callback.signal", **attributes):
+                signal.send(klass, transaction=transaction, request=request, **extra)
+            record_callback(transaction.bank_name, data)
+        else:
+            record_callback(transaction.bank_name, data, duplicate="database")
+
+        if replay_cache is not None and transaction.status != klass.STATUS_PENDING:
+            replay_cache.set(replay_key, CallbackOutcome.from_transaction(transaction))
+
+        return get_payment_response(transaction, data)
+
+
+async def async_response(request):
+    """Async variant of `response` for ASGI deployments (requires Django 3.1+)
+
+    The ORM calls use Django's async ORM where available and the signature is verified in a worker thread,
+    so a single ASGI worker can serve many concurrent bank callbacks.
+    """
+    tracer = get_tracer()
+
+    with tracer.span("payment_callback") as span:
+        with tracer.span("payment_callback.parse"):
+            data = parse_callback_data(request)
+
+        if "VK_MAC" not in data:
+            raise PaymentError("VK_MAC not in request")
+
+        span.set_attribute("service", data.get("VK_SERVICE"))
+
+        replay_cache = get_replay_cache()
+        if replay_cache is not None:
+            with tracer.span("payment_callback.replay_cache"):
+                replay_key = replay_cache.make_key(data)
+                outcome = await replay_cache.aget(replay_key)
+
+            if outcome is not None:
+                span.set_attribute("bank", outcome.bank_name)
+                record_callback(outcome.bank_name, data, duplicate="replay_cache")
+                return get_payment_response(outcome, data)
+
+        klass = settings.get_model("Transaction")
+        with tracer.span("payment_callback.lookup"):
+            transaction = await aget_transaction_or_404(klass, data["VK_STAMP"])
+
+        attributes = {"bank": transaction.bank_name, "transaction_id": transaction.pk}
+        for key, value in attributes.items():
+            span.set_attribute(key, value)
+
+        check_service(data, transaction.bank_name, PaymentError)
+
+        with tracer.span("payment_callback.verify", **attributes):
+            signature_valid = await sync_to_async(
+                verify_signature, thread_sensitive=False
+            )(data, transaction.bank_name, data["VK_MAC"], response=True)
+        if not signature_valid:
+            raise PaymentError("Invalid signature. ")
+
+        status, signal = get_payment_outcome(klass, data)
+        with tracer.span("payment_callback.transition", **attributes):
+            finished = (
+                transaction.status == klass.STATUS_PENDING
+                and await transaction.atransition_status(status)
+            )
+            late = not finished and await acomplete_late_payment(
+                klass, transaction, status
+            )
+
+        if finished or late:
+            # Purchase was marked as complete/failed by this request
+            extra = {}
+            if late:
+                # The transaction was failed (e.g. expired) while the user was still paying at the bank
+                log_late_payment(transaction)
+                extra["late"] = True
+
+            with tracer.span("payment_callback.signal", **attributes):
+                await asend(
+                    signal, klass, transaction=transaction, request=request, **extra
+                )
+            record_callback(transaction.bank_name, data)
+        else:
+            record_callback(transaction.bank_name, data, duplicate="database")
+
+        if replay_cache is not None and transaction.status != klass.STATUS_PENDING:
+            await replay_cache.aset(
+                replay_key, CallbackOutcome.from_transaction(transaction)
+            )
+
+        return get_payment_response(transaction, data)
+
+
+# csrf_exempt wraps the view in a sync function before Django 5.0, so mark the coroutine function directly
+async_response.csrf_exempt = True
+
+
 def create_payment_request(
     bank_name,
     message,
@@ -100,17 +413,24 @@ def create_payment_request(
     redirect_to,
     redirect_on_failure,
     extra_fields=None,
+    options=None,
 ):
-    return PaymentRequest(
-        bank_name=bank_name,
-        amount=amount,
-        currency=currency,
-        redirect_to=redirect_to,
-        redirect_on_failure=redirect_on_failure,
-        message=message,
-        url=pingback_url,
-        extra_fields=extra_fields,
-    )
+    """Creates a Transaction and returns the signed PaymentRequest for it
+
+    `options` overrides BANKLINKS options of the bank for this request only (e.g. `{"SEND_REF": False}`),
+    see `thorbanks.settings.override_bank_options`.
+    """
+    with settings.override_bank_options(bank_name, **(options or {})):
+        return PaymentRequest(
+            bank_name=bank_name,
+            amount=amount,
+            currency=currency,
+            redirect_to=redirect_to,
+            redirect_on_failure=redirect_on_failure,
+            message=message,
+            url=pingback_url,
+            extra_fields=extra_fields,
+        )
 
 
 def create_auth_request(
@@ -131,6 +451,14 @@ def create_auth_request(
     )
 
 
+def get_auth_outcome(klass, data):
+    """Returns the (status, signal) an auth response should result in"""
+    if data["VK_SERVICE"] == "3013":
+        return klass.STATUS_COMPLETED, auth_succeeded
+
+    return klass.STATUS_FAILED, auth_failed
+
+
 class AuthResponseView(View):
     def __init__(self, **kwargs):
         self.data = None
@@ -141,50 +469,28 @@ class AuthResponseView(View):
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
-        self.data = get_request_data(request)
-
-        if "VK_MAC" in self.data:
-            self.handle_ipizza(request)
-        else:
-            raise AuthError("Invalid request (unknown protocol)")
-
-        return super(AuthResponseView, self).dispatch(request, *args, **kwargs)
+        tracer = get_tracer()
 
-    def handle_ipizza(self, request):
-        klass = settings.get_model("Authentication")
-        auth = get_object_or_404(klass, pk=self.data.get("VK_NONCE", None))
+        with tracer.span("auth_callback") as span:
+            with tracer.span("auth_callback.parse"):
+                self.data = parse_callback_data(request)
 
-        # Set proper encoding and get the data again (this time in correct encoding)
-        request.encoding = "UTF-8"
+            if "VK_MAC" in self.data:
+                span.set_attribute("service", self.data.get("VK_SERVICE"))
+                self.handle_ipizza(request)
+            else:
+                raise AuthError("Invalid request (unknown protocol)")
 
-        # We have to manually replace POST after changing encoding because of a Django bug (?)
-        request.POST = QueryDict(request.body, encoding=request.encoding)
-        self.data = get_request_data(request)
+            if self.auth is not None:
+                span.set_attribute("bank", self.auth.bank_name)
+                span.set_attribute("auth_id", self.auth.pk)
 
-        signature_valid = verify_signature(
-            self.data, auth.bank_name, self.data["VK_MAC"], auth=True, response=True
-        )
-        if not signature_valid:
-            raise AuthError("Invalid signature. ")
+            return super(AuthResponseView, self).dispatch(request, *args, **kwargs)
 
-        self.data = self.data.dict()
-
-        if self.data["VK_SERVICE"] == "3013":
-            if auth.status == klass.STATUS_PENDING:
-                # Mark auth as complete
-                auth.raw_response = self.data
-                auth.status = klass.STATUS_COMPLETED
-                auth.save()
-                auth_succeeded.send(klass, auth=auth)
-
-        else:
-            if auth.status == klass.STATUS_PENDING:
-                # Mark auth as failed
-                auth.raw_response = self.data
-                auth.status = klass.STATUS_FAILED
-                auth.save()
-                auth_failed.send(klass, auth=auth)
+    def prepare_ipizza(self, request):
+        self.data = parse_callback_data(request)
 
+    def finish_ipizza(self, auth):
         # This request is from the user after being redirected from the bank to our server. Redirect her further.
         if self.data["VK_SERVICE"] == "3013":
             self.url = auth.redirect_after_success
@@ -196,8 +502,125 @@ class AuthResponseView(View):
         self.data["name"] = self.data.get("VK_USER_NAME")
         self.data["person_code"] = self.data.get("VK_USER_ID")
 
+    def handle_ipizza(self, request):
+        tracer = get_tracer()
+
+        klass = settings.get_model("Authentication")
+        nonce = self.data.get("VK_NONCE", None)
+        with tracer.span("auth_callback.lookup"):
+            auth = get_auth_or_404(klass, nonce)
+
+        self.prepare_ipizza(request)
+
+        check_service(self.data, auth.bank_name, AuthError, auth=True)
+
+        attributes = {"bank": auth.bank_name, "auth_id": auth.pk}
+        with tracer.span("auth_callback.verify", **attributes):
+            signature_valid = verify_signature(
+                self.data, auth.bank_name, self.data["VK_MAC"], auth=True, response=True
+            )
+        if not signature_valid:
+            raise AuthError("Invalid signature. ")
+
+        self.data = dict(self.data)
+
+        status, signal = get_auth_outcome(klass, self.data)
+        with tracer.span("auth_callback.transition", **attributes):
+            finished = (
+                auth.status == klass.STATUS_PENDING
+                and get_nonce_backend().transition(
+                    auth, nonce, status, **auth.get_response_fields(self.data)
+                )
+            )
+
+        if finished:
+            # Auth was marked as complete/failed by this request
+            with tracer.span("auth_callback.signal", **attributes):
+                signal.send(klass, auth=auth)
+            record_callback(auth.bank_name, self.data)
+        else:
+            record_callback(auth.bank_name, self.data, duplicate="database")
+
+        self.finish_ipizza(auth)
+
     def get(self, request, *args, **kwargs):
         return HttpResponseRedirect(self.url)
 
     def post(self, request, *args, **kwargs):
         return self.get(request, *args, **kwargs)
+
+
+class AsyncAuthResponseView(AuthResponseView):
+    """Async variant of `AuthResponseView` for ASGI deployments (requires Django 3.1+, 4.1+ for the async ORM)
+
+    Subclasses must keep all HTTP method handlers async.
+    """
+
+    @method_decorator(csrf_exempt)
+    async def dispatch(self, request, *args, **kwargs):
+        tracer = get_tracer()
+
+        with tracer.span("auth_callback") as span:
+            with tracer.span("auth_callback.parse"):
+                self.data = parse_callback_data(request)
+
+            if "VK_MAC" in self.data:
+                span.set_attribute("service", self.data.get("VK_SERVICE"))
+                await self.ahandle_ipizza(request)
+            else:
+                raise AuthError("Invalid request (unknown protocol)")
+
+            if self.auth is not None:
+                span.set_attribute("bank", self.auth.bank_name)
+                span.set_attribute("auth_id", self.auth.pk)
+
+            return await super(AuthResponseView, self).dispatch(
+                request, *args, **kwargs
+            )
+
+    async def ahandle_ipizza(self, request):
+        tracer = get_tracer()
+
+        klass = settings.get_model("Authentication")
+        nonce = self.data.get("VK_NONCE", None)
+        with tracer.span("auth_callback.lookup"):
+            auth = await aget_auth_or_404(klass, nonce)
+
+        self.prepare_ipizza(request)
+
+        check_service(self.data, auth.bank_name, AuthError, auth=True)
+
+        attributes = {"bank": auth.bank_name, "auth_id": auth.pk}
+        with tracer.span("auth_callback.verify", **attributes):
+            signature_valid = await sync_to_async(
+                verify_signature, thread_sensitive=False
+            )(self.data, auth.bank_name, self.data["VK_MAC"], auth=True, response=True)
+        if not signature_valid:
+            raise AuthError("Invalid signature. ")
+
+        self.data = dict(self.data)
+
+        status, signal = get_auth_outcome(klass, self.data)
+        with tracer.span("auth_callback.transition", **attributes):
+            finished = (
+                auth.status == klass.STATUS_PENDING
+                and await get_nonce_backend().atransition(
+                    auth, nonce, status, **auth.get_response_fields(self.data)
+                )
+            )
+
+        if finished:
+            # Auth was marked as complete/failed by this request
+            with tracer.span("auth_callback.signal", **attributes):
+                await asend(signal, klass, auth=auth)
+            record_callback(auth.bank_name, self.data)
+        else:
+            record_callback(auth.bank_name, self.data, duplicate="database")
+
+        self.finish_ipizza(auth)
+
+    async def get(self, request, *args, **kwargs):
+        return HttpResponseRedirect(self.url)
+
+    async def post(self, request, *args, **kwargs):
+        return await self.get(request, *args, **kwargs)
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import Authentication, Transaction
+from .models import Authentication, Transaction, TransactionArchive
 
 
 admin.site.register(Authentication)
 admin.site.register(Transaction)
+admin.site.register(TransactionArchive)
@@ -1,4 +1,8 @@
-from thorbanks.abstract_models import AbstractAuthentication, AbstractTransaction
+from thorbanks.abstract_models import (
+    AbstractAuthentication,
+    AbstractTransaction,
+    AbstractTransactionArchive,
+)
 
 
 class Authentication(AbstractAuthentication):
@@ -7,3 +11,7 @@ class Authentication(AbstractAuthentication):
 
 class Transaction(AbstractTransaction):
     pass
+
+
+class TransactionArchive(AbstractTransactionArchive):
+    pass